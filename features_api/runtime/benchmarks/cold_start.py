@@ -0,0 +1,208 @@
+"""Cold start: import time of the application, by package, and duration of its init.
+
+Runs against the PostGIS database of `docker-compose.yml` (`docker-compose up database`),
+seeded with `--tables` synthetic tables.
+
+usage: python -m benchmarks.cold_start --tables 50 --output cold_start.json
+       python -m benchmarks.cold_start --tables 50 --baseline cold_start.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from benchmarks.datasets import DEFAULT_ENV, database_url, seed_point_tables
+
+# Tables created by the benchmark, dropped and seeded again with `--tables`
+TABLE_PREFIX = "cold_start_"
+
+# Run in a new interpreter for each sample, so that nothing is imported yet
+COLD_START = """
+import asyncio, json, time
+
+start = time.perf_counter()
+from src.app import app
+imported = time.perf_counter() - start
+
+from src.monitoring import init_timings
+
+async def init():
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        return time.perf_counter() - start
+
+lifespan = asyncio.run(init())
+print("COLD_START " + json.dumps({
+    "import": imported * 1000,
+    "lifespan": lifespan * 1000,
+    "collections": len(app.state.collection_catalog["collections"]),
+    "phases": init_timings,
+}))
+"""
+
+
+def package_times(importtime: str) -> Dict[str, float]:
+    """Self import time (ms) of the top-level packages, from `-X importtime` output."""
+    times: Dict[str, float] = defaultdict(float)
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, module = line[len("import time:"):].split("|")
+        times[module.strip().split(".")[0]] += int(self_us) / 1000
+    return times
+
+
+def cold_start(env: Dict[str, str]) -> Dict:
+    """Import and start the application in a new interpreter."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", COLD_START],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    lines = [line for line in process.stdout.splitlines() if line.startswith("COLD_START ")]
+    if process.returncode or not lines:
+        sys.exit(f"cold start failed:\n{process.stderr[-2000:]}")
+
+    sample = json.loads(lines[-1][len("COLD_START "):])
+    sample["packages"] = package_times(process.stderr)
+    return sample
+
+
+def summarize(samples: List[Dict]) -> Dict:
+    """Median of the samples."""
+    packages = {name for sample in samples for name in sample["packages"]}
+    phases = {name for sample in samples for name in sample["phases"]}
+    return {
+        "samples": len(samples),
+        "collections": samples[0]["collections"],
+        "import": statistics.median(s["import"] for s in samples),
+        "lifespan": statistics.median(s["lifespan"] for s in samples),
+        "phases": {
+            name: statistics.median(s["phases"].get(name, 0.0) for s in samples)
+            for name in sorted(phases)
+        },
+        "packages": dict(
+            sorted(
+                (
+                    (name, statistics.median(s["packages"].get(name, 0.0) for s in samples))
+                    for name in packages
+                ),
+                key=lambda item: -item[1],
+            )
+        ),
+    }
+
+
+def regressions(
+    results: Dict,
+    baseline: Optional[Dict] = None,
+    max_regression: float = 500.0,
+    max_import: Optional[float] = None,
+    max_init: Optional[float] = None,
+) -> List[str]:
+    """Import and init durations above their limits, or above the baseline."""
+    failures = []
+    if max_import is not None and results["import"] > max_import:
+        failures.append(f"import above {max_import} ms")
+    if max_init is not None and results["lifespan"] > max_init:
+        failures.append(f"init above {max_init} ms")
+
+    if baseline:
+        for name in ("import", "lifespan"):
+            if results[name] > baseline[name] + max_regression:
+                failures.append(
+                    f"{name} {results[name]:.0f} ms, {baseline[name]:.0f} ms in the baseline"
+                )
+
+    return failures
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tables",
+        type=int,
+        help="Seed this many synthetic tables before measuring (keep the current ones when unset).",
+    )
+    parser.add_argument("--rows", type=int, default=1000, help="Rows of each synthetic table.")
+    parser.add_argument("--samples", type=int, default=5, help="Cold starts measured.")
+    parser.add_argument(
+        "--profile",
+        choices=["lambda", "server"],
+        default="lambda",
+        help="Database pool profile of the application.",
+    )
+    parser.add_argument("--top", type=int, default=15, help="Packages listed.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results of a previous run.")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=500.0,
+        help="Fail when the import or init takes more milliseconds than the baseline plus this.",
+    )
+    parser.add_argument(
+        "--max-import", type=float, help="Fail when the import takes more milliseconds than this."
+    )
+    parser.add_argument(
+        "--max-init", type=float, help="Fail when the init takes more milliseconds than this."
+    )
+    args = parser.parse_args()
+
+    env = {**DEFAULT_ENV, **os.environ, "VEDA_FEATURES_DB_POOL_PROFILE": args.profile}
+
+    if args.tables is not None:
+        print(f"Seeding {args.tables} tables of {args.rows} rows")
+        asyncio.run(
+            seed_point_tables(database_url(env), TABLE_PREFIX, args.tables, args.rows)
+        )
+
+    # A first run warms the file system cache and writes the bytecode
+    cold_start(env)
+    results = summarize([cold_start(env) for _ in range(args.samples)])
+
+    print(f"{results['collections']} collections, median of {results['samples']} cold starts")
+    print(f"import {results['import']:.0f} ms, init (lifespan) {results['lifespan']:.0f} ms")
+    for name, duration in results["phases"].items():
+        print(f"  init {name:<12} {duration:8.1f} ms")
+    for name, duration in list(results["packages"].items())[: args.top]:
+        print(f"  import {name:<24} {duration:8.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        # What changed the most, to find the culprit of a regression
+        changes = sorted(
+            (
+                (duration - baseline["packages"].get(name, 0.0), name)
+                for name, duration in results["packages"].items()
+            ),
+            reverse=True,
+        )
+        for change, name in changes[:5]:
+            if change > 1:
+                print(f"  import {name:<24} {change:+8.1f} ms since the baseline")
+
+    failures = regressions(
+        results, baseline, args.max_regression, args.max_import, args.max_init
+    )
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
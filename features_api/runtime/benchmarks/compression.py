@@ -0,0 +1,212 @@
+"""CPU time of the response compression, per request.
+
+Compares `starlette_cramjam` (every response compressed on every request, with the codec
+default levels) with src.compression, compressing each response (`live`) or serving
+the variants stored with a cached response (`cached`).
+
+usage: python -m benchmarks.compression --requests 200 --output compression.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+from typing import Dict, List, Tuple
+
+from starlette_cramjam.compression import Compression
+from starlette_cramjam.middleware import CompressionMiddleware as CramjamMiddleware
+
+from src.compression import (
+    VARIANTS_SCOPE_KEY,
+    CompressedVariants,
+    CompressionMiddleware,
+)
+
+
+def geojson_items(features: int) -> bytes:
+    """Page of GeoJSON point features."""
+    rng = random.Random(0)
+    return json.dumps(
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "id": i,
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [rng.uniform(-125, -66), rng.uniform(24, 50)],
+                    },
+                    "properties": {
+                        "name": f"feature {i}",
+                        "value": rng.random() * 100,
+                        "datetime": f"2020-01-{1 + i % 28:02d}T00:00:00Z",
+                    },
+                }
+                for i in range(features)
+            ],
+            "numberMatched": features,
+            "numberReturned": features,
+        }
+    ).encode()
+
+
+def collections_list(collections: int) -> bytes:
+    """Collection list, mostly links."""
+    return json.dumps(
+        {
+            "collections": [
+                {
+                    "id": f"public.collection_{i}",
+                    "title": f"public.collection_{i}",
+                    "links": [
+                        {
+                            "href": f"https://example.com/collections/public.collection_{i}/{rel}",
+                            "rel": rel,
+                            "type": "application/geo+json",
+                        }
+                        for rel in ("self", "items", "queryables", "tiles")
+                    ],
+                }
+                for i in range(collections)
+            ]
+        }
+    ).encode()
+
+
+def vector_tile(features: int) -> bytes:
+    """Bytes shaped like an MVT layer: tags, then zigzag varint deltas of geometries."""
+    rng = random.Random(0)
+    out = bytearray(b"\x1a\x00\x0a\x05layer")
+    for i in range(features):
+        out += struct.pack("BBB", 0x12, 0x04, i % 16)
+        for _ in range(rng.randint(2, 20)):
+            delta = rng.randint(-64, 64)
+            out.append(((delta << 1) ^ (delta >> 31)) & 0x7F)
+    return bytes(out)
+
+
+PAYLOADS: Dict[str, Tuple[str, bytes]] = {
+    "small json": ("application/json", b'{"ping":"pong!"}'),
+    "collections": ("application/json", collections_list(100)),
+    "items (10)": ("application/geo+json", geojson_items(10)),
+    "items (1000)": ("application/geo+json", geojson_items(1000)),
+    "tile": ("application/vnd.mapbox-vector-tile", vector_tile(2000)),
+}
+
+
+def response_app(media_type: str, body: bytes):
+    """ASGI app sending a fixed response."""
+
+    async def app(scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", media_type.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+async def measure(
+    middleware, encoding: str, requests: int, variants: bool = False
+) -> Tuple[float, int]:
+    """CPU microseconds per request, and size of the response body."""
+    sizes: List[int] = []
+    stored: Dict[str, bytes] = {}
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            sizes.append(len(message.get("body", b"")))
+
+    def scope():
+        s = {
+            "type": "http",
+            "method": "GET",
+            "path": "/",
+            "headers": [(b"accept-encoding", encoding.encode())],
+        }
+        if variants:
+            s[VARIANTS_SCOPE_KEY] = CompressedVariants(stored, stored.__setitem__)
+        return s
+
+    # The first request compresses the variant of a cached response
+    await middleware(scope(), receive, send)
+
+    start = time.process_time()
+    for _ in range(requests):
+        await middleware(scope(), receive, send)
+    cpu = time.process_time() - start
+
+    return cpu / requests * 1e6, sizes[-1]
+
+
+async def run(requests: int, encodings: List[str]) -> List[Dict]:
+    """Measure every payload, encoding and compression."""
+    results = []
+    for name, (media_type, body) in PAYLOADS.items():
+        app = response_app(media_type, body)
+        for encoding in encodings:
+            cramjam = CramjamMiddleware(
+                app, compression=[Compression[encoding]] if encoding != "zstd" else None
+            )
+            ours = CompressionMiddleware(app, encodings=[encoding])
+            row = {"payload": name, "encoding": encoding, "size": len(body)}
+            if encoding != "zstd":
+                # starlette_cramjam does not support zstd
+                row["cramjam"], row["cramjam_size"] = await measure(
+                    cramjam, encoding, requests
+                )
+            row["live"], row["live_size"] = await measure(ours, encoding, requests)
+            row["cached"], row["cached_size"] = await measure(
+                ours, encoding, requests, variants=True
+            )
+            results.append(row)
+
+    return results
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per measure.")
+    parser.add_argument(
+        "--encoding",
+        action="append",
+        choices=["br", "gzip", "zstd"],
+        help="Encodings measured (repeat for several, all by default).",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.requests, args.encoding or ["br", "gzip", "zstd"]))
+
+    print(
+        f"{'payload':<14} {'enc':<5} {'bytes':>8} {'cramjam µs':>11} {'live µs':>9} "
+        f"{'cached µs':>10} {'cramjam B':>10} {'ours B':>8}"
+    )
+    for row in results:
+        cramjam = f"{row['cramjam']:11.1f}" if "cramjam" in row else f"{'-':>11}"
+        cramjam_size = f"{row['cramjam_size']:10d}" if "cramjam" in row else f"{'-':>10}"
+        print(
+            f"{row['payload']:<14} {row['encoding']:<5} {row['size']:8d} {cramjam} "
+            f"{row['live']:9.1f} {row['cached']:10.1f} {cramjam_size} {row['live_size']:8d}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
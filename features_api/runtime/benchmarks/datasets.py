@@ -0,0 +1,63 @@
+"""Deterministic synthetic tables of the benchmarks"""
+from typing import Dict, List
+
+from buildpg import asyncpg
+
+# PostGIS database of docker-compose.yml
+DEFAULT_ENV = {
+    "POSTGRES_USER": "username",
+    "POSTGRES_PASS": "password",
+    "POSTGRES_DBNAME": "postgis",
+    "POSTGRES_HOST": "localhost",
+    "POSTGRES_PORT": "5432",
+}
+
+
+def database_url(env: Dict[str, str]) -> str:
+    """Database URL from the `POSTGRES_*` variables of an environment."""
+    return (
+        "postgresql://{POSTGRES_USER}:{POSTGRES_PASS}@{POSTGRES_HOST}:{POSTGRES_PORT}"
+        "/{POSTGRES_DBNAME}".format(**{**DEFAULT_ENV, **env})
+    )
+
+
+async def seed_point_tables(dsn: str, prefix: str, tables: int, rows: int) -> List[str]:
+    """Replace the `{prefix}*` tables by `tables` tables of `rows` random points.
+
+    The rows are the same on every run: `id`, `name`, `value` (0-100), an hourly
+    `datetime` from 2020-01-01 and a WGS84 `geom`, with a primary key and a GIST index.
+    """
+    conn = await asyncpg.connect(dsn)
+    names = [f"{prefix}{i}" for i in range(tables)]
+    try:
+        existing = await conn.fetch(
+            "SELECT tablename FROM pg_tables WHERE schemaname = 'public' AND tablename LIKE $1",
+            f"{prefix}%",
+        )
+        for record in existing:
+            await conn.execute(f'DROP TABLE public."{record["tablename"]}"')
+
+        await conn.execute("SELECT setseed(0.42)")
+        for name in names:
+            table = f'public."{name}"'
+            await conn.execute(
+                f"""
+                CREATE TABLE {table} AS
+                SELECT
+                    g AS id,
+                    md5(g::text) AS name,
+                    random() * 100 AS value,
+                    timestamptz '2020-01-01' + g * interval '1 hour' AS datetime,
+                    ST_SetSRID(
+                        ST_MakePoint(random() * 360 - 180, random() * 170 - 85), 4326
+                    )::geometry(Point, 4326) AS geom
+                FROM generate_series(1, {rows}) AS g
+                """
+            )
+            await conn.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id)")
+            await conn.execute(f"CREATE INDEX ON {table} USING gist (geom)")
+            await conn.execute(f"ANALYZE {table}")
+    finally:
+        await conn.close()
+
+    return names
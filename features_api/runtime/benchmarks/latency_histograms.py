@@ -0,0 +1,65 @@
+"""Overhead of recording a request in the latency histograms.
+
+usage: python -m benchmarks.latency_histograms
+"""
+import argparse
+import random
+import sys
+import timeit
+
+from src.monitoring import LatencyRecorder
+
+ROUTES = [
+    "/collections",
+    "/collections/{collectionId}",
+    "/collections/{collectionId}/items",
+    "/collections/{collectionId}/tiles/{tileMatrixSetId}/{z}/{x}/{y}",
+]
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1_000_000)
+    parser.add_argument(
+        "--max-overhead",
+        type=float,
+        default=3.0,
+        help="Fail when a record takes more microseconds than this.",
+    )
+    args = parser.parse_args()
+
+    recorder = LatencyRecorder(
+        namespace="benchmark",
+        dimensions={},
+        flush_interval=3600,
+        collections=[f"public.collection_{i}" for i in range(10)],
+    )
+    requests = [
+        (
+            random.choice(ROUTES),
+            random.choice([200, 200, 200, 304, 404, 500]),
+            f"public.collection_{random.randrange(50)}",
+            random.lognormvariate(-3, 1.5),
+        )
+        for _ in range(10_000)
+    ]
+
+    def run():
+        for route, status, collection, duration in requests:
+            recorder.record(route, status, collection, duration)
+
+    rounds = max(args.requests // len(requests), 1)
+    elapsed = min(timeit.repeat(run, number=rounds, repeat=5))
+    overhead = elapsed / (rounds * len(requests)) * 1e6
+
+    print(
+        f"{overhead:.2f} µs per request, "
+        f"{len(recorder.histograms)} histograms"
+    )
+    if overhead > args.max_overhead:
+        sys.exit(f"overhead above {args.max_overhead} µs")
+
+
+if __name__ == "__main__":
+    main()
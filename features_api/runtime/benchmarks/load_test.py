@@ -0,0 +1,385 @@
+"""Throughput and latency of the application under a replayed mix of requests.
+
+Runs against the PostGIS database of `docker-compose.yml` (`docker-compose up database`).
+The application runs in-process behind an ASGI client, or under uvicorn with `--uvicorn`.
+
+usage: python -m benchmarks.load_test --tables 4 --rows 100000 --record mix.jsonl
+       python -m benchmarks.load_test --mix mix.jsonl --concurrency 8 --output run.json
+       python -m benchmarks.load_test --mix mix.jsonl --uvicorn --workers 4 --baseline run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlencode
+
+import httpx
+from morecantile import tms as default_tms
+
+from benchmarks.datasets import DEFAULT_ENV, database_url, seed_point_tables
+
+# Tables created by the benchmark, dropped and seeded again with `--tables`
+TABLE_PREFIX = "load_test_"
+
+# Share of each endpoint in a recorded mix
+ENDPOINT_WEIGHTS = {
+    "collections": 5,
+    "collection": 10,
+    "items": 20,
+    "items-bbox": 20,
+    "items-cql2": 15,
+    "item": 10,
+    "tile": 20,
+}
+
+
+class Request(NamedTuple):
+    """Request of a mix."""
+
+    endpoint: str
+    path: str
+    query: str = ""
+
+    @property
+    def url(self) -> str:
+        """Path and query string."""
+        return f"{self.path}?{self.query}" if self.query else self.path
+
+
+def record_mix(collections: List[str], rows: int, count: int, seed: int = 42) -> List[Request]:
+    """Random but reproducible mix of requests on point collections of `rows` rows."""
+    rng = random.Random(seed)
+    tms = default_tms.get("WebMercatorQuad")
+    endpoints = list(ENDPOINT_WEIGHTS)
+    weights = list(ENDPOINT_WEIGHTS.values())
+
+    requests = []
+    for endpoint in rng.choices(endpoints, weights, k=count):
+        collection = rng.choice(collections)
+        items = f"/collections/{collection}/items"
+
+        if endpoint == "collections":
+            request = Request(endpoint, "/collections")
+        elif endpoint == "collection":
+            request = Request(endpoint, f"/collections/{collection}")
+        elif endpoint == "items":
+            limit = rng.choice([10, 100, 1000])
+            request = Request(
+                endpoint, items, urlencode({"limit": limit, "offset": rng.randrange(rows)})
+            )
+        elif endpoint == "items-bbox":
+            size = rng.uniform(1, 20)
+            west, south = rng.uniform(-180, 180 - size), rng.uniform(-85, 85 - size)
+            bbox = ",".join(f"{v:.4f}" for v in (west, south, west + size, south + size))
+            request = Request(endpoint, items, urlencode({"bbox": bbox, "limit": 500}))
+        elif endpoint == "items-cql2":
+            value = rng.uniform(0, 100)
+            request = Request(
+                endpoint,
+                items,
+                urlencode(
+                    {
+                        "filter-lang": "cql2-text",
+                        "filter": f"value < {value:.2f}",
+                        "limit": 100,
+                    }
+                ),
+            )
+        elif endpoint == "item":
+            request = Request(endpoint, f"{items}/{rng.randint(1, rows)}")
+        else:
+            tile = tms.tile(rng.uniform(-180, 180), rng.uniform(-85, 85), rng.randint(2, 10))
+            request = Request(
+                endpoint,
+                f"/collections/{collection}/tiles/WebMercatorQuad/{tile.z}/{tile.x}/{tile.y}",
+            )
+
+        requests.append(request)
+
+    return requests
+
+
+def read_mix(path: str) -> List[Request]:
+    """Requests of a mix file, one JSON object per line."""
+    with open(path) as f:
+        return [Request(**json.loads(line)) for line in f if line.strip()]
+
+
+def write_mix(path: str, requests: List[Request]) -> None:
+    """Write a mix file."""
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request._asdict()) + "\n")
+
+
+def percentile(durations: List[float], q: float) -> float:
+    """Nearest rank percentile of sorted durations."""
+    if not durations:
+        return 0.0
+    return durations[min(len(durations) - 1, max(0, round(q / 100 * len(durations)) - 1))]
+
+
+async def replay(
+    client: httpx.AsyncClient, requests: List[Request], concurrency: int
+) -> Tuple[List[Tuple[str, int, float]], float]:
+    """Send the requests with `concurrency` clients, return (endpoint, status, seconds)."""
+    results: List[Tuple[str, int, float]] = []
+    pending = iter(requests)
+
+    async def worker():
+        for request in pending:
+            start = time.perf_counter()
+            response = await client.get(request.url)
+            results.append(
+                (request.endpoint, response.status_code, time.perf_counter() - start)
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results, time.perf_counter() - start
+
+
+async def allocations(client: httpx.AsyncClient, requests: List[Request]) -> Dict[str, float]:
+    """Median peak of the memory allocated (KiB) while serving a request, by endpoint."""
+    peaks: Dict[str, List[float]] = defaultdict(list)
+    tracemalloc.start()
+    try:
+        for request in requests:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await client.get(request.url)
+            peaks[request.endpoint].append((tracemalloc.get_traced_memory()[1] - before) / 1024)
+    finally:
+        tracemalloc.stop()
+
+    return {endpoint: sorted(values)[len(values) // 2] for endpoint, values in peaks.items()}
+
+
+def summarize(results: List[Tuple[str, int, float]], elapsed: float) -> Dict[str, Any]:
+    """RPS and latency percentiles (ms), overall and by endpoint."""
+    by_endpoint: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+    for endpoint, status, duration in results:
+        by_endpoint[endpoint].append((status, duration))
+        by_endpoint["all"].append((status, duration))
+
+    summary = {}
+    for endpoint, values in sorted(by_endpoint.items()):
+        durations = sorted(duration * 1000 for _, duration in values)
+        summary[endpoint] = {
+            "requests": len(values),
+            "errors": sum(1 for status, _ in values if status >= 500),
+            "rps": len(values) / elapsed,
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+            "p99": percentile(durations, 99),
+        }
+    return summary
+
+
+async def run_in_process(
+    requests: List[Request], warmup: int, concurrency: int, allocation_requests: int
+) -> Dict[str, Any]:
+    """Replay the requests against the application behind an ASGI client."""
+    from src.app import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark", timeout=None
+        ) as client:
+            await replay(client, requests[:warmup], concurrency)
+            results, elapsed = await replay(client, requests[warmup:], concurrency)
+            summary = summarize(results, elapsed)
+
+            if allocation_requests:
+                peaks = await allocations(client, requests[warmup:][:allocation_requests])
+                for endpoint, peak in peaks.items():
+                    summary[endpoint]["allocated_kib"] = peak
+
+    return summary
+
+
+def free_port() -> int:
+    """A TCP port nobody listens on."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_uvicorn(
+    requests: List[Request], warmup: int, concurrency: int, workers: int, env: Dict[str, str]
+) -> Dict[str, Any]:
+    """Replay the requests against the application served by uvicorn workers."""
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "src.app:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}",
+            timeout=None,
+            limits=httpx.Limits(max_connections=concurrency),
+        ) as client:
+            for _ in range(120):
+                try:
+                    if (await client.get("/healthz")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if server.poll() is not None:
+                    sys.exit("uvicorn exited")
+                await asyncio.sleep(0.5)
+            else:
+                sys.exit("uvicorn did not start")
+
+            await replay(client, requests[:warmup], concurrency)
+            results, elapsed = await replay(client, requests[warmup:], concurrency)
+            return summarize(results, elapsed)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[Tuple[str, float, float]]:
+    """Relative change (%) of the RPS and p95 of each endpoint since a baseline run."""
+    changes = []
+    for endpoint, stats in results["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if not before or not before["rps"] or not before["p95"]:
+            continue
+        changes.append(
+            (
+                endpoint,
+                (stats["rps"] / before["rps"] - 1) * 100,
+                (stats["p95"] / before["p95"] - 1) * 100,
+            )
+        )
+    return changes
+
+
+def main():  # noqa: C901
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tables",
+        type=int,
+        help="Seed this many synthetic tables first (keep the current ones when unset).",
+    )
+    parser.add_argument("--rows", type=int, default=100000, help="Rows of each synthetic table.")
+    parser.add_argument("--mix", help="Replay the requests of this mix file.")
+    parser.add_argument(
+        "--record", help="Write the generated mix of requests to this file, to replay it later."
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the generated mix.")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests measured.")
+    parser.add_argument("--warmup", type=int, default=200, help="Requests sent first, not measured.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight.")
+    parser.add_argument(
+        "--allocations",
+        type=int,
+        default=200,
+        help="Requests replayed one at a time while tracing memory allocations (in-process only).",
+    )
+    parser.add_argument("--uvicorn", action="store_true", help="Serve the application with uvicorn.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results of a previous run.")
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        help="Fail when the overall RPS dropped or p95 grew by more than this percentage.",
+    )
+    args = parser.parse_args()
+
+    env = {**DEFAULT_ENV, **os.environ}
+    os.environ.update(env)
+
+    collections = [f"public.{TABLE_PREFIX}{i}" for i in range(args.tables or 0)]
+    if args.tables is not None:
+        print(f"Seeding {args.tables} tables of {args.rows} rows")
+        asyncio.run(seed_point_tables(database_url(env), TABLE_PREFIX, args.tables, args.rows))
+
+    if args.mix:
+        requests = read_mix(args.mix)
+    else:
+        if not collections:
+            parser.error("generating a mix needs --tables")
+        requests = record_mix(
+            collections, args.rows, args.warmup + args.requests, seed=args.seed
+        )
+        if args.record:
+            write_mix(args.record, requests)
+    requests = requests[: args.warmup + args.requests]
+
+    if args.uvicorn:
+        endpoints = asyncio.run(
+            run_uvicorn(requests, args.warmup, args.concurrency, args.workers, env)
+        )
+    else:
+        endpoints = asyncio.run(
+            run_in_process(requests, args.warmup, args.concurrency, args.allocations)
+        )
+
+    results = {
+        "mode": f"uvicorn ({args.workers} workers)" if args.uvicorn else "in-process",
+        "concurrency": args.concurrency,
+        "endpoints": endpoints,
+    }
+
+    print(f"{results['mode']}, {args.concurrency} requests in flight")
+    print(
+        f"{'endpoint':<14} {'requests':>8} {'errors':>6} {'rps':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'KiB':>8}"
+    )
+    for endpoint, stats in endpoints.items():
+        allocated = stats.get("allocated_kib")
+        print(
+            f"{endpoint:<14} {stats['requests']:>8} {stats['errors']:>6} {stats['rps']:>8.1f} "
+            f"{stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f} "
+            f"{f'{allocated:.0f}' if allocated is not None else '':>8}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        failures = []
+        for endpoint, rps, p95 in compare(results, baseline):
+            print(f"{endpoint:<14} rps {rps:+6.1f}%  p95 {p95:+6.1f}% since the baseline")
+            if (
+                endpoint == "all"
+                and args.max_slowdown is not None
+                and (-rps > args.max_slowdown or p95 > args.max_slowdown)
+            ):
+                failures.append(f"slower than the baseline by more than {args.max_slowdown}%")
+
+        if failures:
+            sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
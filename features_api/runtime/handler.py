@@ -6,21 +6,27 @@ import os
 
 from mangum import Mangum
 from src.app import app
-from src.monitoring import logger, metrics, tracer
+from src.monitoring import log_latencies, logger, metrics, tracer
 
 logging.getLogger("mangum.lifespan").setLevel(logging.DEBUG)
 logging.getLogger("mangum.http").setLevel(logging.DEBUG)
 
-handler = Mangum(app, lifespan="on")
-
 if "AWS_EXECUTION_ENV" in os.environ:
+    # Run the application lifespan once, during the init phase of the container, on the
+    # loop Mangum runs the requests on. Mangum would otherwise start (connect to the
+    # database, register the catalog) and shut down the application on every invocation.
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(app.router.startup())
+    loop.run_until_complete(app.router.lifespan_context(app).__aenter__())
+    handler = Mangum(app, lifespan="off")
+else:
+    handler = Mangum(app, lifespan="on")
 
 # Add tracing
 handler.__name__ = "handler"  # tracer requires __name__ to be set
 handler = tracer.capture_lambda_handler(handler)
 # Add logging
 handler = logger.inject_lambda_context(handler, clear_state=True)
+# Write the latency histograms of the invocation
+handler = log_latencies(handler)
 # Add metrics last to properly flush metrics.
 handler = metrics.log_metrics(handler, capture_cold_start_metric=True)
@@ -10,6 +10,7 @@ inst_reqs = [
     "pydantic>=2.4,<3.0",
     "pydantic-settings~=2.0",
     "tipg==1.1.0",
+    "cramjam>=2.6",
     "aws_xray_sdk>=2.6.0,<3",
     "aws-lambda-powertools>=1.18.0",
 ]
@@ -19,6 +20,9 @@ extra_reqs = {
     "psycopg": ["psycopg[pool]"],  # pure python implementation
     "psycopg-c": ["psycopg[c,pool]"],  # C implementation of the libpq wrapper
     "psycopg-binary": ["psycopg[binary,pool]"],  # pre-compiled C implementation
+    "arrow": ["pyarrow"],  # Arrow IPC and GeoParquet items outputs
+    "benchmark": ["httpx", "uvicorn"],  # benchmarks/load_test.py
+    "seed": ["httpx"],  # src/seed.py
     "test": ["pytest", "pytest-cov", "pytest-asyncio", "requests", "brotlipy"],
 }
 
@@ -27,7 +31,7 @@ setup(
     name="veda.features_api",
     description="",
     python_requires=">=3.9",
-    packages=find_namespace_packages(exclude=["tests*"]),
+    packages=find_namespace_packages(exclude=["tests*", "benchmarks*"]),
     zip_safe=False,
     install_requires=inst_reqs,
     extras_require=extra_reqs,
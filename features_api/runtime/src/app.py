@@ -1,23 +1,51 @@
 """feature services fastapi"""
+import asyncio
+import functools
+import os
 from contextlib import asynccontextmanager
+from typing import Optional, Tuple
 
 from src.config import FeaturesAPISettings as APISettings
 from tipg import __version__ as tipg_version
-from tipg.collections import register_collection_catalog
-from tipg.database import close_db_connection, connect_to_db
+from tipg.collections import Catalog
+from tipg.database import close_db_connection
 from tipg.errors import DEFAULT_STATUS_CODES, add_exception_handlers
-from tipg.factory import Endpoints
 from tipg.middleware import CacheControlMiddleware, CatalogUpdateMiddleware
-from tipg.settings import CustomSQLSettings, DatabaseSettings
+from tipg.settings import CustomSQLSettings, DatabaseSettings, PostgresSettings
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, status
 from starlette.middleware.cors import CORSMiddleware
-from starlette_cramjam.middleware import CompressionMiddleware
 
-from src.monitoring import LoggerRouteHandler
+from src.cache import ResponseCache, ResponseCacheMiddleware, load_cache_backend
+from src.catalog import (
+    CatalogFingerprint,
+    load_collection_catalog,
+    read_catalog_snapshot,
+    refresh_collection_catalog,
+    register_collection_catalog,
+)
+from src.compression import CompressionMiddleware
+from src.database import connect_to_db, default_pool_profile, pool_profile
+from src.dependencies import lazy_collection_dependency, lazy_collections_dependency
+from src.factory import FeaturesEndpoints
+from src.features import InvalidPageToken, UnsupportedParameter
+from src.middleware import (
+    BackgroundCatalogUpdateMiddleware,
+    LatencyMiddleware,
+    ServerTimingMiddleware,
+    SlowQueryMiddleware,
+)
+from src.monitoring import (
+    InstrumentedPool,
+    LoggerRouteHandler,
+    init_phase,
+    latency_recorder,
+)
+from src.statistics import QueryStatisticsUnavailable, collection_statistics
+from src.tiles import TileCache, TileCacheMiddleware
 
 settings = APISettings()
-postgres_settings = settings.load_postgres_settings()
+# Extents are not computed while describing the tables, they come from the extents store
 db_settings = DatabaseSettings(
     datetime_extent=False,
     spatial_extent=False
@@ -25,25 +53,78 @@ db_settings = DatabaseSettings(
 custom_sql_settings = CustomSQLSettings()
 
 
+@functools.lru_cache()
+def get_postgres_settings() -> PostgresSettings:
+    """Database settings, read from the secret when one is set."""
+    return settings.load_postgres_settings()
+
+
+async def startup(app: FastAPI, pool_size: Optional[int] = None) -> None:
+    """Connect to the database and register the catalog.
+
+    The secret fetch and the pool creation run while the catalog snapshot is read, and
+    each phase is recorded as an `Init*Time` metric. `pool_size` caps the connections
+    of the pool profile.
+    """
+
+    async def connect() -> None:
+        with init_phase("Secret"):
+            postgres_settings = await asyncio.to_thread(get_postgres_settings)
+
+        profile = pool_profile(
+            settings.db_pool_profile or default_pool_profile(),
+            postgres_settings,
+            health_check_idle=settings.db_health_check_idle,
+            health_check_timeout=settings.db_health_check_timeout,
+        )
+        if pool_size is not None:
+            profile = profile._replace(
+                min_size=min(profile.min_size, pool_size), max_size=pool_size
+            )
+
+        with init_phase("Pool"):
+            await connect_to_db(
+                app,
+                schemas=[
+                    "public",
+                ],
+                settings=postgres_settings,
+                profile=profile,
+            )
+
+    async def read_snapshot() -> Optional[Tuple[Catalog, CatalogFingerprint]]:
+        if not settings.catalog_snapshot:
+            return None
+        with init_phase("Snapshot"):
+            return await asyncio.to_thread(
+                read_catalog_snapshot, settings.catalog_snapshot, db_settings
+            )
+
+    with init_phase("Total"):
+        _, snapshot = await asyncio.gather(connect(), read_snapshot())
+        if settings.server_timing or settings.slow_query_budget is not None:
+            app.state.pool = InstrumentedPool(app.state.pool)
+
+        # Register Collection Catalog, from the snapshot when one is configured
+        with init_phase("Catalog"):
+            await load_collection_catalog(
+                app,
+                db_settings=db_settings,
+                snapshot=snapshot,
+                lazy=settings.catalog_lazy,
+                extents=settings.catalog_extents,
+            )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """reload catalogs"""
-    await connect_to_db(
-        app,
-        schemas=[
-            "public",
-        ],
-        settings=postgres_settings,
-    )
-
-    # Register Collection Catalog
-    await register_collection_catalog(
-        app,
-        db_settings=db_settings,
-    )
+    """Init, then close the pool on shutdown"""
+    await startup(app)
 
     yield
 
+    latency_recorder.flush()
+
     # Close the Connection Pool
     await close_db_connection(app)
 
@@ -57,13 +138,58 @@ app = FastAPI(
     root_path=settings.root_path,
 )
 
-ogc_api = Endpoints(
+endpoints_kwargs = {}
+if settings.catalog_lazy:
+    endpoints_kwargs = {
+        "collection_dependency": lazy_collection_dependency(
+            db_settings, settings.catalog_ttl
+        ),
+        "collections_dependency": lazy_collections_dependency(
+            db_settings, settings.catalog_ttl
+        ),
+    }
+
+ogc_api = FeaturesEndpoints(
     title=settings.name,
     with_tiles_viewer=settings.add_tiles_viewer,
+    stream_batch_size=settings.items_stream_batch_size if settings.items_streaming else 0,
+    keyset_pagination=settings.items_keyset_pagination,
+    projected_geometries=settings.tile_projected_geometries,
+    **endpoints_kwargs,
 )
 app.include_router(ogc_api.router)
 app.router.route_class = LoggerRouteHandler
 
+# Called with the ids of the collections which changed on each catalog refresh
+app.state.catalog_listeners = []
+
+if settings.tile_cache:
+    tile_cache = TileCache(
+        max_bytes=settings.tile_cache_max_bytes,
+        directory=settings.tile_cache_dir,
+        max_disk_bytes=settings.tile_cache_dir_max_bytes,
+    )
+    app.state.catalog_listeners.append(tile_cache.invalidate)
+    app.add_middleware(TileCacheMiddleware, cache=tile_cache)
+
+if settings.response_cache:
+    response_cache = ResponseCache(
+        max_entries=settings.response_cache_max_entries,
+        max_bytes=settings.response_cache_max_bytes,
+        ttl=settings.response_cache_ttl,
+        backend=(
+            load_cache_backend(settings.response_cache_backend)
+            if settings.response_cache_backend
+            else None
+        ),
+    )
+    app.state.catalog_listeners.append(response_cache.invalidate)
+    app.add_middleware(
+        ResponseCacheMiddleware,
+        cache=response_cache,
+        max_entry_bytes=settings.response_cache_max_entry_bytes,
+    )
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.cors_origins,
@@ -71,16 +197,59 @@ app.add_middleware(
     allow_methods=["GET"],
     allow_headers=[settings.cors_origins],
 )
-app.add_middleware(CacheControlMiddleware, cachecontrol=settings.cachecontrol)
-app.add_middleware(CompressionMiddleware)
 app.add_middleware(
-    CatalogUpdateMiddleware,
-    func=register_collection_catalog,
+    CacheControlMiddleware,
+    cachecontrol=settings.cachecontrol,
+    exclude_path={r".*/statistics$"},
+)
+app.add_middleware(
+    CompressionMiddleware,
+    encodings=settings.compression_encodings,
+    minimum_size=settings.compression_minimum_size,
+    levels=settings.compression_levels,
+)
+if settings.server_timing:
+    app.add_middleware(ServerTimingMiddleware)
+if settings.slow_query_budget is not None:
+    app.add_middleware(
+        SlowQueryMiddleware,
+        budget=settings.slow_query_budget / 1000,
+        sample_rate=settings.slow_query_sample_rate,
+        timeout=settings.slow_query_explain_timeout,
+        # on Lambda a task would be frozen with the invocation, holding the only
+        # connection of the pool: the plan is captured before the invocation returns
+        background="AWS_LAMBDA_FUNCTION_NAME" not in os.environ,
+    )
+# On Lambda a background refresh would be frozen with the invocation, holding the only
+# connection of the pool: the catalog is refreshed inline
+catalog_refresh = (
+    "inline" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else settings.catalog_refresh
+)
+app.add_middleware(
+    (
+        BackgroundCatalogUpdateMiddleware
+        if catalog_refresh == "background"
+        else CatalogUpdateMiddleware
+    ),
+    func=refresh_collection_catalog,
     ttl=settings.catalog_ttl,
     db_settings=db_settings,
+    lazy=settings.catalog_lazy,
+    extents=settings.catalog_extents,
 )
+if settings.latency_histograms:
+    # Outermost, to time the responses of the caches too
+    app.add_middleware(LatencyMiddleware, recorder=latency_recorder)
 
-add_exception_handlers(app, DEFAULT_STATUS_CODES)
+add_exception_handlers(
+    app,
+    {
+        **DEFAULT_STATUS_CODES,
+        InvalidPageToken: status.HTTP_422_UNPROCESSABLE_ENTITY,
+        UnsupportedParameter: status.HTTP_422_UNPROCESSABLE_ENTITY,
+        QueryStatisticsUnavailable: status.HTTP_503_SERVICE_UNAVAILABLE,
+    },
+)
 
 
 @app.get(
@@ -102,5 +271,27 @@ async def refresh(request: Request):
     await register_collection_catalog(
         request.app,
         db_settings=db_settings,
+        lazy=settings.catalog_lazy,
+        extents=settings.catalog_extents,
     )
     return request.app.state.collection_catalog
+
+
+if settings.query_statistics:
+
+    @app.get(
+        "/statistics",
+        description=(
+            "Query statistics (pg_stat_statements) of the collections by endpoint type: "
+            "calls, mean, max and total time (ms), rows and shared blocks hit/read."
+        ),
+        summary="Query statistics.",
+        operation_id="queryStatistics",
+        tags=["Statistics"],
+    )
+    async def statistics(request: Request):
+        """Query statistics of the collections."""
+        return await collection_statistics(
+            request.app.state.pool,
+            list(request.app.state.collection_catalog["collections"]),
+        )
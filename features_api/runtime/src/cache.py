@@ -0,0 +1,403 @@
+"""Server side response cache"""
+import abc
+import functools
+import hashlib
+import importlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+import orjson
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.catalog import collection_version
+from src.compression import VARIANTS_SCOPE_KEY, CompressedVariants
+from src.monitoring import logger
+
+# Cached routes: /collections, /collections/{id}, /collections/{id}/queryables,
+# /collections/{id}/items and /collections/{id}/items/{itemId}
+CACHEABLE_PATH = re.compile(
+    r"/collections(/(?P<collectionId>[^/]+)(/queryables|/items(/[^/]+)?)?)?/?"
+)
+
+
+def route_path(scope: Scope) -> str:
+    """Path of a request within the application, without its `root_path`."""
+    path, root_path = scope["path"], scope.get("root_path", "")
+    if root_path and (path == root_path or path.startswith(f"{root_path}/")):
+        return path[len(root_path) :]
+    return path
+
+
+@dataclass
+class CachedResponse:
+    """Response stored in the cache."""
+
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+    expires: float
+    # id of the collection the response belongs to, empty for collection lists
+    tag: str = ""
+    # compressed bodies, by encoding, only kept in the in-process tier
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+    def to_bytes(self) -> bytes:
+        """Serialize for a shared cache backend."""
+        meta = orjson.dumps(
+            {
+                "status": self.status,
+                "headers": [[k.decode("latin-1"), v.decode("latin-1")] for k, v in self.headers],
+                "etag": self.etag,
+                "expires": time.time() + self.expires - time.monotonic(),
+                "tag": self.tag,
+            }
+        )
+        return meta + b"\n" + self.body
+
+    @classmethod
+    def from_bytes(cls, content: bytes) -> "CachedResponse":
+        """Deserialize from a shared cache backend."""
+        meta, body = content.split(b"\n", 1)
+        values = orjson.loads(meta)
+        return cls(
+            status=values["status"],
+            headers=[(k.encode("latin-1"), v.encode("latin-1")) for k, v in values["headers"]],
+            body=body,
+            etag=values["etag"],
+            expires=time.monotonic() + values["expires"] - time.time(),
+            tag=values["tag"],
+        )
+
+    @property
+    def size(self) -> int:
+        """Approximate memory used by the response."""
+        return (
+            len(self.body)
+            + sum(len(k) + len(v) for k, v in self.headers)
+            + sum(len(v) for v in self.variants.values())
+        )
+
+
+class CacheBackend(metaclass=abc.ABCMeta):
+    """Shared cache tier (e.g. Redis or Memcached) used behind the in-process cache.
+
+    Entries are keyed with the version of the collection so stale entries are never
+    read back; backends only need to expire them after `ttl` seconds.
+    """
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return the value stored for a key."""
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        """Store a value for `ttl` seconds."""
+        ...
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process stand-in for a shared cache backend."""
+
+    def __init__(self) -> None:
+        """Init backend."""
+        self.values: Dict[str, Tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return the value stored for a key."""
+        if item := self.values.get(key):
+            expires, value = item
+            if expires > time.monotonic():
+                return value
+            del self.values[key]
+        return None
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        """Store a value for `ttl` seconds."""
+        self.values[key] = (time.monotonic() + ttl, value)
+
+
+def load_cache_backend(path: str) -> CacheBackend:
+    """Instantiate a cache backend from its `module:Class` path."""
+    module_name, _, class_name = path.partition(":")
+    backend = getattr(importlib.import_module(module_name), class_name)
+    return backend()
+
+
+class ResponseCache:
+    """In-process LRU cache, limited in entries and bytes, with an optional shared tier."""
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: int = 300,
+        backend: Optional[CacheBackend] = None,
+    ) -> None:
+        """Init cache."""
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self.entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.tags: Dict[str, Set[str]] = {}
+        self.size = 0
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """Return a cached response, looking in the shared tier after the local one."""
+        if response := self.entries.get(key):
+            if response.expires > time.monotonic():
+                self.entries.move_to_end(key)
+                return response
+            self._remove(key)
+
+        if self.backend:
+            try:
+                content = await self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Response cache backend failed: {e}")
+                return None
+
+            if content:
+                response = CachedResponse.from_bytes(content)
+                if response.expires > time.monotonic():
+                    self.put(key, response)
+                    return response
+
+        return None
+
+    async def set(self, key: str, response: CachedResponse) -> None:
+        """Store a response in both tiers."""
+        self.put(key, response)
+
+        if self.backend:
+            try:
+                await self.backend.set(key, response.to_bytes(), self.ttl)
+            except Exception as e:
+                logger.warning(f"Response cache backend failed: {e}")
+
+    def put(self, key: str, response: CachedResponse) -> None:
+        """Store a response in the in-process tier, evicting the least recently used ones."""
+        if response.size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = response
+        self.tags.setdefault(response.tag, set()).add(key)
+        self.size += response.size
+        self._evict()
+
+    def add_variant(
+        self, key: str, response: CachedResponse, encoding: str, body: bytes
+    ) -> None:
+        """Store a compressed body of a response still in the in-process tier."""
+        if self.entries.get(key) is not response or encoding in response.variants:
+            return
+
+        response.variants[encoding] = body
+        self.size += len(body)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def invalidate(self, collection_ids: Set[str]) -> None:
+        """Drop the in-process entries of collections, and the collection lists."""
+        for tag in {*collection_ids, ""}:
+            for key in self.tags.pop(tag, set()):
+                self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        response = self.entries.pop(key, None)
+        if response is None:
+            return
+
+        self.size -= response.size
+        if keys := self.tags.get(response.tag):
+            keys.discard(key)
+            if not keys:
+                del self.tags[response.tag]
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag of a response body."""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check an `If-None-Match` header against an ETag (weak comparison)."""
+    values = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return "*" in values or etag.removeprefix("W/") in values
+
+
+class ResponseCacheMiddleware:
+    """Middleware caching collection and item responses, with ETag and 304 support."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        cache: ResponseCache,
+        max_entry_bytes: int = 4 * 1024 * 1024,
+    ) -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            cache (ResponseCache): cache to store the responses in.
+            max_entry_bytes (int): larger responses are streamed through without being cached.
+
+        """
+        self.app = app
+        self.cache = cache
+        self.max_entry_bytes = max_entry_bytes
+
+    def cache_key(self, scope: Scope, collection_id: Optional[str]) -> str:
+        """Key a request with its normalized route, query parameters and catalog version."""
+        headers = Headers(scope=scope)
+        query = urlencode(
+            sorted(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+        )
+        key = "|".join(
+            [
+                # responses embed absolute links
+                scope.get("scheme", "http"),
+                headers.get("host", ""),
+                scope.get("root_path", ""),
+                scope["path"].rstrip("/"),
+                query,
+                # content negotiation
+                headers.get("accept", ""),
+                collection_version(scope["app"], collection_id),
+            ]
+        )
+        return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        matched = CACHEABLE_PATH.fullmatch(route_path(scope))
+        if not matched:
+            await self.app(scope, receive, send)
+            return
+
+        collection_id = matched.group("collectionId")
+        key = self.cache_key(scope, collection_id)
+        if_none_match = Headers(scope=scope).get("if-none-match")
+
+        if cached := await self.cache.get(key):
+            if if_none_match and etag_matches(if_none_match, cached.etag):
+                self.attach_variants(scope, key, cached)
+                await self.send_not_modified(send, cached.headers)
+            else:
+                self.attach_variants(scope, key, cached)
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": cached.status,
+                        "headers": list(cached.headers),
+                    }
+                )
+                await send({"type": "http.response.body", "body": cached.body})
+            return
+
+        start_message: Optional[Message] = None
+        chunks: List[bytes] = []
+        size = 0
+        passthrough = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, size, passthrough
+
+            if passthrough:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                if message["status"] != 200:
+                    passthrough = True
+                    await send(message)
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            chunks.append(body)
+            size += len(body)
+
+            if size > self.max_entry_bytes:
+                # Too large to be cached, stream what we have and the rest
+                passthrough = True
+                await send(start_message)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": b"".join(chunks),
+                        "more_body": message.get("more_body", False),
+                    }
+                )
+                return
+
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            etag = make_etag(body)
+            headers = MutableHeaders(scope=start_message)
+            headers["ETag"] = etag
+
+            cached = CachedResponse(
+                status=start_message["status"],
+                headers=list(start_message["headers"]),
+                body=body,
+                etag=etag,
+                expires=time.monotonic() + self.cache.ttl,
+                tag=collection_id or "",
+            )
+            await self.cache.set(key, cached)
+
+            self.attach_variants(scope, key, cached)
+            if if_none_match and etag_matches(if_none_match, etag):
+                await self.send_not_modified(send, start_message["headers"])
+                return
+
+            await send(start_message)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def attach_variants(self, scope: Scope, key: str, cached: CachedResponse) -> None:
+        """Hand a cached response and its compressed bodies to the compression middleware."""
+        scope[VARIANTS_SCOPE_KEY] = CompressedVariants(
+            cached.variants,
+            functools.partial(self.cache.add_variant, key, cached),
+            headers=cached.headers,
+            size=len(cached.body),
+        )
+
+    async def send_not_modified(self, send: Send, headers: List[Tuple[bytes, bytes]]):
+        """Send a 304 response with the validators and caching headers of the cached one."""
+        keep = {b"etag", b"cache-control", b"vary", b"content-location", b"expires"}
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [(k, v) for k, v in headers if k.lower() in keep],
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,636 @@
+"""Collection catalog management"""
+import asyncio
+import datetime
+import hashlib
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, TypedDict
+
+import orjson
+from asyncpg.exceptions import PostgresError
+from buildpg import asyncpg
+from tipg.collections import (
+    Catalog,
+    Collection,
+    PgCollection,
+    pg_get_collection_index,
+)
+from tipg.settings import DatabaseSettings, TableSettings
+
+from fastapi import FastAPI
+
+from src.monitoring import logger
+
+# One row per relation with a signature of its shape (columns, types, keys, comments),
+# a data version built from the relation file node and the pg_stat change counters and
+# the columns leading a btree index, plus a single row summarizing the set-returning
+# functions tipg could expose.
+CATALOG_FINGERPRINT_QUERY = """
+    SELECT
+        'Table' AS entity,
+        concat(n.nspname, '.', c.relname) AS id,
+        md5(concat_ws(
+            '|',
+            c.oid,
+            c.relkind,
+            obj_description(c.oid, 'pg_class'),
+            (
+                SELECT string_agg(
+                    concat_ws(':', i.indexrelid, i.indkey::text, i.indisprimary, i.indisunique),
+                    ',' ORDER BY i.indexrelid
+                )
+                FROM pg_index i
+                WHERE i.indrelid = c.oid
+            ),
+            string_agg(
+                concat_ws(':', a.attnum, a.attname, a.atttypid, a.atttypmod, col_description(c.oid, a.attnum)),
+                ',' ORDER BY a.attnum
+            )
+        )) AS signature,
+        concat_ws(':', c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del) AS version,
+        bool_or(format_type(a.atttypid, NULL) IN ('geometry', 'geography')) AS spatial,
+        (
+            SELECT array_agg(DISTINCT ia.attname::text ORDER BY ia.attname::text)
+            FROM pg_index i
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = ic.relam
+            JOIN pg_attribute ia ON ia.attrelid = c.oid AND ia.attnum = i.indkey[0]
+            WHERE i.indrelid = c.oid AND am.amname = 'btree' AND i.indpred IS NULL
+        ) AS sort_keys
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE
+        n.nspname = ANY(:schemas)
+        AND c.relkind IN ('r', 'v', 'm', 'f', 'p')
+        AND has_table_privilege(c.oid, 'SELECT')
+        AND c.relname NOT IN ('spatial_ref_sys', 'geometry_columns', 'geography_columns')
+    GROUP BY n.nspname, c.relname, c.oid, c.relkind, c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del
+
+    UNION ALL
+
+    SELECT
+        'Function' AS entity,
+        NULL AS id,
+        md5(coalesce(string_agg(
+            concat_ws(':', p.oid, p.proname, p.proargnames::text, p.proargtypes::text, p.prorettype, md5(p.prosrc)),
+            ',' ORDER BY p.oid
+        ), '')) AS signature,
+        NULL AS version,
+        NULL AS spatial,
+        NULL AS sort_keys
+    FROM pg_proc p
+    JOIN pg_namespace n ON n.oid = p.pronamespace
+    WHERE
+        n.nspname = ANY(:schemas)
+        AND p.proretset
+        AND p.prokind = 'f';
+"""
+
+
+# Extents maintained by the functions of the `features_api` schema, created by the
+# database bootstrap (features_api_database)
+EXTENTS_QUERY = """
+    SELECT
+        concat(table_schema, '.', table_name) AS id,
+        column_name,
+        bounds,
+        to_json(mindt) #>> '{}' AS mindt,
+        to_json(maxdt) #>> '{}' AS maxdt
+    FROM features_api.extents;
+"""
+
+# collection id -> column name -> (bounds, mindt, maxdt)
+Extents = Dict[str, Dict[str, Tuple[Optional[List[float]], Optional[str], Optional[str]]]]
+
+# Bump when the layout of the snapshot file changes
+CATALOG_SNAPSHOT_VERSION = 2
+
+
+class CatalogFingerprint(TypedDict):
+    """Cheap summary of the database objects backing the catalog."""
+
+    # collection id -> signature of the table definition
+    tables: Dict[str, str]
+    # collection id -> data version (file node and row change counters)
+    versions: Dict[str, str]
+    # collection ids with at least one geometry/geography column
+    spatial: List[str]
+    # collection id -> columns leading a btree index, which keyset pagination can seek
+    sort_keys: Dict[str, List[str]]
+    # signature of all the functions in the catalog schemas
+    functions: str
+
+
+async def get_catalog_fingerprint(
+    db_pool: asyncpg.BuildPgPool,
+    db_settings: Optional[DatabaseSettings] = None,
+) -> CatalogFingerprint:
+    """Fetch the catalog fingerprint, without describing any table."""
+    db_settings = db_settings or DatabaseSettings()
+
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch_b(
+            CATALOG_FINGERPRINT_QUERY,
+            schemas=db_settings.schemas or ["public"],
+        )
+
+    fingerprint = CatalogFingerprint(
+        tables={}, versions={}, spatial=[], sort_keys={}, functions=""
+    )
+    for row in rows:
+        if row["entity"] == "Function":
+            fingerprint["functions"] = row["signature"]
+            continue
+
+        fingerprint["tables"][row["id"]] = row["signature"]
+        fingerprint["versions"][row["id"]] = row["version"]
+        if row["spatial"]:
+            fingerprint["spatial"].append(row["id"])
+        if row["sort_keys"]:
+            fingerprint["sort_keys"][row["id"]] = list(row["sort_keys"])
+
+    return fingerprint
+
+
+async def get_extents(db_pool: asyncpg.BuildPgPool) -> Extents:
+    """Fetch the stored extents of all the tables."""
+    try:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch(EXTENTS_QUERY)
+    except PostgresError as e:
+        logger.warning(f"Could not read the collection extents: {e}")
+        return {}
+
+    extents: Extents = {}
+    for row in rows:
+        extents.setdefault(row["id"], {})[row["column_name"]] = (
+            list(row["bounds"]) if row["bounds"] else None,
+            row["mindt"],
+            row["maxdt"],
+        )
+
+    return extents
+
+
+def apply_extents(collections: Iterable[Collection], extents: Extents) -> None:
+    """Set the stored extents on the geometry and datetime columns of the collections."""
+    for collection in collections:
+        columns = extents.get(collection.id)
+        if not columns or collection.type != "Table":
+            continue
+
+        for column in [*collection.table_columns, *collection.properties]:
+            if column.name not in columns:
+                continue
+
+            bounds, mindt, maxdt = columns[column.name]
+            if column.is_geometry and bounds:
+                column.bounds = bounds
+            elif column.is_datetime:
+                column.mindt, column.maxdt = mindt, maxdt
+
+
+def diff_fingerprints(
+    previous: CatalogFingerprint,
+    current: CatalogFingerprint,
+    data: bool = False,
+) -> Tuple[Set[str], Set[str]]:
+    """Return the (changed, removed) collection ids between two fingerprints.
+
+    When `data` is set, tables whose rows changed are reported as changed as well.
+    """
+    changed = {
+        table_id
+        for table_id, signature in current["tables"].items()
+        if previous["tables"].get(table_id) != signature
+    }
+    if data:
+        changed |= {
+            table_id
+            for table_id, version in current["versions"].items()
+            if previous["versions"].get(table_id) != version
+        }
+
+    removed = set(previous["tables"]) - set(current["tables"])
+
+    return changed, removed
+
+
+async def get_collection_index(
+    db_pool: asyncpg.BuildPgPool,
+    db_settings: Optional[DatabaseSettings] = None,
+    tables: Optional[List[str]] = None,
+    functions: bool = True,
+) -> List[Collection]:
+    """Describe the collections, optionally restricted to a list of tables."""
+    db_settings = db_settings or DatabaseSettings()
+
+    update: Dict = {}
+    if tables is not None:
+        update["tables"] = [
+            table
+            for table in tables
+            if db_settings.tables is None or table in db_settings.tables
+        ]
+    if not functions:
+        update["functions"] = []
+
+    if update:
+        db_settings = db_settings.model_copy(update=update)
+
+    return await pg_get_collection_index(db_pool, settings=db_settings)
+
+
+def fingerprint_digest(fingerprint: CatalogFingerprint) -> str:
+    """Short digest of a whole fingerprint."""
+    return hashlib.md5(
+        orjson.dumps(fingerprint, option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+
+
+def collection_version(app: FastAPI, collection_id: Optional[str] = None) -> str:
+    """Version of a collection, or of the whole catalog, as of the last refresh.
+
+    It changes when the definition or the rows of the collection's table change.
+    """
+    fingerprint: Optional[CatalogFingerprint] = getattr(
+        app.state, "catalog_fingerprint", None
+    )
+    if not fingerprint:
+        return ""
+
+    if collection_id is None:
+        return fingerprint_digest(fingerprint)
+
+    if collection_id in fingerprint["tables"]:
+        return (
+            fingerprint["tables"][collection_id]
+            + ":"
+            + (fingerprint["versions"].get(collection_id) or "")
+        )
+
+    return fingerprint["functions"]
+
+
+def collection_sort_keys(app: FastAPI, collection_id: str) -> List[str]:
+    """Columns of a collection leading a btree index, as of the last refresh."""
+    fingerprint: Optional[CatalogFingerprint] = getattr(
+        app.state, "catalog_fingerprint", None
+    )
+    if not fingerprint:
+        return []
+
+    return fingerprint["sort_keys"].get(collection_id, [])
+
+
+def notify_catalog_change(app: FastAPI, collection_ids: Set[str]) -> None:
+    """Call the `app.state.catalog_listeners` with the ids of the collections which changed."""
+    for listener in getattr(app.state, "catalog_listeners", []):
+        listener(collection_ids)
+
+
+def _placeholder_collections(
+    fingerprint: CatalogFingerprint,
+    db_settings: DatabaseSettings,
+    collection_ids: Optional[Set[str]] = None,
+) -> Dict[str, Collection]:
+    """Undescribed collections for the tables of a lazy catalog."""
+    if collection_ids is None:
+        collection_ids = set(fingerprint["tables"])
+
+    if db_settings.only_spatial_tables:
+        collection_ids = collection_ids & set(fingerprint["spatial"])
+
+    collections: Dict[str, Collection] = {}
+    for collection_id in sorted(collection_ids):
+        if collection_id not in fingerprint["tables"]:
+            continue
+
+        if db_settings.tables is not None and collection_id not in db_settings.tables:
+            continue
+
+        if db_settings.exclude_tables and collection_id in db_settings.exclude_tables:
+            continue
+
+        schema, table = collection_id.split(".", 1)
+        if db_settings.exclude_table_schemas and schema in db_settings.exclude_table_schemas:
+            continue
+
+        collections[collection_id] = PgCollection(
+            type="Table",
+            id=collection_id,
+            table=table,
+            schema=schema,
+        )
+
+    return collections
+
+
+async def register_collection_catalog(
+    app: FastAPI,
+    db_settings: Optional[DatabaseSettings] = None,
+    lazy: bool = False,
+    extents: bool = False,
+) -> Set[str]:
+    """Register the catalog and its fingerprint.
+
+    Every collection is described, unless `lazy` is set: the tables are then only
+    listed and get described by `describe_collections` when they are requested.
+    With `extents`, the collection extents are read from the extents store.
+    """
+    db_settings = db_settings or DatabaseSettings()
+
+    # Take the fingerprint first so a change happening during the introspection
+    # is picked up by the next refresh
+    fingerprint = await get_catalog_fingerprint(app.state.pool, db_settings)
+
+    if lazy:
+        functions = await get_collection_index(app.state.pool, db_settings, tables=[])
+        collections = {
+            **_placeholder_collections(fingerprint, db_settings),
+            **{col.id: col for col in functions},
+        }
+        app.state.catalog_described = {
+            col.id: time.monotonic() for col in functions
+        }
+        app.state.catalog_lock = asyncio.Lock()
+
+    else:
+        collections = {
+            col.id: col
+            for col in await get_collection_index(app.state.pool, db_settings)
+        }
+
+    if extents:
+        app.state.catalog_extents = await get_extents(app.state.pool)
+        apply_extents(collections.values(), app.state.catalog_extents)
+
+    previous: Optional[Catalog] = getattr(app.state, "collection_catalog", None)
+
+    app.state.collection_catalog = Catalog(
+        collections=collections,
+        last_updated=datetime.datetime.now(),
+    )
+    app.state.catalog_fingerprint = fingerprint
+
+    if previous:
+        notify_catalog_change(app, set(previous["collections"]) | set(collections))
+
+    return set(collections)
+
+
+async def refresh_collection_catalog(
+    app: FastAPI,
+    db_settings: Optional[DatabaseSettings] = None,
+    lazy: bool = False,
+    extents: bool = False,
+) -> Set[str]:
+    """Refresh the catalog, only describing the collections which changed.
+
+    In a `lazy` catalog the changed tables are reset to undescribed collections.
+    With `extents`, the stored extents of every collection are read again.
+    Returns the ids of the collections which were added, updated or removed.
+    """
+    db_settings = db_settings or DatabaseSettings()
+
+    catalog: Optional[Catalog] = getattr(app.state, "collection_catalog", None)
+    previous: Optional[CatalogFingerprint] = getattr(
+        app.state, "catalog_fingerprint", None
+    )
+    if not catalog or not previous:
+        return await register_collection_catalog(
+            app, db_settings, lazy=lazy, extents=extents
+        )
+
+    fingerprint = await get_catalog_fingerprint(app.state.pool, db_settings)
+
+    # Extents are computed from the data, so data changes need a new description too
+    changed, removed = diff_fingerprints(
+        previous,
+        fingerprint,
+        data=db_settings.spatial_extent or db_settings.datetime_extent,
+    )
+    functions_changed = previous["functions"] != fingerprint["functions"]
+
+    collections = dict(catalog["collections"])
+    for collection_id in removed | changed:
+        collections.pop(collection_id, None)
+
+    if changed or functions_changed:
+        logger.info(
+            f"Refreshing {len(changed)} table(s) in the catalog"
+            + (" and the functions" if functions_changed else "")
+        )
+        updated: List[Collection] = []
+        if functions_changed or not lazy:
+            updated = await get_collection_index(
+                app.state.pool,
+                db_settings,
+                tables=[] if lazy else sorted(changed),
+                functions=functions_changed,
+            )
+
+        if functions_changed:
+            for collection_id, collection in list(collections.items()):
+                if collection.type == "Function":
+                    collections.pop(collection_id)
+                    changed.add(collection_id)
+
+        if lazy:
+            collections.update(
+                _placeholder_collections(fingerprint, db_settings, changed)
+            )
+            described = app.state.catalog_described
+            for collection_id in changed | removed:
+                described.pop(collection_id, None)
+            described.update({col.id: time.monotonic() for col in updated})
+
+        collections.update({col.id: col for col in updated})
+        changed |= {col.id for col in updated}
+
+    # The stored extents follow the rows, not the table definitions
+    if extents:
+        app.state.catalog_extents = await get_extents(app.state.pool)
+        apply_extents(collections.values(), app.state.catalog_extents)
+
+    # Swap the whole catalog at once so requests never see a partial update
+    app.state.collection_catalog = Catalog(
+        collections=collections,
+        last_updated=datetime.datetime.now(),
+    )
+    app.state.catalog_fingerprint = fingerprint
+
+    # Cached responses also depend on the rows, whatever the catalog needed
+    data_changed, _ = diff_fingerprints(previous, fingerprint, data=True)
+    if changed or removed or data_changed:
+        notify_catalog_change(app, changed | removed | data_changed)
+
+    return changed | removed
+
+
+async def describe_collections(
+    app: FastAPI,
+    collection_ids: List[str],
+    db_settings: Optional[DatabaseSettings] = None,
+    ttl: int = 300,
+) -> None:
+    """Describe the tables of a lazy catalog which were never described or expired."""
+    db_settings = db_settings or DatabaseSettings()
+
+    def pending() -> List[str]:
+        catalog: Catalog = app.state.collection_catalog
+        described: Dict[str, float] = app.state.catalog_described
+        now = time.monotonic()
+        return [
+            collection_id
+            for collection_id in collection_ids
+            if collection_id in catalog["collections"]
+            and catalog["collections"][collection_id].type == "Table"
+            and now - described.get(collection_id, -ttl - 1) > ttl
+        ]
+
+    if not pending():
+        return
+
+    async with app.state.catalog_lock:
+        # Another request might have described them while we were waiting
+        tables = pending()
+        if not tables:
+            return
+
+        collections = await get_collection_index(
+            app.state.pool, db_settings, tables=tables, functions=False
+        )
+
+        catalog: Catalog = app.state.collection_catalog
+        updated = dict(catalog["collections"])
+        for collection_id in tables:
+            # Tables which are not returned were dropped or are not spatial anymore
+            updated.pop(collection_id, None)
+
+        apply_extents(collections, getattr(app.state, "catalog_extents", {}))
+
+        now = time.monotonic()
+        for col in collections:
+            updated[col.id] = col
+            app.state.catalog_described[col.id] = now
+
+        app.state.collection_catalog = Catalog(
+            collections=updated,
+            last_updated=catalog["last_updated"],
+        )
+
+
+def _snapshot_settings(db_settings: DatabaseSettings) -> Dict[str, Any]:
+    """Settings which change how the collections are described."""
+    settings = {
+        "database": db_settings.model_dump(mode="json"),
+        "tables": TableSettings().model_dump(mode="json"),
+    }
+    # Round trip through JSON so it compares equal to what was read from a file
+    return orjson.loads(orjson.dumps(settings, option=orjson.OPT_SORT_KEYS))
+
+
+def dump_catalog_snapshot(
+    catalog: Catalog,
+    fingerprint: CatalogFingerprint,
+    db_settings: DatabaseSettings,
+) -> bytes:
+    """Serialize a catalog and the fingerprint it was built from."""
+    return orjson.dumps(
+        {
+            "version": CATALOG_SNAPSHOT_VERSION,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "settings": _snapshot_settings(db_settings),
+            "fingerprint": fingerprint,
+            "collections": [
+                collection.model_dump(mode="json", by_alias=True)
+                for collection in catalog["collections"].values()
+            ],
+        }
+    )
+
+
+def load_catalog_snapshot(
+    content: bytes,
+    db_settings: DatabaseSettings,
+) -> Tuple[Catalog, CatalogFingerprint]:
+    """Deserialize a catalog snapshot.
+
+    Raises `ValueError` when the snapshot was written with another format
+    or with settings that would describe the collections differently.
+    """
+    snapshot = orjson.loads(content)
+
+    if snapshot.get("version") != CATALOG_SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported catalog snapshot version {snapshot.get('version')}")
+
+    if snapshot.get("settings") != _snapshot_settings(db_settings):
+        raise ValueError("Catalog snapshot was built with different settings")
+
+    collections = [
+        PgCollection.model_validate(collection)
+        for collection in snapshot["collections"]
+    ]
+    catalog = Catalog(
+        collections={col.id: col for col in collections},
+        last_updated=datetime.datetime.fromisoformat(snapshot["created"]),
+    )
+
+    return catalog, CatalogFingerprint(**snapshot["fingerprint"])
+
+
+def read_catalog_snapshot(
+    path: str, db_settings: DatabaseSettings
+) -> Optional[Tuple[Catalog, CatalogFingerprint]]:
+    """Read a catalog snapshot file, None when it is missing or can not be used."""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            return load_catalog_snapshot(f.read(), db_settings)
+
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        logger.warning(f"Could not load catalog snapshot {path}: {e}")
+        return None
+
+
+async def load_collection_catalog(
+    app: FastAPI,
+    db_settings: Optional[DatabaseSettings] = None,
+    snapshot: Optional[Tuple[Catalog, CatalogFingerprint]] = None,
+    lazy: bool = False,
+    extents: bool = False,
+) -> Set[str]:
+    """Register the catalog, starting from a snapshot (`read_catalog_snapshot`) when there is one.
+
+    The snapshot is checked against the current fingerprint and only the collections
+    which changed since it was built are described.
+    """
+    db_settings = db_settings or DatabaseSettings()
+
+    if snapshot is not None:
+        catalog, fingerprint = snapshot
+        app.state.collection_catalog = catalog
+        app.state.catalog_fingerprint = fingerprint
+        if lazy:
+            app.state.catalog_described = {
+                collection_id: time.monotonic()
+                for collection_id in catalog["collections"]
+            }
+            app.state.catalog_lock = asyncio.Lock()
+
+        changed = await refresh_collection_catalog(
+            app, db_settings, lazy=lazy, extents=extents
+        )
+        logger.info(
+            f"Loaded catalog snapshot, {len(changed)} collection(s) changed since"
+        )
+        return changed
+
+    return await register_collection_catalog(
+        app, db_settings, lazy=lazy, extents=extents
+    )
@@ -0,0 +1,231 @@
+"""Response compression"""
+import re
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import cramjam
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.monitoring import add_timing
+
+# cramjam module of each content coding
+CODECS = {
+    "br": cramjam.brotli,
+    "zstd": cramjam.zstd,
+    "gzip": cramjam.gzip,
+}
+
+# Level of each encoding, per media type ("*" for the others). Cached responses are
+# compressed once, the others on every request: levels favour speed over ratio.
+DEFAULT_LEVELS: Dict[str, Dict[str, int]] = {
+    "*": {"br": 4, "zstd": 3, "gzip": 6},
+    "application/vnd.mapbox-vector-tile": {"br": 5, "zstd": 6, "gzip": 6},
+}
+
+# Already compressed
+DEFAULT_EXCLUDED_MEDIA_TYPES = {"application/vnd.apache.parquet"}
+
+# Scope key under which a cache middleware hands the compressed variants of the response
+# it sends
+VARIANTS_SCOPE_KEY = "compressed_variants"
+
+ACCEPT_ENCODING = re.compile(r"^\s*(?P<coding>[\w*-]+)\s*(;\s*q\s*=\s*(?P<q>[0-9.]+))?")
+
+
+class CompressedVariants(NamedTuple):
+    """Compressed bodies of a cached response, by encoding, and how to store a new one.
+
+    A cache answering with a 304 also hands the headers and body size of the response
+    it revalidates.
+    """
+
+    bodies: Dict[str, bytes]
+    store: Callable[[str, bytes], None]
+    headers: Optional[List[Tuple[bytes, bytes]]] = None
+    size: int = 0
+
+
+def select_encoding(accept_encoding: str, encodings: Sequence[str]) -> Optional[str]:
+    """Preferred encoding of a request among `encodings`, None for identity.
+
+    The client's quality values come first, the order of `encodings` breaks the ties.
+    """
+    qualities: Dict[str, float] = {}
+    for value in accept_encoding.lower().split(","):
+        matched = ACCEPT_ENCODING.match(value)
+        if not matched:
+            continue
+        try:
+            qualities[matched.group("coding")] = float(matched.group("q") or 1.0)
+        except ValueError:
+            continue
+
+    wildcard = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def weak_etag(etag: str) -> str:
+    """Weak version of an ETag: the compressed bodies are not byte-identical."""
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """Middleware compressing the responses with brotli, zstd or gzip.
+
+    Bodies smaller than `minimum_size` and already compressed media types are sent as
+    is. Streamed responses are compressed chunk by chunk. Responses coming from a cache
+    middleware are compressed once per encoding: their variants are stored with them.
+    A 304 sent by a cache middleware carries the weak ETag and `Vary` header of the
+    response it revalidates when that response is compressed.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        encodings: Sequence[str] = ("br", "zstd", "gzip"),
+        minimum_size: int = 1024,
+        levels: Optional[Dict[str, Dict[str, int]]] = None,
+        exclude_mediatype: Optional[Set[str]] = None,
+    ) -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            encodings (list): supported encodings, by order of preference.
+            minimum_size (int): smaller bodies are not compressed.
+            levels (dict): level of each encoding, per media type ("*" for the others).
+            exclude_mediatype (set): media types sent uncompressed.
+
+        """
+        self.app = app
+        self.encodings = [e for e in encodings if e in CODECS]
+        self.minimum_size = minimum_size
+        self.levels = levels if levels is not None else DEFAULT_LEVELS
+        self.exclude_mediatype = (
+            exclude_mediatype
+            if exclude_mediatype is not None
+            else DEFAULT_EXCLUDED_MEDIA_TYPES
+        )
+
+    def compressible(self, headers: Headers, size: Optional[int]) -> bool:
+        """Whether a response is compressed, `size` being None for a streamed body."""
+        media_type = headers.get("content-type", "").split(";")[0].strip()
+        return not (
+            "content-encoding" in headers
+            or media_type in self.exclude_mediatype
+            or (size is not None and size < self.minimum_size)
+        )
+
+    def level(self, media_type: str, encoding: str) -> Optional[int]:
+        """Compression level of a media type, None for the codec default."""
+        levels = self.levels.get(media_type) or self.levels.get("*") or {}
+        return levels.get(encoding)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = select_encoding(
+            Headers(scope=scope).get("accept-encoding", ""), self.encodings
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        codec = CODECS[encoding]
+        start_message: Optional[Message] = None
+        compressor = None
+        passthrough = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, compressor, passthrough
+
+            if message["type"] == "http.response.start":
+                if message["status"] == 304:
+                    passthrough = True
+                    variants: Optional[CompressedVariants] = scope.get(VARIANTS_SCOPE_KEY)
+                    if (
+                        variants is not None
+                        and variants.headers is not None
+                        and self.compressible(Headers(raw=variants.headers), variants.size)
+                    ):
+                        # Same validators as the compressed response it revalidates
+                        headers = MutableHeaders(scope=message)
+                        headers.add_vary_header("Accept-Encoding")
+                        if etag := headers.get("etag"):
+                            headers["ETag"] = weak_etag(etag)
+                    await send(message)
+                    return
+
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is not None:
+                # Rest of a streamed response
+                start = time.perf_counter()
+                compressor.compress(body)
+                chunk = compressor.flush() if more_body else compressor.finish()
+                add_timing("compression", time.perf_counter() - start)
+                await send({**message, "body": bytes(chunk)})
+                return
+
+            headers = MutableHeaders(scope=start_message)
+            media_type = headers.get("content-type", "").split(";")[0].strip()
+            if not self.compressible(headers, None if more_body else len(body)):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            headers["Content-Encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            if etag := headers.get("etag"):
+                headers["ETag"] = weak_etag(etag)
+
+            level = self.level(media_type, encoding)
+            start = time.perf_counter()
+            if more_body:
+                # Streamed response: no Content-Length, each chunk is flushed
+                del headers["Content-Length"]
+                compressor = (
+                    codec.Compressor(level) if level is not None else codec.Compressor()
+                )
+                compressor.compress(body)
+                body = bytes(compressor.flush())
+
+            else:
+                variants = scope.get(VARIANTS_SCOPE_KEY)
+                compressed = variants.bodies.get(encoding) if variants else None
+                if compressed is None:
+                    compressed = bytes(
+                        codec.compress(body, level=level)
+                        if level is not None
+                        else codec.compress(body)
+                    )
+                    if variants:
+                        variants.store(encoding, compressed)
+                body = compressed
+                headers["Content-Length"] = str(len(body))
+
+            add_timing("compression", time.perf_counter() - start)
+            await send(start_message)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -3,9 +3,8 @@
 import base64
 import json
 from functools import lru_cache
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 
-import boto3
 from pydantic_settings import BaseSettings
 
 
@@ -21,6 +20,9 @@ def get_secret_dict(secret_name: str):
         secrets (dict): decrypted secrets in dict
     """
 
+    # boto3 takes a while to import, and is only needed with a secret
+    import boto3
+
     # Create a Secrets Manager client
     session = boto3.session.Session()
     client = session.client(service_name="secretsmanager")
@@ -46,6 +48,80 @@ class FeaturesAPISettings(BaseSettings):
     stage: str = ""
 
     catalog_ttl: int = 300  # seconds
+    # path of a catalog snapshot built with `python -m src.snapshot`
+    catalog_snapshot: Optional[str] = None
+    # only list the tables at startup and describe them when first requested
+    catalog_lazy: bool = False
+    # refresh the expired catalog after the response ("inline") or in a background task
+    # (servers only: always inline on Lambda)
+    catalog_refresh: Literal["inline", "background"] = "inline"
+    # read the collection extents from the `features_api.extents` table maintained in
+    # the database, instead of advertising none
+    catalog_extents: bool = True
+
+    # in-process cache of collection and item responses
+    response_cache: bool = True
+    response_cache_ttl: int = 300  # seconds
+    response_cache_max_entries: int = 1000
+    response_cache_max_bytes: int = 64 * 1024 * 1024
+    # larger responses are not cached
+    response_cache_max_entry_bytes: int = 4 * 1024 * 1024
+    # `module:Class` path of a src.cache.CacheBackend used as a shared tier
+    response_cache_backend: Optional[str] = None
+
+    # stream GeoJSON, GeoJSONSeq and NDJSON items from a server-side cursor
+    items_streaming: bool = False
+    # rows read from the cursor at a time
+    items_stream_batch_size: int = 1000
+
+    # page the items with a token of the last sort key instead of an offset, when
+    # sorted by the primary key or by a single column leading a btree index
+    items_keyset_pagination: bool = False
+
+    # per route and status class latency histograms, logged as EMF (at INFO level)
+    latency_histograms: bool = True
+    # seconds between two writes of the histograms outside of Lambda
+    latency_flush_interval: int = 60
+    # collections with their own latency histograms: each one adds a CloudWatch metric
+    # per route and status class
+    latency_collections: List[str] = []
+
+    # time the request stages, returned in a Server-Timing header and as metrics
+    server_timing: bool = False
+
+    # count the items and tile requests taking more than `slow_query_budget` ms, and log
+    # the EXPLAIN ANALYZE plan of their slowest query for a `slow_query_sample_rate`
+    # fraction of them, re-run once the response is sent (in a background task, or on
+    # Lambda before the invocation returns); disabled when unset
+    slow_query_budget: Optional[int] = None
+    slow_query_sample_rate: float = 0.1
+    # seconds the re-run query is allowed to take
+    slow_query_explain_timeout: float = 10.0
+
+    # expose the pg_stat_statements statistics of the collections (normalized SQL timings)
+    # at `/statistics`, without authentication: only enable it on private deployments
+    query_statistics: bool = False
+
+    # response compression: encodings by order of preference, smallest body compressed,
+    # and level of each encoding per media type ("*" for the others, see src.compression)
+    compression_encodings: List[str] = ["br", "zstd", "gzip"]
+    compression_minimum_size: int = 1024
+    compression_levels: Optional[Dict[str, Dict[str, int]]] = None
+
+    tile_cache: bool = True
+    tile_cache_max_bytes: int = 128 * 1024 * 1024
+    # directory of the filesystem tier, e.g. /tmp/tiles on Lambda
+    tile_cache_dir: Optional[str] = None
+    tile_cache_dir_max_bytes: int = 256 * 1024 * 1024
+    # render tiles from the `{geom}_{srid}` geometry columns in the TileMatrixSet CRS
+    tile_projected_geometries: bool = True
+
+    # database pool: a single connection checked when reused after `db_health_check_idle`
+    # seconds ("lambda"), or the tipg pool settings ("server"); "lambda" on AWS Lambda by
+    # default
+    db_pool_profile: Optional[Literal["lambda", "server"]] = None
+    db_health_check_idle: float = 30.0
+    db_health_check_timeout: float = 2.0
 
     postgis_secret_arn: Optional[str] = None
 
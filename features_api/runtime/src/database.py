@@ -0,0 +1,174 @@
+"""Database connection pool"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional
+
+from buildpg import asyncpg
+from tipg.database import connection_factory
+from tipg.settings import PostgresSettings
+
+from fastapi import FastAPI
+
+from src.monitoring import record_pool_acquire
+
+# Errors of a connection which went stale, e.g. closed by RDS Proxy while the Lambda
+# container was frozen
+STALE_CONNECTION_ERRORS = (
+    asyncpg.PostgresError,
+    asyncpg.InterfaceError,
+    OSError,
+    asyncio.TimeoutError,
+)
+
+
+class PoolProfile(NamedTuple):
+    """Pool sizing and connection reuse policy."""
+
+    min_size: int
+    max_size: int
+    max_queries: int
+    # seconds after which idle connections are closed (0: never)
+    max_inactive_connection_lifetime: float
+    # seconds a connection can stay idle before being checked when acquired (None: never)
+    health_check_idle: Optional[float] = None
+    health_check_timeout: float = 2.0
+
+
+def default_pool_profile() -> str:
+    """`lambda` in a Lambda function, `server` otherwise."""
+    return "lambda" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "server"
+
+
+def pool_profile(
+    name: str,
+    settings: PostgresSettings,
+    health_check_idle: Optional[float] = None,
+    health_check_timeout: float = 2.0,
+) -> PoolProfile:
+    """Pool profile of a deployment.
+
+    A Lambda container handles one request at a time: it gets a single connection,
+    opened during init and kept across invocations, checked when reused after being idle.
+    Servers (containers) use the tipg pool settings.
+    """
+    if name == "lambda":
+        return PoolProfile(
+            min_size=1,
+            max_size=1,
+            max_queries=settings.db_max_queries,
+            # idle timers do not run while the container is frozen
+            max_inactive_connection_lifetime=0,
+            health_check_idle=health_check_idle,
+            health_check_timeout=health_check_timeout,
+        )
+
+    return PoolProfile(
+        min_size=settings.db_min_conn_size,
+        max_size=settings.db_max_conn_size,
+        max_queries=settings.db_max_queries,
+        max_inactive_connection_lifetime=settings.db_max_inactive_conn_lifetime,
+    )
+
+
+class ManagedPool:
+    """asyncpg pool proxy checking idle connections before reusing them.
+
+    Records the acquisition wait, the age of the acquired connection and the reconnections
+    of stale connections.
+    """
+
+    def __init__(self, profile: PoolProfile) -> None:
+        """Init proxy."""
+        self.profile = profile
+        self._pool: Any = None
+        # monotonic time a connection was opened and last released, by server pid
+        self.opened: Dict[int, float] = {}
+        self.released: Dict[int, float] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        """Forward to the pool."""
+        return getattr(self._pool, name)
+
+    async def connect(self, dsn: str, init: Any) -> None:
+        """Create the pool, opening its first `min_size` connections."""
+
+        async def init_connection(conn: Any) -> None:
+            await init(conn)
+            pid = conn.get_server_pid()
+            self.opened[pid] = time.monotonic()
+            conn.add_termination_listener(lambda _: self._forget(pid))
+
+        self._pool = await asyncpg.create_pool_b(
+            dsn,
+            min_size=self.profile.min_size,
+            max_size=self.profile.max_size,
+            max_queries=self.profile.max_queries,
+            max_inactive_connection_lifetime=self.profile.max_inactive_connection_lifetime,
+            init=init_connection,
+        )
+
+    def _forget(self, pid: int) -> None:
+        self.opened.pop(pid, None)
+        self.released.pop(pid, None)
+
+    async def is_healthy(self, conn: Any) -> bool:
+        """Whether a connection still answers, when it was idle for a while."""
+        idle = self.profile.health_check_idle
+        released = self.released.get(conn.get_server_pid())
+        if idle is None or released is None or time.monotonic() - released < idle:
+            return True
+
+        try:
+            await conn.execute("SELECT 1", timeout=self.profile.health_check_timeout)
+        except STALE_CONNECTION_ERRORS:
+            return False
+        return True
+
+    @asynccontextmanager
+    async def acquire(self, *args, **kwargs) -> AsyncIterator[Any]:
+        """Acquire a healthy connection, reconnecting a stale one."""
+        start = time.perf_counter()
+        conn = await self._pool.acquire(*args, **kwargs)
+        reconnects = 0
+        try:
+            if not await self.is_healthy(conn):
+                # The pool opens a new connection in place of the terminated one
+                conn.terminate()
+                await self._pool.release(conn)
+                conn = None
+                conn = await self._pool.acquire(*args, **kwargs)
+                reconnects = 1
+
+            pid = conn.get_server_pid()
+            opened = self.opened.get(pid)
+            record_pool_acquire(
+                wait=time.perf_counter() - start,
+                age=time.monotonic() - opened if opened is not None else None,
+                reconnects=reconnects,
+            )
+            yield conn
+
+        finally:
+            if conn is not None:
+                if not conn.is_closed():
+                    self.released[conn.get_server_pid()] = time.monotonic()
+                # The pool also takes back closed connections, replacing them
+                await self._pool.release(conn)
+
+
+async def connect_to_db(
+    app: FastAPI,
+    *,
+    schemas: List[str],
+    settings: PostgresSettings,
+    profile: PoolProfile,
+    tipg_schema: str = "pg_temp",
+) -> None:
+    """Connect with a pool profile, like `tipg.database.connect_to_db`."""
+    pool = ManagedPool(profile)
+    await pool.connect(
+        str(settings.database_url), connection_factory(schemas, tipg_schema)
+    )
+    app.state.pool = pool
@@ -0,0 +1,121 @@
+"""Lazy catalog dependencies"""
+from typing import Annotated, Callable, List, Literal, Optional
+
+from tipg.collections import Catalog, Collection, CollectionList
+from tipg.dependencies import CollectionParams, CollectionsParams, bbox_query, datetime_query
+from tipg.settings import DatabaseSettings
+
+from fastapi import Depends, Path, Query
+from starlette.requests import Request
+
+from src.catalog import describe_collections
+from src.features import GeometryOptions, zoom_precision, zoom_tolerance
+
+
+def lazy_collection_dependency(
+    db_settings: DatabaseSettings,
+    ttl: int,
+) -> Callable[..., Collection]:
+    """Collection dependency describing the collection the first time it is requested."""
+
+    async def collection_dependency(
+        request: Request,
+        collectionId: Annotated[str, Path(description="Collection identifier")],
+    ) -> Collection:
+        """Return Layer Object."""
+        await describe_collections(
+            request.app, [collectionId], db_settings=db_settings, ttl=ttl
+        )
+        return CollectionParams(request, collectionId)
+
+    return collection_dependency
+
+
+def lazy_collections_dependency(
+    db_settings: DatabaseSettings,
+    ttl: int,
+) -> Callable[..., CollectionList]:
+    """Collections dependency describing the listed collections first."""
+
+    async def collections_dependency(
+        request: Request,
+        bbox_filter: Annotated[Optional[List[float]], Depends(bbox_query)],
+        datetime_filter: Annotated[Optional[List[str]], Depends(datetime_query)],
+        type_filter: Annotated[
+            Optional[Literal["Function", "Table"]],
+            Query(alias="type", description="Filter based on Collection type."),
+        ] = None,
+        limit: Annotated[
+            Optional[int],
+            Query(
+                ge=0,
+                le=1000,
+                description="Limits the number of collection in the response.",
+            ),
+        ] = None,
+        offset: Annotated[
+            Optional[int],
+            Query(
+                ge=0,
+                description="Starts the response at an offset.",
+            ),
+        ] = None,
+    ) -> CollectionList:
+        """Return Collections Catalog."""
+        catalog: Optional[Catalog] = getattr(request.app.state, "collection_catalog", None)
+        if catalog:
+            collection_ids = [
+                collection.id
+                for collection in catalog["collections"].values()
+                if type_filter is None or collection.type == type_filter
+            ]
+
+            # Without spatio-temporal filters only the requested page needs a description
+            if bbox_filter is None and datetime_filter is None:
+                start = offset or 0
+                collection_ids = collection_ids[start : start + limit if limit else None]
+
+            await describe_collections(
+                request.app, collection_ids, db_settings=db_settings, ttl=ttl
+            )
+
+        return CollectionsParams(
+            request,
+            bbox_filter=bbox_filter,
+            datetime_filter=datetime_filter,
+            type_filter=type_filter,
+            limit=limit,
+            offset=offset,
+        )
+
+    return collections_dependency
+
+
+def geometry_options_query(
+    simplify_tolerance: Annotated[
+        Optional[float],
+        Query(
+            alias="simplify-tolerance",
+            gt=0,
+            description="Simplify the geometries (preserving their topology) with a tolerance in decimal degrees.",
+        ),
+    ] = None,
+    zoom: Annotated[
+        Optional[int],
+        Query(
+            ge=0,
+            le=24,
+            description="Simplify the geometries and round their coordinates to the resolution of a web map zoom level.",
+        ),
+    ] = None,
+    precision: Annotated[
+        Optional[int],
+        Query(ge=0, le=15, description="Number of decimal digits of the coordinates."),
+    ] = None,
+) -> GeometryOptions:
+    """Geometry simplification and precision, explicit or from a zoom level."""
+    if zoom is not None:
+        simplify_tolerance = simplify_tolerance or zoom_tolerance(zoom)
+        precision = precision if precision is not None else zoom_precision(zoom)
+
+    return GeometryOptions(tolerance=simplify_tolerance, precision=precision)
@@ -0,0 +1,733 @@
+"""Endpoints factories"""
+import functools
+import inspect
+from dataclasses import dataclass
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Union,
+    get_args,
+)
+
+from tipg.collections import Collection, Feature, features_settings
+from tipg.dependencies import (
+    ItemsResponseType,
+    accept_media_type,
+    function_parameters_query,
+    properties_filter_query,
+)
+from tipg.errors import NoPrimaryKey, NotFound
+from tipg.factory import Endpoints, OGCFeaturesFactory, OGCTilesFactory
+from tipg.resources.enums import MediaType
+from tipg.resources.response import GeoJSONResponse, orjsonDumps
+
+from fastapi import APIRouter, Depends, Query
+from starlette.datastructures import QueryParams
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+from src.catalog import collection_sort_keys
+from src.dependencies import geometry_options_query
+from src.features import (
+    GeometryOptions,
+    InvalidPageToken,
+    Keyset,
+    Page,
+    UnsupportedParameter,
+    columnar_query,
+    decode_page_token,
+    encode_page_token,
+    features_batches,
+    features_query,
+    get_keyset,
+    projected_geometry_column,
+    record_batches,
+    row_feature,
+)
+from src.formats import (
+    FILE_EXTENSIONS,
+    BinaryMediaType,
+    ColumnarSchema,
+    arrow_stream,
+    available_media_types,
+    parquet_stream,
+)
+
+# Outputs of the items endpoint served by the FeaturesFactory, others are left to tipg
+ITEMS_MEDIA_TYPES = [MediaType.geojson, MediaType.geojsonseq, MediaType.ndjson]
+
+# Rows per record batch / row group of the binary outputs, when not streaming
+BINARY_BATCH_SIZE = 10000
+
+
+def check_geometry_options(geometry_options: GeometryOptions, output_type: MediaType):
+    """Raise if geometry options are given for an output rendered by tipg."""
+    if geometry_options != GeometryOptions():
+        raise UnsupportedParameter(
+            f"`simplify-tolerance`, `zoom` and `precision` are not supported by the {output_type.name} output."
+        )
+
+
+def items_output_type_dependency() -> Any:
+    """Items output type dependency, with the binary media types."""
+    binary_media_types = available_media_types()
+
+    def items_output_type(
+        request: Request,
+        f: Annotated[
+            Optional[
+                Literal[  # type: ignore
+                    tuple(
+                        [
+                            *get_args(ItemsResponseType),
+                            *[m.name for m in binary_media_types],
+                        ]
+                    )
+                ]
+            ],
+            Query(
+                description="Response MediaType. Defaults to endpoint's default or value defined in `accept` header."
+            ),
+        ] = None,
+    ) -> Optional[Union[MediaType, BinaryMediaType]]:
+        """Output MediaType: geojson, html, json, csv, geojsonseq, ndjson, arrow, parquet, fgb."""
+        if f:
+            return BinaryMediaType[f] if f in BinaryMediaType.__members__ else MediaType[f]
+
+        accepted_media = [
+            *[MediaType[v] for v in get_args(ItemsResponseType)],
+            *binary_media_types,
+        ]
+        return accept_media_type(request.headers.get("accept", ""), accepted_media)
+
+    return items_output_type
+
+
+def wrap_route(
+    router: APIRouter,
+    name: str,
+    wrapper: Callable[[Callable], Callable],
+    parameters: Dict[str, Any],
+    annotations: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Replace a tipg route of a router by `wrapper(endpoint)`.
+
+    The wrapper is called with the parameters of the tipg endpoint, those with new
+    `annotations`, and the keyword-only `parameters` (name: annotation). The new route
+    keeps the position and the OpenAPI description (operation id, summary, responses...)
+    of the tipg route.
+    """
+    route = next(r for r in router.routes if getattr(r, "name", None) == name)
+    index = router.routes.index(route)
+    router.routes.remove(route)
+    endpoint = functools.wraps(route.endpoint)(wrapper(route.endpoint))
+
+    annotations = annotations or {}
+    signature = inspect.signature(route.endpoint)
+    endpoint.__signature__ = signature.replace(  # type: ignore
+        parameters=[
+            *[
+                parameter.replace(annotation=annotations[name])
+                if name in annotations
+                else parameter
+                for name, parameter in signature.parameters.items()
+            ],
+            *[
+                inspect.Parameter(
+                    name,
+                    inspect.Parameter.KEYWORD_ONLY,
+                    default=None,
+                    annotation=annotation,
+                )
+                for name, annotation in parameters.items()
+            ],
+        ]
+    )
+
+    router.add_api_route(
+        route.path,
+        endpoint,
+        methods=list(route.methods),
+        name=route.name,
+        response_model=route.response_model,
+        status_code=route.status_code,
+        tags=route.tags,
+        dependencies=route.dependencies,
+        summary=route.summary,
+        description=route.description,
+        response_description=route.response_description,
+        responses=route.responses,
+        deprecated=route.deprecated,
+        operation_id=route.operation_id,
+        response_model_include=route.response_model_include,
+        response_model_exclude=route.response_model_exclude,
+        response_model_by_alias=route.response_model_by_alias,
+        response_model_exclude_unset=route.response_model_exclude_unset,
+        response_model_exclude_defaults=route.response_model_exclude_defaults,
+        response_model_exclude_none=route.response_model_exclude_none,
+        include_in_schema=route.include_in_schema,
+        response_class=route.response_class,
+        callbacks=route.callbacks,
+        openapi_extra=route.openapi_extra,
+    )
+    router.routes.insert(index, router.routes.pop())
+
+
+@dataclass
+class FeaturesFactory(OGCFeaturesFactory):
+    """OGC Features endpoints, with streamed, keyset paginated and binary items responses."""
+
+    # Stream the items, reading them from the database `stream_batch_size` at a time
+    # (disabled when 0)
+    stream_batch_size: int = 0
+
+    # Page the items with a `token` made of the sort key of the last item of a page,
+    # when sorted by the primary key or by a single column leading a btree index
+    keyset_pagination: bool = False
+
+    def _items_route(self):
+        super()._items_route()
+
+        # Keep the tipg endpoint parameters and use it for the other output types
+        def wrapper(items: Callable) -> Callable:
+            async def features_items(**kwargs: Any):
+                token = kwargs.pop("token")
+                geometry_options = kwargs.pop("geometry_options")
+                output_type = kwargs.get("output_type") or MediaType.geojson
+                if isinstance(output_type, BinaryMediaType):
+                    if token:
+                        raise InvalidPageToken(
+                            "Page tokens are only supported by GeoJSON, GeoJSONSeq and NDJSON outputs."
+                        )
+                    return await self.binary_items_response(
+                        geometry_options=geometry_options, **kwargs
+                    )
+
+                if output_type not in ITEMS_MEDIA_TYPES:
+                    if token:
+                        raise InvalidPageToken(
+                            "Page tokens are only supported by GeoJSON, GeoJSONSeq and NDJSON outputs."
+                        )
+                    check_geometry_options(geometry_options, output_type)
+                    return await items(**kwargs)
+
+                kwargs["output_type"] = output_type
+                return await self.items_response(
+                    token=token, geometry_options=geometry_options, **kwargs
+                )
+
+            return features_items
+
+        wrap_route(
+            self.router,
+            "items",
+            wrapper,
+            parameters={
+                "token": Annotated[
+                    Optional[str],
+                    Query(description="Page token, from the `next` link of a page."),
+                ],
+                "geometry_options": Annotated[
+                    GeometryOptions, Depends(geometry_options_query)
+                ],
+            },
+            annotations={
+                "output_type": Annotated[
+                    Optional[Any], Depends(items_output_type_dependency())
+                ]
+            },
+        )
+
+    def _item_route(self):
+        super()._item_route()
+
+        def wrapper(item: Callable) -> Callable:
+            async def features_item(**kwargs: Any):
+                geometry_options = kwargs.pop("geometry_options")
+                output_type = kwargs.get("output_type") or MediaType.geojson
+                if output_type not in (MediaType.geojson, MediaType.geojsonseq):
+                    check_geometry_options(geometry_options, output_type)
+                    return await item(**kwargs)
+
+                return await self.item_response(geometry_options=geometry_options, **kwargs)
+
+            return features_item
+
+        wrap_route(
+            self.router,
+            "item",
+            wrapper,
+            parameters={
+                "geometry_options": Annotated[
+                    GeometryOptions, Depends(geometry_options_query)
+                ],
+            },
+        )
+
+    def items_links(
+        self,
+        request: Request,
+        collection: Collection,
+        matched: int,
+        page: Page,
+        limit: int,
+        offset: int,
+        keyset: Optional[Keyset] = None,
+        sortby: Optional[str] = None,
+    ) -> List[Dict]:
+        """Links of an items page."""
+        qs = "?" + str(request.query_params) if request.query_params else ""
+        items_url = self.url_for(request, "items", collectionId=collection.id)
+        links: List[Dict] = [
+            {
+                "title": "Collection",
+                "href": self.url_for(request, "collection", collectionId=collection.id),
+                "rel": "collection",
+                "type": "application/json",
+            },
+            {
+                "title": "Items",
+                "href": items_url + qs,
+                "rel": "self",
+                "type": "application/geo+json",
+            },
+        ]
+
+        next_params: Optional[Dict] = None
+        if keyset:
+            if page.more:
+                qp = dict(request.query_params)
+                qp.pop("offset", None)
+                next_params = {**qp, "token": encode_page_token(sortby, page.key)}
+
+        elif matched - page.returned > offset:
+            next_params = {**request.query_params, "offset": offset + page.returned}
+
+        if next_params:
+            links.append(
+                {
+                    "href": f"{items_url}?{QueryParams(next_params)}",
+                    "rel": "next",
+                    "type": "application/geo+json",
+                    "title": "Next page",
+                },
+            )
+
+        if offset and "token" not in request.query_params:
+            qp = dict(request.query_params)
+            qp.pop("offset")
+            query_params = QueryParams({**qp, "offset": max(offset - limit, 0)})
+            links.append(
+                {
+                    "href": f"{items_url}?{query_params}",
+                    "rel": "prev",
+                    "type": "application/geo+json",
+                    "title": "Previous page",
+                },
+            )
+
+        return links
+
+    def feature_links(
+        self, request: Request, collection: Collection, feature: Feature
+    ) -> List[Dict]:
+        """Links of an item."""
+        return [
+            {
+                "title": "Collection",
+                "href": self.url_for(request, "collection", collectionId=collection.id),
+                "rel": "collection",
+                "type": "application/json",
+            },
+            {
+                "title": "Item",
+                "href": self.url_for(
+                    request,
+                    "item",
+                    collectionId=collection.id,
+                    itemId=feature.get("id"),
+                ),
+                "rel": "item",
+                "type": "application/geo+json",
+            },
+        ]
+
+    async def items_response(  # noqa: C901
+        self,
+        request: Request,
+        collection: Collection,
+        ids_filter: Optional[List[str]] = None,
+        bbox_filter: Optional[List[float]] = None,
+        datetime_filter: Optional[List[str]] = None,
+        properties: Optional[List[str]] = None,
+        cql_filter: Optional[Any] = None,
+        sortby: Optional[str] = None,
+        geom_column: Optional[str] = None,
+        datetime_column: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        bbox_only: Optional[bool] = None,
+        simplify: Optional[float] = None,
+        output_type: MediaType = MediaType.geojson,
+        token: Optional[str] = None,
+        geometry_options: GeometryOptions = GeometryOptions(),
+    ) -> Response:
+        """GeoJSON, GeoJSONSeq or NDJSON items response."""
+        limit = limit or features_settings.default_features_limit
+        offset = offset or 0
+
+        keyset = (
+            get_keyset(
+                collection, sortby, collection_sort_keys(request.app, collection.id)
+            )
+            if self.keyset_pagination
+            else None
+        )
+        after = None
+        if token:
+            if not keyset:
+                raise InvalidPageToken(
+                    "Page tokens can not be used with this collection or `sortby`."
+                )
+            after = decode_page_token(token, sortby)
+            offset = 0
+
+        filters: Dict[str, Any] = {
+            "ids_filter": ids_filter,
+            "bbox_filter": bbox_filter,
+            "datetime_filter": datetime_filter,
+            "properties_filter": properties_filter_query(request, collection),
+            "cql_filter": cql_filter,
+            "geom": geom_column,
+            "dt": datetime_column,
+            "function_parameters": function_parameters_query(request, collection),
+        }
+
+        # Build the query first so invalid parameters are raised before streaming
+        query, args = features_query(
+            collection,
+            **filters,
+            sortby=sortby,
+            properties=properties,
+            # one more feature tells if there is a next page
+            limit=limit + 1 if keyset else limit,
+            offset=offset,
+            bbox_only=bbox_only,
+            simplify=simplify,
+            geom_as_wkt=output_type == MediaType.ndjson,
+            keyset=keyset,
+            after=after,
+            geometry_options=geometry_options,
+        )
+
+        async with request.app.state.pool.acquire() as conn:
+            matched = await collection._features_count_query(conn, **filters)
+
+        page = Page()
+        batches = features_batches(
+            request.app.state.pool,
+            query,
+            args,
+            batch_size=self.stream_batch_size,
+            limit=limit if keyset else None,
+            keyset=keyset,
+            page=page,
+        )
+
+        if output_type == MediaType.ndjson:
+            with_geometry = collection.get_geometry_column(geom_column) is not None
+
+            async def content() -> AsyncIterator[bytes]:
+                async for batch in batches:
+                    yield b"".join(
+                        orjsonDumps(
+                            {
+                                "collectionId": collection.id,
+                                "itemId": feature.get("id"),
+                                **feature.get("properties", {}),
+                                **(
+                                    {"geometry": feature.get("geometry")}
+                                    if with_geometry
+                                    else {}
+                                ),
+                            }
+                        )
+                        + b"\n"
+                        for feature in batch
+                    )
+
+            headers = {"Content-Disposition": "attachment;filename=items.ndjson"}
+
+        elif output_type == MediaType.geojsonseq:
+
+            async def content() -> AsyncIterator[bytes]:
+                async for batch in batches:
+                    yield b"".join(
+                        orjsonDumps(
+                            {
+                                **feature,
+                                "links": self.feature_links(request, collection, feature),
+                            }
+                        )
+                        + b"\n"
+                        for feature in batch
+                    )
+
+            headers = {"Content-Disposition": "attachment;filename=items.geojson"}
+
+        else:
+            header = orjsonDumps(
+                {
+                    "type": "FeatureCollection",
+                    "id": collection.id,
+                    "title": collection.title or collection.id,
+                    "description": collection.description
+                    or collection.title
+                    or collection.id,
+                    "numberMatched": matched,
+                    "features": [],
+                }
+            )
+
+            async def content() -> AsyncIterator[bytes]:
+                # `{..., "features": [` then the features, batch by batch, and the
+                # members depending on them (number returned and links)
+                yield header[:-2]
+                separator = b""
+                async for batch in batches:
+                    yield separator + b",".join(
+                        orjsonDumps(
+                            {
+                                **feature,
+                                "links": self.feature_links(request, collection, feature),
+                            }
+                        )
+                        for feature in batch
+                    )
+                    separator = b","
+
+                trailer = orjsonDumps(
+                    {
+                        "numberReturned": page.returned,
+                        "links": self.items_links(
+                            request, collection, matched, page, limit, offset, keyset, sortby
+                        ),
+                    }
+                )
+                yield b"]," + trailer[1:]
+
+            headers = {}
+
+        if self.stream_batch_size:
+            return StreamingResponse(content(), media_type=output_type, headers=headers)
+
+        return Response(
+            b"".join([chunk async for chunk in content()]),
+            media_type=output_type,
+            headers=headers,
+        )
+
+    async def binary_items_response(
+        self,
+        request: Request,
+        collection: Collection,
+        ids_filter: Optional[List[str]] = None,
+        bbox_filter: Optional[List[float]] = None,
+        datetime_filter: Optional[List[str]] = None,
+        properties: Optional[List[str]] = None,
+        cql_filter: Optional[Any] = None,
+        sortby: Optional[str] = None,
+        geom_column: Optional[str] = None,
+        datetime_column: Optional[str] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        bbox_only: Optional[bool] = None,
+        simplify: Optional[float] = None,
+        output_type: BinaryMediaType = BinaryMediaType.arrow,
+        geometry_options: GeometryOptions = GeometryOptions(),
+    ) -> Response:
+        """Arrow IPC stream, GeoParquet or FlatGeobuf items response."""
+        query, args = columnar_query(
+            collection,
+            ids_filter=ids_filter,
+            bbox_filter=bbox_filter,
+            datetime_filter=datetime_filter,
+            properties_filter=properties_filter_query(request, collection),
+            cql_filter=cql_filter,
+            sortby=sortby,
+            properties=properties,
+            geom=geom_column,
+            dt=datetime_column,
+            limit=limit,
+            offset=offset,
+            bbox_only=bbox_only,
+            simplify=simplify,
+            function_parameters=function_parameters_query(request, collection),
+            flatgeobuf=output_type == BinaryMediaType.fgb,
+            geometry_options=geometry_options,
+        )
+        headers = {
+            "Content-Disposition": f"attachment;filename=items.{FILE_EXTENSIONS[output_type]}"
+        }
+
+        # PostGIS builds the whole FlatGeobuf, its spatial index needs all the features
+        if output_type == BinaryMediaType.fgb:
+            async with request.app.state.pool.acquire() as conn:
+                content = await conn.fetchval(query, *args)
+            if content is None:
+                # ST_AsFlatGeobuf of no features is NULL, not an empty FlatGeobuf
+                return Response(status_code=204)
+            return Response(content, media_type=output_type, headers=headers)
+
+        schema = ColumnarSchema(
+            collection,
+            properties,
+            with_geometry=collection.get_geometry_column(geom_column) is not None,
+        )
+        batches = record_batches(
+            request.app.state.pool,
+            query,
+            args,
+            batch_size=self.stream_batch_size or BINARY_BATCH_SIZE,
+        )
+        writer = arrow_stream if output_type == BinaryMediaType.arrow else parquet_stream
+        content = writer(schema, batches)
+
+        if self.stream_batch_size:
+            return StreamingResponse(content, media_type=output_type, headers=headers)
+
+        return Response(
+            b"".join([chunk async for chunk in content]),
+            media_type=output_type,
+            headers=headers,
+        )
+
+    async def item_response(
+        self,
+        request: Request,
+        collection: Collection,
+        itemId: str,
+        bbox_only: Optional[bool] = None,
+        simplify: Optional[float] = None,
+        geom_column: Optional[str] = None,
+        datetime_column: Optional[str] = None,
+        properties: Optional[List[str]] = None,
+        output_type: Optional[MediaType] = None,
+        geometry_options: GeometryOptions = GeometryOptions(),
+    ) -> Response:
+        """GeoJSON item response."""
+        if collection.id_column is None:
+            raise NoPrimaryKey("No primary key is set on this table")
+
+        query, args = features_query(
+            collection,
+            ids_filter=[itemId],
+            properties=properties,
+            geom=geom_column,
+            dt=datetime_column,
+            bbox_only=bbox_only,
+            simplify=simplify,
+            function_parameters=function_parameters_query(request, collection),
+            geometry_options=geometry_options,
+        )
+        async with request.app.state.pool.acquire() as conn:
+            rows = await conn.fetch(query, *args)
+
+        if not rows:
+            raise NotFound(f"Item {itemId} in Collection {collection.id} does not exist.")
+
+        return GeoJSONResponse(
+            {
+                **row_feature(rows[0]),
+                "links": [
+                    {
+                        "href": self.url_for(request, "collection", collectionId=collection.id),
+                        "rel": "collection",
+                        "type": "application/json",
+                    },
+                    {
+                        "href": self.url_for(
+                            request, "item", collectionId=collection.id, itemId=itemId
+                        ),
+                        "rel": "self",
+                        "type": "application/geo+json",
+                    },
+                ],
+            }
+        )
+
+
+@dataclass
+class TilesFactory(OGCTilesFactory):
+    """OGC Tiles endpoints, reading geometries already projected to the TileMatrixSet CRS."""
+
+    # Use the `{geom}_{srid}` geometry column of a collection for the tiles of a
+    # TileMatrixSet of the same CRS
+    projected_geometries: bool = True
+
+    def _tile_routes(self):
+        super()._tile_routes()
+        if not self.projected_geometries:
+            return
+
+        def wrapper(tile: Callable) -> Callable:
+            async def tiles_tile(**kwargs: Any):
+                collection = kwargs["collection"]
+                tms = self.supported_tms.get(kwargs["tileMatrixSetId"])
+                column = projected_geometry_column(
+                    collection,
+                    collection.get_geometry_column(kwargs.get("geom_column")),
+                    tms.crs.to_epsg(),
+                )
+                # tipg compares `bbox` with the column in EPSG:4326
+                if column is not None and kwargs.get("bbox_filter") is None:
+                    # The tile envelope is then not transformed, and the ST_Transform
+                    # of ST_AsMVTGeom returns the geometries as they are
+                    kwargs["geom_column"] = column.name
+
+                return await tile(**kwargs)
+
+            return tiles_tile
+
+        wrap_route(self.router, "collection_get_tile", wrapper, parameters={})
+
+
+@dataclass
+class FeaturesEndpoints(Endpoints):
+    """OGC Features and Tiles endpoints, with the FeaturesFactory and TilesFactory."""
+
+    stream_batch_size: int = 0
+    keyset_pagination: bool = False
+    projected_geometries: bool = True
+
+    def register_routes(self):
+        """Register factory Routes."""
+        self.ogc_features = FeaturesFactory(
+            collections_dependency=self.collections_dependency,
+            collection_dependency=self.collection_dependency,
+            router_prefix=self.router_prefix,
+            templates=self.templates,
+            stream_batch_size=self.stream_batch_size,
+            keyset_pagination=self.keyset_pagination,
+            # We do not want `/` and `/conformance` from the factory
+            with_common=False,
+        )
+        self.router.include_router(self.ogc_features.router)
+
+        self.ogc_tiles = TilesFactory(
+            collection_dependency=self.collection_dependency,
+            router_prefix=self.router_prefix,
+            templates=self.templates,
+            supported_tms=self.supported_tms,
+            with_viewer=self.with_tiles_viewer,
+            projected_geometries=self.projected_geometries,
+            # We do not want `/` and `/conformance` from the factory
+            with_common=False,
+        )
+        self.router.include_router(self.ogc_tiles.router)
@@ -0,0 +1,461 @@
+"""Features queries"""
+import base64
+import binascii
+import math
+import re
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import orjson
+from buildpg import clauses, logic, render
+from buildpg import funcs as pg_funcs
+from buildpg.components import RawDangerous
+from pygeofilter.ast import AstType
+from tipg.collections import Collection, Column, Feature, features_settings
+from tipg.errors import InvalidGeometryColumnName, MissingGeometryColumn, TiPgError
+
+
+class InvalidPageToken(TiPgError):
+    """Invalid page token."""
+
+
+class UnsupportedParameter(TiPgError):
+    """Query parameter not supported by the requested output."""
+
+
+class Keyset(NamedTuple):
+    """Sort key of a keyset (seek) paginated query: a column, then the primary key."""
+
+    column: Column
+    id_column: Column
+    descending: bool
+
+    @property
+    def by_id(self) -> bool:
+        """Whether the features are only sorted by their primary key."""
+        return self.column.name == self.id_column.name
+
+
+def get_keyset(
+    collection: Collection, sortby: Optional[str], sort_keys: Sequence[str]
+) -> Optional[Keyset]:
+    """Keyset of a query, when it can be paginated with one.
+
+    The sort column must lead a btree index (`sort_keys`), otherwise every page would
+    still sort the whole filtered table.
+    """
+    if collection.id_column is None:
+        return None
+
+    if not sortby:
+        if collection.id_column.name not in sort_keys:
+            return None
+        return Keyset(collection.id_column, collection.id_column, False)
+
+    # Only a single sort column, followed by the primary key
+    if "," in sortby.strip():
+        return None
+
+    parts = re.match("^(?P<direction>[+-]?)(?P<column>.*)$", sortby.strip()).groupdict()  # type: ignore
+    column = collection.get_column(parts["column"].strip())
+    if column is None or column.name not in sort_keys:
+        return None
+
+    return Keyset(column, collection.id_column, parts["direction"] == "-")
+
+
+def encode_page_token(sortby: Optional[str], key: List[Optional[str]]) -> str:
+    """Opaque page token, from the sort key of the last feature of a page."""
+    content = orjson.dumps({"sortby": sortby or "", "key": key})
+    return base64.urlsafe_b64encode(content).decode().rstrip("=")
+
+
+def decode_page_token(token: str, sortby: Optional[str]) -> List[Optional[str]]:
+    """Sort key of a page token."""
+    try:
+        content = orjson.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        token_sortby, key = content["sortby"], content["key"]
+    except (binascii.Error, orjson.JSONDecodeError, KeyError, TypeError) as e:
+        raise InvalidPageToken("Invalid page token.") from e
+
+    if token_sortby != (sortby or ""):
+        raise InvalidPageToken("Page token was created with another `sortby`.")
+
+    return key
+
+
+def _value(value: Optional[str], column: Column):
+    return pg_funcs.cast(pg_funcs.cast(value, "text"), column.type)
+
+
+def _null(column: Column):
+    return logic.V(column.name).is_(logic.S(RawDangerous("NULL")))
+
+
+def _not_null(column: Column):
+    return logic.V(column.name).is_not(logic.S(RawDangerous("NULL")))
+
+
+def seek_predicate(keyset: Keyset, key: List[Optional[str]]):
+    """Filter the features after a sort key.
+
+    Sorting is ascending with NULLs last or descending with NULLs first (PostgreSQL's
+    defaults), on the column then on the primary key.
+    """
+    id_column = keyset.id_column
+    if keyset.by_id:
+        (last_id,) = key
+        if keyset.descending:
+            return logic.V(id_column.name) < _value(last_id, id_column)
+        return logic.V(id_column.name) > _value(last_id, id_column)
+
+    last_value, last_id = key
+    column = keyset.column
+    row = logic.Func("ROW", logic.V(column.name), logic.V(id_column.name))
+
+    if last_value is None:
+        if keyset.descending:
+            return pg_funcs.OR(
+                _not_null(column), logic.V(id_column.name) < _value(last_id, id_column)
+            )
+        return pg_funcs.AND(
+            _null(column), logic.V(id_column.name) > _value(last_id, id_column)
+        )
+
+    last_row = logic.Func("ROW", _value(last_value, column), _value(last_id, id_column))
+    if keyset.descending:
+        return row < last_row
+    return pg_funcs.OR(row > last_row, _null(column))
+
+
+def keyset_order(keyset: Keyset):
+    """ORDER BY clause of a keyset."""
+    columns = [keyset.column.name]
+    if not keyset.by_id:
+        columns.append(keyset.id_column.name)
+
+    if keyset.descending:
+        return clauses.OrderBy(*[logic.V(name).desc() for name in columns])
+    return clauses.OrderBy(*[logic.V(name) for name in columns])
+
+
+class GeometryOptions(NamedTuple):
+    """Simplification and coordinates precision of the returned geometries."""
+
+    # ST_SimplifyPreserveTopology tolerance, in degrees
+    tolerance: Optional[float] = None
+    # decimal digits of the coordinates
+    precision: Optional[int] = None
+
+
+def zoom_tolerance(zoom: int) -> float:
+    """Size of a pixel of a 256px WebMercatorQuad tile at the equator, in degrees."""
+    return 360.0 / (256 * 2**zoom)
+
+
+def zoom_precision(zoom: int) -> int:
+    """Decimal digits resolving a tenth of a pixel at a zoom level."""
+    return max(0, math.ceil(-math.log10(zoom_tolerance(zoom) / 10)))
+
+
+def geometry_expression(
+    collection: Collection,
+    geometry_column: Optional[Column],
+    bbox_only: Optional[bool] = None,
+    simplify: Optional[float] = None,
+    tolerance: Optional[float] = None,
+):
+    """Geometry of the features, simplified in WGS84 while preserving its topology."""
+    g = collection._geom(geometry_column, bbox_only, simplify)
+    if g is not None and tolerance and not bbox_only:
+        g = logic.Func("ST_SimplifyPreserveTopology", g, tolerance)
+    return g
+
+
+def projected_geometry_column(
+    collection: Collection, geometry_column: Optional[Column], srid: Optional[int]
+) -> Optional[Column]:
+    """`{name}_{srid}` copy of a geometry column already projected to `srid`.
+
+    e.g. the `geom_3857` column maintained by `features_api.add_projected_geometry`.
+    """
+    if geometry_column is None or not srid or geometry_column.srid == srid:
+        return None
+
+    column = collection.get_geometry_column(f"{geometry_column.name}_{srid}")
+    if column is not None and column.srid == srid:
+        return column
+    return None
+
+
+def _select(
+    collection: Collection,
+    properties: Optional[List[str]],
+    geometry_column: Optional[Column],
+    bbox_only: Optional[bool],
+    simplify: Optional[float],
+    geom_as_wkt: bool,
+    geometry_options: GeometryOptions,
+):
+    """`PgCollection._select`, with the geometry options."""
+    sel = collection._select_no_geo(properties)
+
+    g = geometry_expression(
+        collection, geometry_column, bbox_only, simplify, geometry_options.tolerance
+    )
+    precision = geometry_options.precision
+    if geom_as_wkt:
+        if g is None:
+            return sel.comma(pg_funcs.cast(None, "text").as_("tipg_geom"))
+        if precision is not None:
+            return sel.comma(
+                logic.Func("ST_AsEWKT", g, pg_funcs.cast(precision, "int")).as_("tipg_geom")
+            )
+        return sel.comma(logic.Func("ST_AsEWKT", g).as_("tipg_geom"))
+
+    if g is None:
+        return sel.comma(pg_funcs.cast(None, "json").as_("tipg_geom"))
+    if precision is not None:
+        geojson = logic.Func("ST_AsGeoJSON", g, pg_funcs.cast(precision, "int"))
+    else:
+        geojson = logic.Func("ST_AsGeoJSON", g)
+    return sel.comma(pg_funcs.cast(geojson, "json").as_("tipg_geom"))
+
+
+def features_query(
+    collection: Collection,
+    *,
+    ids_filter: Optional[List[str]] = None,
+    bbox_filter: Optional[List[float]] = None,
+    datetime_filter: Optional[List[str]] = None,
+    properties_filter: Optional[List[Tuple[str, str]]] = None,
+    cql_filter: Optional[AstType] = None,
+    sortby: Optional[str] = None,
+    properties: Optional[List[str]] = None,
+    geom: Optional[str] = None,
+    dt: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    bbox_only: Optional[bool] = None,
+    simplify: Optional[float] = None,
+    geom_as_wkt: bool = False,
+    function_parameters: Optional[Dict[str, str]] = None,
+    keyset: Optional[Keyset] = None,
+    after: Optional[List[Optional[str]]] = None,
+    geometry_options: GeometryOptions = GeometryOptions(),
+) -> Tuple[str, List]:
+    """Render the query of a page of features, as `PgCollection.features` runs it.
+
+    With a `keyset`, features are sorted by it and the sort key of each one is selected
+    as `tipg_sort`; with `after`, the page starts after that sort key instead of at
+    `offset`.
+    """
+    if geom and geom.lower() != "none" and not collection.get_geometry_column(geom):
+        raise InvalidGeometryColumnName(f"Invalid Geometry Column: {geom}.")
+
+    select = _select(
+        collection,
+        properties=properties,
+        geometry_column=collection.get_geometry_column(geom),
+        bbox_only=bbox_only,
+        simplify=simplify,
+        geom_as_wkt=geom_as_wkt,
+        geometry_options=geometry_options,
+    )
+    where = collection._where(
+        ids=ids_filter,
+        datetime=datetime_filter,
+        bbox=bbox_filter,
+        properties=properties_filter,
+        cql=cql_filter,
+        geom=geom,
+        dt=dt,
+    )
+    order = collection._sortby(sortby)
+
+    if keyset:
+        if not keyset.by_id:
+            select = select.comma(logic.V(keyset.column.name).as_("tipg_sort"))
+        order = keyset_order(keyset)
+        if after is not None:
+            where = clauses.Where(pg_funcs.AND(where.logic, seek_predicate(keyset, after)))
+            offset = 0
+
+    c = clauses.Clauses(
+        select,
+        collection._from(function_parameters or {}),
+        where,
+        order,
+        clauses.Limit(limit or features_settings.default_features_limit),
+        clauses.Offset(offset or 0),
+    )
+
+    return render(":c", c=c)
+
+
+def columnar_query(
+    collection: Collection,
+    *,
+    ids_filter: Optional[List[str]] = None,
+    bbox_filter: Optional[List[float]] = None,
+    datetime_filter: Optional[List[str]] = None,
+    properties_filter: Optional[List[Tuple[str, str]]] = None,
+    cql_filter: Optional[AstType] = None,
+    sortby: Optional[str] = None,
+    properties: Optional[List[str]] = None,
+    geom: Optional[str] = None,
+    dt: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    bbox_only: Optional[bool] = None,
+    simplify: Optional[float] = None,
+    function_parameters: Optional[Dict[str, str]] = None,
+    flatgeobuf: bool = False,
+    geometry_options: GeometryOptions = GeometryOptions(),
+) -> Tuple[str, List]:
+    """Render the query of a page of features as typed columns and a WKB geometry.
+
+    With `flatgeobuf`, the query returns the page as a single FlatGeobuf (with its
+    spatial index) built by PostGIS. Binary coordinates keep their size, the
+    `precision` option zeroes their insignificant bits so they compress better.
+    """
+    geometry_column = collection.get_geometry_column(geom)
+    if geom and geom.lower() != "none" and not geometry_column:
+        raise InvalidGeometryColumnName(f"Invalid Geometry Column: {geom}.")
+
+    fields = [logic.V(name) for name in collection.columns(properties)]
+    g = geometry_expression(
+        collection, geometry_column, bbox_only, simplify, geometry_options.tolerance
+    )
+    if g is not None and geometry_options.precision is not None:
+        g = logic.Func(
+            "ST_QuantizeCoordinates", g, pg_funcs.cast(geometry_options.precision, "int")
+        )
+    if flatgeobuf:
+        if g is None:
+            raise MissingGeometryColumn("FlatGeobuf output needs a geometry column.")
+        fields.append(g.as_("tipg_geom"))
+    elif g is not None:
+        fields.append(logic.Func("ST_AsBinary", g).as_("tipg_geom"))
+
+    c = clauses.Clauses(
+        clauses.Select(pg_funcs.comma_sep(*fields)),
+        collection._from(function_parameters or {}),
+        collection._where(
+            ids=ids_filter,
+            datetime=datetime_filter,
+            bbox=bbox_filter,
+            properties=properties_filter,
+            cql=cql_filter,
+            geom=geom,
+            dt=dt,
+        ),
+        collection._sortby(sortby),
+        clauses.Limit(limit or features_settings.default_features_limit),
+        clauses.Offset(offset or 0),
+    )
+
+    if flatgeobuf:
+        return render(
+            "SELECT ST_AsFlatGeobuf(q, true, 'tipg_geom') FROM (:c) AS q", c=c
+        )
+
+    return render(":c", c=c)
+
+
+@dataclass
+class Page:
+    """Features read for a page."""
+
+    returned: int = 0
+    # sort key of the last feature, for keyset queries
+    key: Optional[List[Optional[str]]] = None
+    # whether there are more features than the page limit
+    more: bool = False
+
+
+def _sort_key(row: Any, keyset: Keyset) -> List[Optional[str]]:
+    values = [row.get("tipg_sort")] if not keyset.by_id else []
+    values.append(row["tipg_id"])
+    return [None if v is None else str(v) for v in values]
+
+
+async def record_batches(
+    pool,
+    query: str,
+    args: List,
+    batch_size: int = 1000,
+    limit: Optional[int] = None,
+    page: Optional[Page] = None,
+) -> AsyncIterator[List[Any]]:
+    """Read the rows of a query, `batch_size` at a time from a server-side cursor.
+
+    With `batch_size=0` the rows are fetched at once. Rows after the first `limit` ones
+    are not returned, they only mark the `page` as having more features.
+    """
+    page = page if page is not None else Page()
+
+    async with pool.acquire() as conn:
+        if not batch_size:
+            rows = await conn.fetch(query, *args)
+            if limit is not None and len(rows) > limit:
+                page.more = True
+                rows = rows[:limit]
+            if rows:
+                page.returned += len(rows)
+                yield rows
+            return
+
+        # cursors only live within a transaction
+        async with conn.transaction(readonly=True):
+            batch: List[Any] = []
+            async for row in conn.cursor(query, *args, prefetch=batch_size):
+                if limit is not None and page.returned >= limit:
+                    page.more = True
+                    break
+
+                batch.append(row)
+                page.returned += 1
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+
+async def features_batches(
+    pool,
+    query: str,
+    args: List,
+    batch_size: int = 1000,
+    limit: Optional[int] = None,
+    keyset: Optional[Keyset] = None,
+    page: Optional[Page] = None,
+) -> AsyncIterator[List[Feature]]:
+    """Read the features of a query (see `record_batches`)."""
+    page = page if page is not None else Page()
+
+    async for rows in record_batches(pool, query, args, batch_size, limit, page):
+        if keyset:
+            page.key = _sort_key(rows[-1], keyset)
+
+        yield [row_feature(row) for row in rows]
+
+
+def row_feature(row: Any) -> Feature:
+    """Feature of a `features_query` row."""
+    props = dict(row)
+    props.pop("tipg_sort", None)
+    g = props.pop("tipg_geom")
+    id = props.pop("tipg_id")
+    return Feature(type="Feature", geometry=g, id=id, properties=props)
@@ -0,0 +1,177 @@
+"""Binary items output formats"""
+import functools
+import importlib.util
+import io
+from enum import Enum
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import orjson
+from tipg.collections import Collection
+
+
+@functools.lru_cache()
+def _pyarrow() -> Any:
+    """pyarrow, imported when first used since it takes a while to import."""
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    return pyarrow
+
+
+class BinaryMediaType(str, Enum):
+    """Binary items output media types."""
+
+    arrow = "application/vnd.apache.arrow.stream"
+    parquet = "application/vnd.apache.parquet"
+    fgb = "application/flatgeobuf"
+
+
+FILE_EXTENSIONS = {
+    BinaryMediaType.arrow: "arrow",
+    BinaryMediaType.parquet: "parquet",
+    BinaryMediaType.fgb: "fgb",
+}
+
+
+def available_media_types() -> List[BinaryMediaType]:
+    """Binary output media types, Arrow and Parquet need the `arrow` extra (pyarrow)."""
+    if importlib.util.find_spec("pyarrow") is None:
+        return [BinaryMediaType.fgb]
+    return list(BinaryMediaType)
+
+
+def _arrow_types() -> Dict[str, Tuple[Any, Optional[Callable]]]:
+    """Arrow type and value converter of PostgreSQL types."""
+    pyarrow = _pyarrow()
+    return {
+        "bool": (pyarrow.bool_(), None),
+        "int2": (pyarrow.int16(), None),
+        "int4": (pyarrow.int32(), None),
+        "int8": (pyarrow.int64(), None),
+        "float4": (pyarrow.float32(), None),
+        "float8": (pyarrow.float64(), None),
+        "numeric": (pyarrow.float64(), float),
+        "date": (pyarrow.date32(), None),
+        "timestamp": (pyarrow.timestamp("us"), None),
+        "timestamptz": (pyarrow.timestamp("us", tz="UTC"), None),
+        "json": (pyarrow.string(), lambda v: orjson.dumps(v).decode()),
+        "jsonb": (pyarrow.string(), lambda v: orjson.dumps(v).decode()),
+        "bytea": (pyarrow.binary(), None),
+    }
+
+
+class ColumnarSchema:
+    """Arrow schema of the rows of a columnar query, and how to convert them."""
+
+    def __init__(
+        self,
+        collection: Collection,
+        properties: Optional[List[str]] = None,
+        with_geometry: bool = True,
+    ) -> None:
+        """Build the schema from the collection columns."""
+        pyarrow = _pyarrow()
+        arrow_types = _arrow_types()
+        columns = {c.name: c for c in collection.properties}
+
+        fields = []
+        # (row key, converter)
+        self.columns: List[Tuple[str, Optional[Callable]]] = []
+        for name in collection.columns(properties):
+            arrow_type, convert = arrow_types.get(columns[name].type, (None, None))
+            if arrow_type is None:
+                # text, uuid, arrays, ... are written as strings
+                arrow_type, convert = pyarrow.string(), _to_string
+            fields.append(pyarrow.field(name, arrow_type))
+            self.columns.append((name, convert))
+
+        self.with_geometry = with_geometry
+        if with_geometry:
+            fields.append(
+                pyarrow.field(
+                    "geometry",
+                    pyarrow.binary(),
+                    metadata={"ARROW:extension:name": "geoarrow.wkb"},
+                )
+            )
+            self.columns.append(("tipg_geom", None))
+
+        self.schema = pyarrow.schema(fields)
+
+    def geoparquet_schema(self):
+        """Schema with the GeoParquet metadata."""
+        if not self.with_geometry:
+            return self.schema
+
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            # geometries are in WGS84 (lon/lat), GeoParquet's default CRS
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+        }
+        return self.schema.with_metadata({"geo": orjson.dumps(geo)})
+
+    def record_batch(self, rows: List[Any]):
+        """Arrow record batch of rows."""
+        pyarrow = _pyarrow()
+        arrays = []
+        for (key, convert), field in zip(self.columns, self.schema):
+            values = [row[key] for row in rows]
+            if convert:
+                values = [None if v is None else convert(v) for v in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+def _to_string(value: Any) -> str:
+    return value if isinstance(value, str) else str(value)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Writable file collecting what is written until it is taken."""
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        content = b"".join(self.chunks)
+        self.chunks = []
+        return content
+
+
+async def arrow_stream(
+    schema: ColumnarSchema, batches: AsyncIterator[List[Any]]
+) -> AsyncIterator[bytes]:
+    """Write rows as an Arrow IPC stream, one record batch at a time."""
+    sink = _ChunkSink()
+    with _pyarrow().ipc.new_stream(sink, schema.schema) as writer:
+        async for rows in batches:
+            writer.write_batch(schema.record_batch(rows))
+            yield sink.take()
+    yield sink.take()
+
+
+async def parquet_stream(
+    schema: ColumnarSchema, batches: AsyncIterator[List[Any]]
+) -> AsyncIterator[bytes]:
+    """Write rows as GeoParquet, one row group per batch."""
+    sink = _ChunkSink()
+    with _pyarrow().parquet.ParquetWriter(sink, schema.geoparquet_schema()) as writer:
+        async for rows in batches:
+            writer.write_batch(schema.record_batch(rows))
+            yield sink.take()
+    yield sink.take()
@@ -0,0 +1,301 @@
+"""Middlewares"""
+import asyncio
+import random
+import time
+from datetime import datetime
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from tipg.collections import Catalog
+from tipg.errors import MissingCollectionCatalog
+from tipg.middleware import CatalogUpdateFunc
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.monitoring import (
+    LatencyRecorder,
+    Query,
+    explain_query,
+    log_slow_query,
+    logger,
+    record_catalog_age,
+    record_catalog_refresh,
+    record_request_timings,
+    record_slow_request,
+    request_queries,
+    request_timings,
+    server_timing_header,
+    slowest_query,
+)
+
+
+class BackgroundCatalogUpdateMiddleware:
+    """Middleware to update the catalog in a background task (stale-while-revalidate).
+
+    Requests keep being served with the current catalog while a single task builds the
+    new one, which `func` swaps in once complete.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        func: CatalogUpdateFunc,
+        ttl: int = 300,
+        retry_after: int = 30,
+        **kwargs: Any,
+    ) -> None:
+        """Init Middleware.
+
+        Args:
+            app (ASGIApp): starlette/FastAPI application.
+            func (callable): catalog update function, called with the application and `kwargs`.
+            ttl (int): age of the catalog, in seconds, after which it is refreshed.
+            retry_after (int): seconds to wait before trying again after a failed refresh.
+
+        """
+        self.app = app
+        self.func = func
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.kwargs = kwargs
+        self.task: Optional[asyncio.Task] = None
+        self.failed_at: Optional[float] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+
+        catalog: Catalog = getattr(request.app.state, "collection_catalog", None)
+        if not catalog:
+            raise MissingCollectionCatalog("Could not find collections catalog.")
+
+        last_updated = catalog["last_updated"]
+        age = (datetime.now() - last_updated).total_seconds() if last_updated else None
+        if (
+            (age is None or age > self.ttl)
+            # single flight: only one refresh at a time
+            and (self.task is None or self.task.done())
+            and (
+                self.failed_at is None
+                or time.monotonic() - self.failed_at > self.retry_after
+            )
+        ):
+            logger.debug(
+                f"Running catalog refresh in background. Last Updated: {last_updated}"
+            )
+            if age is not None:
+                record_catalog_age(age)
+            self.task = asyncio.create_task(self.refresh(request.app))
+
+        await self.app(scope, receive, send)
+
+    async def refresh(self, app: ASGIApp) -> None:
+        """Run the catalog update function and record how it went."""
+        # The task was created from a request, its queries are not part of it
+        request_timings.set(None)
+
+        start = time.perf_counter()
+        try:
+            await self.func(app, **self.kwargs)
+
+        except Exception:
+            self.failed_at = time.monotonic()
+            logger.exception("Catalog refresh failed")
+            record_catalog_refresh(time.perf_counter() - start, failed=True)
+
+        else:
+            self.failed_at = None
+            record_catalog_refresh(time.perf_counter() - start)
+
+
+class ServerTimingMiddleware:
+    """Middleware timing the stages of the requests.
+
+    The timings are returned in a `Server-Timing` header and recorded as metrics.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Init Middleware."""
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                timings["total"] = time.perf_counter() - start
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing_header(timings))
+
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                timings["total"] = time.perf_counter() - start
+                record_request_timings(timings)
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_timings.reset(token)
+
+
+class SlowQueryMiddleware:
+    """Middleware logging the query plan of slow requests.
+
+    When a request of one of `routes` takes more than `budget` seconds, its slowest
+    query is explained with `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` for a
+    `sample_rate` fraction of them, once the response is sent: in a background task, one
+    at a time, or without `background` before returning from the request.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        budget: float,
+        sample_rate: float = 0.1,
+        timeout: float = 10.0,
+        background: bool = True,
+        routes: Collection[str] = ("items", "collection_get_tile"),
+    ) -> None:
+        """Init Middleware."""
+        self.app = app
+        self.budget = budget
+        self.sample_rate = sample_rate
+        self.timeout = timeout
+        self.background = background
+        self.routes = routes
+        self.task: Optional[asyncio.Task] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        queries: List[Query] = []
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        duration = None
+
+        async def send_wrapper(message: Message):
+            nonlocal duration
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                duration = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_queries.reset(token)
+
+        route = scope.get("route")
+        if (
+            duration is None
+            or duration < self.budget
+            or getattr(route, "name", None) not in self.routes
+        ):
+            return
+
+        record_slow_request()
+        query = slowest_query(queries)
+        if query is None or random.random() >= self.sample_rate:
+            return
+
+        collection = scope.get("path_params", {}).get("collectionId", "")
+        pool = scope["app"].state.pool
+        if not self.background:
+            # The connections of the request are back in the pool
+            await self.log_plan(pool, route.path, collection, duration, query)
+        elif self.task is None or self.task.done():
+            self.task = asyncio.create_task(
+                self.log_plan(pool, route.path, collection, duration, query)
+            )
+
+    async def log_plan(
+        self, pool: Any, route: str, collection: str, duration: float, query: Query
+    ) -> None:
+        """Explain a slow query and log its plan."""
+        try:
+            plan = await explain_query(pool, query, self.timeout)
+        except Exception:
+            logger.exception("Could not explain the slow query")
+        else:
+            log_slow_query(route, collection, duration, query, plan)
+
+
+class LatencyMiddleware:
+    """Middleware recording the latency of the requests in histograms.
+
+    Added last, it also times the responses of the cache middlewares, which answer
+    before the routing: the route template of these requests is found by matching the
+    routes of the application. Requests of no route are not recorded.
+    """
+
+    def __init__(self, app: ASGIApp, recorder: LatencyRecorder) -> None:
+        """Init Middleware."""
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        duration = None
+
+        async def send_wrapper(message: Message):
+            nonlocal status, duration
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                duration = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if duration is None:
+                duration = time.perf_counter() - start
+            route, path_params = self.route(scope)
+            if route is not None:
+                self.recorder.record(
+                    route, status, path_params.get("collectionId", ""), duration
+                )
+
+    @staticmethod
+    def route(scope: Scope) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Path template and parameters of the route of a request."""
+        route = scope.get("route")
+        if route is not None:
+            return route.path, scope.get("path_params", {})
+
+        for route in scope["app"].router.routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return route.path, child_scope.get("path_params", {})
+
+        return None, {}
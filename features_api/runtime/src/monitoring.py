@@ -1,8 +1,27 @@
 """Observability utils"""
-from typing import Callable
+import functools
+import math
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
+import orjson
 from aws_lambda_powertools import Logger, Metrics, Tracer
 from aws_lambda_powertools.metrics import MetricUnit  # noqa: F401
+from buildpg import render
 
 from fastapi import Request, Response
 from fastapi.routing import APIRoute
@@ -16,6 +35,369 @@ metrics: Metrics = Metrics(service="features-api", namespace="veda-backend")
 metrics.set_default_dimensions(environment=settings.stage, service="features-api")
 tracer: Tracer = Tracer()
 
+# Time spent in each stage of the current request, only set when Server-Timing is enabled
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+
+class Query(NamedTuple):
+    """Query run for a request."""
+
+    sql: str
+    args: Tuple
+    # seconds, None for a query read from a cursor
+    duration: Optional[float]
+
+
+# Queries of the current request, only collected when slow queries are captured
+request_queries: ContextVar[Optional[List[Query]]] = ContextVar(
+    "request_queries", default=None
+)
+
+# Server-Timing name and metric name of the request stages
+TIMING_STAGES = {
+    "pool-acquire": "PoolAcquireTime",
+    "sql": "SqlTime",
+    "serialization": "SerializationTime",
+    "compression": "CompressionTime",
+    "total": "RequestTime",
+}
+
+
+def add_timing(stage: str, duration: float) -> None:
+    """Add a duration (in seconds) to a stage of the current request."""
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + duration
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time a block as a stage of the current request."""
+    if request_timings.get() is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Format the timings as a `Server-Timing` header value."""
+    return ", ".join(
+        f"{stage};dur={timings[stage] * 1000:.2f}"
+        for stage in TIMING_STAGES
+        if stage in timings
+    )
+
+
+def record_request_timings(timings: Dict[str, float]) -> None:
+    """Record the timings of a request as metrics."""
+    for stage, name in TIMING_STAGES.items():
+        if stage in timings:
+            metrics.add_metric(
+                name=name, unit=MetricUnit.Milliseconds, value=timings[stage] * 1000
+            )
+
+
+# Duration (ms) of the phases of the last application init
+init_timings: Dict[str, float] = {}
+
+
+@contextmanager
+def init_phase(name: str) -> Iterator[None]:
+    """Time a phase of the application init, recorded as the `Init{name}Time` metric."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = (time.perf_counter() - start) * 1000
+        init_timings[name] = duration
+        logger.info(f"Init phase {name} took {duration:.1f}ms")
+        metrics.add_metric(
+            name=f"Init{name}Time", unit=MetricUnit.Milliseconds, value=duration
+        )
+
+
+def record_pool_acquire(wait: float, age: Optional[float], reconnects: int) -> None:
+    """Record a connection acquisition: its wait and the age of the connection (seconds)."""
+    metrics.add_metric(name="PoolAcquireWait", unit=MetricUnit.Milliseconds, value=wait * 1000)
+    if age is not None:
+        metrics.add_metric(name="ConnectionAge", unit=MetricUnit.Seconds, value=age)
+    if reconnects:
+        metrics.add_metric(name="PoolReconnects", unit=MetricUnit.Count, value=reconnects)
+
+
+class InstrumentedConnection:
+    """Database connection proxy timing the queries, and collecting them for slow requests."""
+
+    query_methods = {
+        "execute",
+        "executemany",
+        "fetch",
+        "fetchval",
+        "fetchrow",
+        "execute_b",
+        "fetch_b",
+        "fetchval_b",
+        "fetchrow_b",
+    }
+
+    def __init__(self, conn: Any) -> None:
+        """Init proxy."""
+        self._conn = conn
+
+    def __getattr__(self, name: str) -> Any:
+        """Forward to the connection, timing the query methods."""
+        attr = getattr(self._conn, name)
+        if name == "cursor":
+
+            def cursor(sql: str, *args, **kwargs):
+                record_query(sql, args, None)
+                return attr(sql, *args, **kwargs)
+
+            return cursor
+
+        if name not in self.query_methods:
+            return attr
+
+        async def query(sql: str, *args, **kwargs):
+            start = time.perf_counter()
+            with timed("sql"):
+                result = await attr(sql, *args, **kwargs)
+            if request_queries.get() is not None and name.endswith("_b"):
+                # buildpg named parameters
+                sql, args = render(sql, **kwargs)
+            record_query(sql, args, time.perf_counter() - start)
+            return result
+
+        return query
+
+
+def record_query(sql: str, args: Any, duration: Optional[float]) -> None:
+    """Add a query to the queries of the current request, when they are collected."""
+    queries = request_queries.get()
+    if queries is not None:
+        queries.append(Query(sql, tuple(args), duration))
+
+
+def slowest_query(queries: List[Query]) -> Optional[Query]:
+    """Query which took the longest, a cursor (streamed) query first."""
+    return max(
+        queries,
+        key=lambda q: math.inf if q.duration is None else q.duration,
+        default=None,
+    )
+
+
+async def explain_query(pool: Any, query: Query, timeout: float) -> Any:
+    """`EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` plan of a query.
+
+    The query runs again, in a read only transaction limited to `timeout` seconds.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction(readonly=True):
+            await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+            plan = await conn.fetchval(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query.sql}", *query.args
+            )
+
+    return orjson.loads(plan) if isinstance(plan, (str, bytes)) else plan
+
+
+def log_slow_query(
+    route: str, collection: str, duration: float, query: Query, plan: Any
+) -> None:
+    """Log the slowest query of a slow request, with its plan when explained."""
+    logger.warning(
+        f"Slow request {route} took {duration * 1000:.0f}ms",
+        extra={
+            "slow_query": {
+                "route": route,
+                "collection": collection,
+                "duration": round(duration * 1000, 3),
+                "query_duration": (
+                    round(query.duration * 1000, 3) if query.duration is not None else None
+                ),
+                "sql": query.sql,
+                "args": [
+                    arg if isinstance(arg, (str, int, float, bool, type(None))) else str(arg)
+                    for arg in query.args
+                ],
+                "plan": plan,
+            }
+        },
+    )
+
+
+class InstrumentedPool:
+    """Database pool proxy timing the connection acquisitions and the queries."""
+
+    def __init__(self, pool: Any) -> None:
+        """Init proxy."""
+        self._pool = pool
+
+    def __getattr__(self, name: str) -> Any:
+        """Forward to the pool."""
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, *args, **kwargs) -> AsyncIterator[InstrumentedConnection]:
+        """Acquire a connection, timing the wait."""
+        start = time.perf_counter()
+        async with self._pool.acquire(*args, **kwargs) as conn:
+            add_timing("pool-acquire", time.perf_counter() - start)
+            yield InstrumentedConnection(conn)
+
+
+class LatencyHistogram:
+    """Latency histogram with fixed log-scale buckets.
+
+    Bucket `i` holds the durations between `MIN_MS * GROWTH ** i` and
+    `MIN_MS * GROWTH ** (i + 1)` milliseconds, i.e. with a relative error under 12%.
+    """
+
+    MIN_MS = 0.1
+    GROWTH = 1.25
+    # 0.1ms to ~2 minutes, in less than the 100 values an EMF metric can hold
+    BUCKETS = 64
+
+    __slots__ = ("counts", "total")
+
+    _log_growth = math.log(GROWTH)
+
+    def __init__(self) -> None:
+        """Init histogram."""
+        self.counts = [0] * self.BUCKETS
+        self.total = 0
+
+    def record(self, duration_ms: float) -> None:
+        """Count a duration in its bucket."""
+        if duration_ms <= self.MIN_MS:
+            index = 0
+        else:
+            index = min(
+                int(math.log(duration_ms / self.MIN_MS) / self._log_growth),
+                self.BUCKETS - 1,
+            )
+        self.counts[index] += 1
+        self.total += 1
+
+    @classmethod
+    def bucket_value(cls, index: int) -> float:
+        """Representative (geometric middle) duration of a bucket."""
+        return cls.MIN_MS * cls.GROWTH ** (index + 0.5)
+
+    def percentile(self, q: float) -> float:
+        """Approximate `q` (0-100) percentile."""
+        rank = q / 100 * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.bucket_value(index)
+        return 0.0
+
+    def values(self) -> Tuple[List[float], List[int]]:
+        """Values and counts of the non empty buckets."""
+        buckets = [(i, count) for i, count in enumerate(self.counts) if count]
+        return (
+            [round(self.bucket_value(i), 3) for i, _ in buckets],
+            [count for _, count in buckets],
+        )
+
+
+class LatencyRecorder:
+    """Latency histograms per route and status class, and per collection for `collections`.
+
+    The histograms are logged as EMF (one document per histogram, with `Values` and
+    `Counts` arrays CloudWatch computes the percentiles from) on `flush`, which happens
+    after each invocation on Lambda or every `flush_interval` seconds in a server. Only
+    the allowed `collections` are a dimension, each one adding a metric per route and
+    status class: the requests of the other collections share the route histograms.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        dimensions: Dict[str, str],
+        flush_interval: int = 60,
+        collections: Collection[str] = (),
+    ) -> None:
+        """Init recorder."""
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.flush_interval = flush_interval
+        self.collections = frozenset(collections)
+        self.histograms: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+        self.flushed_at = time.monotonic()
+
+    def record(self, route: str, status: int, collection: str, duration: float) -> None:
+        """Record the duration (in seconds) of a request."""
+        if collection not in self.collections:
+            collection = ""
+        key = (route, f"{status // 100}xx", collection)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.record(duration * 1000)
+
+        if self.flush_interval and time.monotonic() - self.flushed_at > self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Log the histograms as EMF and reset them."""
+        self.flushed_at = time.monotonic()
+        if not self.histograms:
+            return
+
+        histograms, self.histograms = self.histograms, {}
+        timestamp = int(time.time() * 1000)
+
+        for (route, status, collection), histogram in histograms.items():
+            dimensions = {**self.dimensions, "route": route, "status": status}
+            if collection:
+                dimensions["collection"] = collection
+            values, counts = histogram.values()
+            # The JSON log line, with the document at its top level, is read as EMF
+            logger.info(
+                f"Latency of {route}",
+                extra={
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.namespace,
+                                "Dimensions": [list(dimensions)],
+                                "Metrics": [{"Name": "Latency", "Unit": "Milliseconds"}],
+                            }
+                        ],
+                    },
+                    **dimensions,
+                    "Latency": {"Values": values, "Counts": counts},
+                    "p50": round(histogram.percentile(50), 3),
+                    "p95": round(histogram.percentile(95), 3),
+                    "p99": round(histogram.percentile(99), 3),
+                },
+            )
+
+
+latency_recorder = LatencyRecorder(
+    namespace="veda-backend",
+    dimensions={"environment": settings.stage, "service": "features-api"},
+    # On Lambda the handler flushes after each invocation
+    flush_interval=(
+        0
+        if "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+        else settings.latency_flush_interval
+    ),
+    collections=settings.latency_collections,
+)
 
 
 class LoggerRouteHandler(APIRoute):
@@ -24,6 +406,7 @@ class LoggerRouteHandler(APIRoute):
     def get_route_handler(self) -> Callable:
         """Overide route handler method to add logs, metrics, tracing"""
         original_route_handler = super().get_route_handler()
+        traced_route_handler = tracer.capture_method(original_route_handler)
 
         async def route_handler(request: Request) -> Response:
             # Add fastapi context to logs
@@ -42,7 +425,57 @@ class LoggerRouteHandler(APIRoute):
                 value=1,
             )
             tracer.put_annotation(key="path", value=request.url.path)
-            tracer.capture_method(original_route_handler)(request)
-            return await original_route_handler(request)
+
+            timings = request_timings.get()
+            database = (
+                timings.get("pool-acquire", 0.0) + timings.get("sql", 0.0) if timings else 0.0
+            )
+            start = time.perf_counter()
+            try:
+                return await traced_route_handler(request)
+
+            finally:
+                duration = time.perf_counter() - start
+                if timings is not None:
+                    # Time outside of the database is spent building the response
+                    database = (
+                        timings.get("pool-acquire", 0.0) + timings.get("sql", 0.0) - database
+                    )
+                    add_timing("serialization", duration - database)
 
         return route_handler
+
+
+def record_slow_request() -> None:
+    """Count a request over the slow query budget."""
+    metrics.add_metric(name="SlowRequests", unit=MetricUnit.Count, value=1)
+
+
+def record_catalog_refresh(duration: float, failed: bool = False) -> None:
+    """Record the duration (in seconds) of a catalog refresh, or its failure"""
+    if failed:
+        metrics.add_metric(name="CatalogRefreshFailures", unit=MetricUnit.Count, value=1)
+    else:
+        metrics.add_metric(
+            name="CatalogRefreshDuration",
+            unit=MetricUnit.Milliseconds,
+            value=duration * 1000,
+        )
+
+
+def record_catalog_age(age: float) -> None:
+    """Record the age (in seconds) of the catalog being served"""
+    metrics.add_metric(name="CatalogAge", unit=MetricUnit.Seconds, value=age)
+
+
+def log_latencies(handler: Callable) -> Callable:
+    """Write the latency histograms after each Lambda invocation."""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            latency_recorder.flush()
+
+    return wrapper
@@ -0,0 +1,274 @@
+"""Seed the tile cache of a collection.
+
+usage: python -m src.seed collection_id --bbox -180 -90 180 90 --minzoom 0 --maxzoom 6
+       python -m src.seed collection_id --url https://features.example.com --maxzoom 6
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import httpx
+import orjson
+from morecantile import Tile, TileMatrixSet
+from morecantile import tms as default_tms
+from tipg.database import close_db_connection
+
+from src.app import app, settings, startup
+from src.catalog import collection_version
+
+
+async def render_tile(
+    client: httpx.AsyncClient,
+    collection_id: str,
+    tms_id: str,
+    tile: Tile,
+    query: str = "",
+) -> int:
+    """Request a tile, return the response status."""
+    response = await client.get(
+        f"/collections/{collection_id}/tiles/{tms_id}/{tile.z}/{tile.x}/{tile.y}",
+        params=query,
+    )
+    return response.status_code
+
+
+class Seeder:
+    """Render the tiles of a bbox and zoom range, recording progress in a manifest.
+
+    Tiles are requested with `client`, from a deployed endpoint or from the application
+    itself (`httpx.ASGITransport`).
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        collection_id: str,
+        tms: TileMatrixSet,
+        bbox: Sequence[float],
+        minzoom: int,
+        maxzoom: int,
+        query: str = "",
+        concurrency: int = 4,
+        manifest: Optional[str] = None,
+        version: Optional[str] = None,
+    ) -> None:
+        """Init seeder."""
+        self.client = client
+        self.collection_id = collection_id
+        self.tms = tms
+        self.bbox = list(bbox)
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        self.query = query
+        self.concurrency = concurrency
+        self.manifest = manifest
+        self.version = version
+
+        self.done: List[str] = []
+        self.failed: List[str] = []
+        self.total = 0
+        self.rendered = 0
+        self.started = 0.0
+        self.finished = 0.0
+
+    @property
+    def params(self) -> Dict:
+        """Parameters identifying the seeding job."""
+        return {
+            "collection": self.collection_id,
+            "tileMatrixSet": self.tms.id,
+            "bbox": self.bbox,
+            "minzoom": self.minzoom,
+            "maxzoom": self.maxzoom,
+            "query": self.query,
+            "url": str(self.client.base_url),
+            # tiles rendered from another version of the collection are not in the cache
+            "version": self.version,
+        }
+
+    def tiles(self) -> Iterator[Tile]:
+        """Tiles covering the bbox."""
+        return self.tms.tiles(*self.bbox, zooms=list(range(self.minzoom, self.maxzoom + 1)))
+
+    def resume(self) -> None:
+        """Load the tiles already rendered from the manifest of the same job."""
+        if not self.manifest or not os.path.exists(self.manifest):
+            return
+
+        with open(self.manifest, "rb") as f:
+            previous = orjson.loads(f.read())
+
+        if {k: previous.get(k) for k in self.params} != self.params:
+            print(f"{self.manifest} is from another seeding job, starting over")
+            return
+
+        self.done = previous["done"]
+
+    @property
+    def tiles_per_second(self) -> float:
+        """Rendering rate of this run."""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.rendered / elapsed if elapsed else 0.0
+
+    def write_manifest(self) -> None:
+        """Write the progress of the job."""
+        if not self.manifest:
+            return
+
+        tmp = f"{self.manifest}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {
+                        **self.params,
+                        "total": self.total,
+                        "done": self.done,
+                        "failed": self.failed,
+                        "tiles_per_second": round(self.tiles_per_second, 2),
+                    }
+                )
+            )
+        os.replace(tmp, self.manifest)
+
+    async def run(self, report_interval: float = 5.0) -> None:
+        """Render the missing tiles with `concurrency` workers."""
+        done = set(self.done)
+        self.total = sum(1 for _ in self.tiles())
+        pending = (
+            tile for tile in self.tiles() if f"{tile.z}/{tile.x}/{tile.y}" not in done
+        )
+        self.failed = []
+        self.started = time.monotonic()
+        last_report = self.started
+
+        async def worker():
+            nonlocal last_report
+
+            for tile in pending:
+                name = f"{tile.z}/{tile.x}/{tile.y}"
+                try:
+                    status = await render_tile(
+                        self.client, self.collection_id, self.tms.id, tile, self.query
+                    )
+                except Exception as e:
+                    print(f"{name} failed: {e}")
+                    status = 500
+
+                # 404: tile outside of the collection extent
+                if status in (200, 204, 404):
+                    self.done.append(name)
+                    self.rendered += 1
+                else:
+                    self.failed.append(name)
+
+                if time.monotonic() - last_report > report_interval:
+                    last_report = time.monotonic()
+                    self.write_manifest()
+                    print(
+                        f"{len(self.done)}/{self.total} tiles, "
+                        f"{self.tiles_per_second:.1f} tiles/s"
+                    )
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        self.finished = time.monotonic()
+        self.write_manifest()
+
+
+async def seed(args: argparse.Namespace) -> Seeder:
+    """Seed the tiles, over HTTP or through the application itself."""
+
+    async def run(client: httpx.AsyncClient, version: Optional[str] = None) -> Seeder:
+        seeder = Seeder(
+            client,
+            args.collection,
+            default_tms.get(args.tms),
+            bbox=args.bbox,
+            minzoom=args.minzoom,
+            maxzoom=args.maxzoom,
+            query=args.query,
+            concurrency=args.concurrency,
+            manifest=args.manifest,
+            version=version,
+        )
+        if args.resume:
+            seeder.resume()
+
+        await seeder.run()
+        return seeder
+
+    timeout = httpx.Timeout(args.timeout)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            return await run(client)
+
+    # Seeding must not use more connections than it renders tiles at once
+    await startup(app, pool_size=args.concurrency)
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://seed", timeout=timeout
+        ) as client:
+            return await run(client, collection_version(app, args.collection))
+    finally:
+        await close_db_connection(app)
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("collection", help="Collection identifier.")
+    parser.add_argument("--tms", default="WebMercatorQuad", help="TileMatrixSet identifier.")
+    parser.add_argument(
+        "--url",
+        help=(
+            "Base URL of a deployed API to request the tiles from, warming the caches of "
+            "the instances which answer. Without it, tiles are rendered in process into "
+            "VEDA_FEATURES_TILE_CACHE_DIR."
+        ),
+    )
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        type=float,
+        default=[-180.0, -85.0511, 180.0, 85.0511],
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        help="Bounding box to seed, in WGS84.",
+    )
+    parser.add_argument("--minzoom", type=int, default=0)
+    parser.add_argument("--maxzoom", type=int, required=True)
+    parser.add_argument(
+        "--query", default="", help="Query string of the tile requests, e.g. 'limit=5000'."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of tiles requested at once, and size of the database pool.",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60.0, help="Timeout of a tile request, in seconds."
+    )
+    parser.add_argument("--manifest", help="Path of the progress manifest.")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the tiles already rendered according to the manifest.",
+    )
+    args = parser.parse_args()
+
+    if not args.url and (not settings.tile_cache or not settings.tile_cache_dir):
+        parser.error("seeding needs a --url or VEDA_FEATURES_TILE_CACHE_DIR to be set")
+    if args.resume and not args.manifest:
+        parser.error("--resume needs a --manifest")
+
+    seeder = asyncio.run(seed(args))
+    print(
+        f"Rendered {seeder.rendered} tiles ({len(seeder.done)}/{seeder.total} done, "
+        f"{len(seeder.failed)} failed) at {seeder.tiles_per_second:.1f} tiles/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Build a catalog snapshot from the database.
+
+usage: python -m src.snapshot catalog.json
+"""
+import argparse
+import asyncio
+
+from tipg.database import close_db_connection, connect_to_db
+
+from fastapi import FastAPI
+
+from src.app import db_settings, get_postgres_settings
+from src.catalog import dump_catalog_snapshot, register_collection_catalog
+
+
+async def build_snapshot(output: str) -> int:
+    """Describe every collection and write the snapshot, return the number of collections."""
+    app = FastAPI()
+    await connect_to_db(app, schemas=db_settings.schemas, settings=get_postgres_settings())
+    try:
+        await register_collection_catalog(app, db_settings=db_settings)
+    finally:
+        await close_db_connection(app)
+
+    with open(output, "wb") as f:
+        f.write(
+            dump_catalog_snapshot(
+                app.state.collection_catalog,
+                app.state.catalog_fingerprint,
+                db_settings,
+            )
+        )
+
+    return len(app.state.collection_catalog["collections"])
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", help="Path of the snapshot file to write.")
+    args = parser.parse_args()
+
+    count = asyncio.run(build_snapshot(args.output))
+    print(f"Wrote {count} collections to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Query statistics of the collections, from pg_stat_statements"""
+import re
+from typing import Any, Dict, List
+
+from buildpg import asyncpg
+from tipg.errors import TiPgError
+
+
+class QueryStatisticsUnavailable(TiPgError):
+    """pg_stat_statements is not installed, or not preloaded by the server."""
+
+
+STATISTICS_SCHEMA_SQL = """
+SELECT quote_ident(n.nspname)
+FROM pg_extension e
+JOIN pg_namespace n ON n.oid = e.extnamespace
+WHERE e.extname = 'pg_stat_statements'
+"""
+
+# Statements of the current database grouped by the collection they read and the
+# endpoint type their shape tells, times in milliseconds
+STATEMENT_STATISTICS_SQL = """
+WITH collections AS (
+    SELECT * FROM unnest($1::text[], $2::text[]) AS c(id, pattern)
+),
+statements AS (
+    SELECT
+        c.id AS collection,
+        CASE
+            WHEN s.query ~* 'ST_AsMVT\\(' THEN 'tiles'
+            WHEN s.query ~* '^\\s*SELECT\\s+COUNT\\(\\*\\)' THEN 'count'
+            ELSE 'items'
+        END AS endpoint,
+        s.*
+    FROM {schema}.pg_stat_statements s
+    JOIN collections c ON s.query ~ c.pattern
+    WHERE s.dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+)
+SELECT
+    collection,
+    endpoint,
+    count(*) AS statements,
+    sum(calls)::bigint AS calls,
+    sum(total_exec_time) AS total_time,
+    sum(total_exec_time) / nullif(sum(calls), 0) AS mean_time,
+    max(max_exec_time) AS max_time,
+    sum(rows)::bigint AS rows,
+    sum(shared_blks_hit)::bigint AS shared_blks_hit,
+    sum(shared_blks_read)::bigint AS shared_blks_read
+FROM statements
+GROUP BY collection, endpoint
+ORDER BY total_time DESC
+"""
+
+
+def collection_pattern(collection_id: str) -> str:
+    """PostgreSQL regular expression of a collection read in a statement.
+
+    tipg renders `FROM schema.table` (or `FROM schema.function(...)`), also within the
+    CTE of tiles and the subqueries of the binary outputs; the identifiers may be quoted
+    by other clients.
+    """
+    schema, _, name = collection_id.partition(".")
+    return (
+        r"\mFROM\s+("
+        + re.escape(collection_id)
+        + r"(?!\w)|"
+        + re.escape(f'"{schema}"."{name}"')
+        + ")"
+    )
+
+
+async def collection_statistics(pool: Any, collection_ids: List[str]) -> Dict[str, Any]:
+    """Calls, mean and max time, rows and shared blocks hit/read per collection and endpoint.
+
+    Collections are listed from the one whose statements took the longest in total.
+    """
+    async with pool.acquire() as conn:
+        schema = await conn.fetchval(STATISTICS_SCHEMA_SQL)
+        if schema is None:
+            raise QueryStatisticsUnavailable("pg_stat_statements is not installed")
+
+        try:
+            rows = await conn.fetch(
+                STATEMENT_STATISTICS_SQL.format(schema=schema),
+                collection_ids,
+                [collection_pattern(id) for id in collection_ids],
+            )
+        except asyncpg.PostgresError as e:
+            # e.g. not loaded with shared_preload_libraries
+            raise QueryStatisticsUnavailable(str(e)) from e
+
+    collections: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        hits, reads = row["shared_blks_hit"], row["shared_blks_read"]
+        collections.setdefault(row["collection"], {})[row["endpoint"]] = {
+            "statements": row["statements"],
+            "calls": row["calls"],
+            "mean_time": row["mean_time"],
+            "max_time": row["max_time"],
+            "total_time": row["total_time"],
+            "rows": row["rows"],
+            "shared_blks_hit": hits,
+            "shared_blks_read": reads,
+            "hit_ratio": hits / (hits + reads) if hits + reads else None,
+        }
+
+    return {
+        "collections": [
+            {"id": id, "endpoints": endpoints} for id, endpoints in collections.items()
+        ]
+    }
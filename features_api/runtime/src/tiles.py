@@ -0,0 +1,278 @@
+"""Vector tile cache"""
+import functools
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set
+from urllib.parse import parse_qsl, quote, urlencode
+
+from tipg.resources.enums import MediaType
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.cache import route_path
+from src.catalog import collection_version
+from src.compression import VARIANTS_SCOPE_KEY, CompressedVariants
+from src.monitoring import MetricUnit, logger, metrics
+
+TILE_PATH = re.compile(
+    r"/collections/(?P<collectionId>[^/]+)/tiles/(?P<tileMatrixSetId>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)/?"
+)
+
+
+class TileKey(NamedTuple):
+    """Cached tile identifier."""
+
+    collection: str
+    tms: str
+    z: int
+    x: int
+    y: int
+    # hash of the query parameters and of the collection version
+    filters: str
+
+
+def filter_hash(query_string: str, version: str = "") -> str:
+    """Hash the (sorted) query parameters of a tile request."""
+    query = urlencode(sorted(parse_qsl(query_string, keep_blank_values=True)))
+    return hashlib.blake2b(f"{query}|{version}".encode(), digest_size=12).hexdigest()
+
+
+class TileCache:
+    """Tile cache with an in-memory LRU tier and an optional filesystem tier.
+
+    Both tiers are limited in bytes; the least recently used tiles are evicted first.
+    The memory tier also keeps the compressed tiles, by encoding.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 128 * 1024 * 1024,
+        directory: Optional[str] = None,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+    ) -> None:
+        """Init cache."""
+        self.max_bytes = max_bytes
+        self.memory: "OrderedDict[TileKey, bytes]" = OrderedDict()
+        self.variants: Dict[TileKey, Dict[str, bytes]] = {}
+        self.size = 0
+
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.files: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_size = 0
+        if directory:
+            self._scan_directory()
+
+    def _scan_directory(self) -> None:
+        """Index the tiles already on disk, oldest first."""
+        os.makedirs(self.directory, exist_ok=True)
+
+        tiles = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                tiles.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(tiles):
+            self.files[path] = size
+            self.disk_size += size
+
+        self._evict_disk()
+
+    def path(self, key: TileKey) -> str:
+        """Path of a tile in the filesystem tier."""
+        return os.path.join(
+            self.directory,
+            quote(key.collection, safe=""),
+            quote(key.tms, safe=""),
+            str(key.z),
+            str(key.x),
+            f"{key.y}-{key.filters}.mvt",
+        )
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        """Return a cached tile."""
+        if (content := self.memory.get(key)) is not None:
+            self.memory.move_to_end(key)
+            metrics.add_metric(name="TileCacheHit", unit=MetricUnit.Count, value=1)
+            return content
+
+        if self.directory:
+            path = self.path(key)
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+            except OSError:
+                pass
+            else:
+                if path in self.files:
+                    self.files.move_to_end(path)
+                self._put_memory(key, content)
+                metrics.add_metric(name="TileCacheHit", unit=MetricUnit.Count, value=1)
+                return content
+
+        metrics.add_metric(name="TileCacheMiss", unit=MetricUnit.Count, value=1)
+        return None
+
+    def set(self, key: TileKey, content: bytes) -> None:
+        """Store a tile in both tiers."""
+        self._put_memory(key, content)
+
+        if self.directory and len(content) <= self.max_disk_bytes:
+            path = self.path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename so concurrent readers never see a partial tile
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning(f"Could not write tile {path}: {e}")
+                return
+
+            self.disk_size += len(content) - self.files.pop(path, 0)
+            self.files[path] = len(content)
+            self._evict_disk()
+
+    def add_variant(self, key: TileKey, encoding: str, content: bytes) -> None:
+        """Store a compressed tile of the memory tier."""
+        if key not in self.memory or encoding in self.variants.get(key, {}):
+            return
+
+        self.variants.setdefault(key, {})[encoding] = content
+        self.size += len(content)
+        self._evict_memory()
+
+    def invalidate(self, collection_ids: Set[str]) -> None:
+        """Drop all the tiles of collections."""
+        for key in [key for key in self.memory if key.collection in collection_ids]:
+            self._remove_memory(key)
+
+        if self.directory:
+            for collection_id in collection_ids:
+                directory = os.path.join(self.directory, quote(collection_id, safe=""))
+                prefix = directory + os.sep
+                for path in [path for path in self.files if path.startswith(prefix)]:
+                    self.disk_size -= self.files.pop(path)
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _put_memory(self, key: TileKey, content: bytes) -> None:
+        if len(content) > self.max_bytes:
+            return
+
+        if key in self.memory:
+            self._remove_memory(key)
+
+        self.memory[key] = content
+        self.size += len(content)
+        self._evict_memory()
+
+    def _remove_memory(self, key: TileKey) -> None:
+        self.size -= len(self.memory.pop(key))
+        for content in self.variants.pop(key, {}).values():
+            self.size -= len(content)
+
+    def _evict_memory(self) -> None:
+        while self.size > self.max_bytes:
+            self._remove_memory(next(iter(self.memory)))
+            metrics.add_metric(name="TileCacheEviction", unit=MetricUnit.Count, value=1)
+
+    def _evict_disk(self) -> None:
+        while self.disk_size > self.max_disk_bytes:
+            path, size = self.files.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            metrics.add_metric(name="TileCacheEviction", unit=MetricUnit.Count, value=1)
+
+
+def tile_key(scope: Scope) -> Optional[TileKey]:
+    """Return the cache key of a tile request, if it is one."""
+    matched = TILE_PATH.fullmatch(route_path(scope))
+    if not matched:
+        return None
+
+    collection_id = matched.group("collectionId")
+    return TileKey(
+        collection=collection_id,
+        tms=matched.group("tileMatrixSetId"),
+        z=int(matched.group("z")),
+        x=int(matched.group("x")),
+        y=int(matched.group("y")),
+        filters=filter_hash(
+            scope["query_string"].decode("latin-1"),
+            collection_version(scope["app"], collection_id),
+        ),
+    )
+
+
+class TileCacheMiddleware:
+    """Middleware serving the vector tiles from a TileCache."""
+
+    def __init__(self, app: ASGIApp, cache: TileCache) -> None:
+        """Init Middleware."""
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        """Handle call."""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        key = tile_key(scope)
+        if not key:
+            await self.app(scope, receive, send)
+            return
+
+        if (content := self.cache.get(key)) is not None:
+            self.attach_variants(scope, key)
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", MediaType.mvt.value.encode()),
+                        (b"content-length", str(len(content)).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": content})
+            return
+
+        status = None
+        chunks = []
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            elif message["type"] == "http.response.body" and status == 200:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    self.cache.set(key, b"".join(chunks))
+                    self.attach_variants(scope, key)
+
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def attach_variants(self, scope: Scope, key: TileKey) -> None:
+        """Hand the compressed tiles to the compression middleware."""
+        scope[VARIANTS_SCOPE_KEY] = CompressedVariants(
+            self.cache.variants.get(key, {}),
+            functools.partial(self.cache.add_variant, key),
+        )
@@ -0,0 +1,150 @@
+"""Test the response cache."""
+import time
+
+import httpx
+import pytest
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from src.cache import (
+    CachedResponse,
+    MemoryCacheBackend,
+    ResponseCache,
+    ResponseCacheMiddleware,
+)
+
+
+def create_app(calls) -> Starlette:
+    """Application counting the requests reaching its routes."""
+
+    async def endpoint(request: Request):
+        calls.append(request.url.path)
+        return JSONResponse({"path": request.url.path})
+
+    return Starlette(
+        routes=[Route("/{path:path}", endpoint)],
+        middleware=[Middleware(ResponseCacheMiddleware, cache=ResponseCache())],
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path,cached",
+    [
+        ("/collections", True),
+        ("/collections/public.fires", True),
+        ("/collections/public.fires/items/1", True),
+        ("/other/collections/public.fires", False),
+        ("/collections/public.fires/items/1/extra", False),
+        ("/collections/public.fires/tiles", False),
+    ],
+)
+async def test_cacheable_paths(path, cached):
+    """Only the paths of the collection and items routes are cached."""
+    calls = []
+    transport = httpx.ASGITransport(app=create_app(calls))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for _ in range(2):
+            response = await client.get(path)
+            assert response.status_code == 200
+            assert ("etag" in response.headers) is cached
+
+    assert len(calls) == (1 if cached else 2)
+
+
+@pytest.mark.asyncio
+async def test_cacheable_paths_root_path():
+    """Paths are matched without the root path of the application."""
+    calls = []
+    transport = httpx.ASGITransport(app=create_app(calls), root_path="/api")
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for _ in range(2):
+            await client.get("/api/collections/public.fires")
+            await client.get("/api/other/collections/public.fires")
+
+    assert calls.count("/api/collections/public.fires") == 1
+    assert calls.count("/api/other/collections/public.fires") == 2
+
+
+@pytest.mark.asyncio
+async def test_etag_and_version():
+    """Responses carry an ETag answered with 304, and a new collection version is a miss."""
+    calls = []
+    app = create_app(calls)
+    app.state.catalog_fingerprint = {
+        "tables": {"public.fires": "s1"},
+        "versions": {"public.fires": "v1"},
+        "functions": "",
+    }
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/collections/public.fires/items?limit=1")
+        etag = response.headers["etag"]
+
+        not_modified = await client.get(
+            "/collections/public.fires/items?limit=1",
+            headers={"If-None-Match": f'"other", {etag}'},
+        )
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == etag
+        assert not_modified.content == b""
+        assert len(calls) == 1
+
+        # The rows changed: the route answers again, with the same body
+        app.state.catalog_fingerprint["versions"]["public.fires"] = "v2"
+        response = await client.get(
+            "/collections/public.fires/items?limit=1", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        assert len(calls) == 2
+
+
+def test_invalidate_and_evict():
+    """Invalidation drops the entries of a collection and the lists; LRU eviction."""
+    cache = ResponseCache(max_entries=3)
+
+    def response(tag: str) -> CachedResponse:
+        return CachedResponse(
+            status=200, headers=[], body=b"{}", etag='"e"', expires=1e12, tag=tag
+        )
+
+    cache.put("fires", response("public.fires"))
+    cache.put("fires-items", response("public.fires"))
+    cache.put("list", response(""))
+    cache.invalidate({"public.fires"})
+    assert list(cache.entries) == []
+    assert cache.size == 0
+
+    for key in ("a", "b", "c"):
+        cache.put(key, response(f"public.{key}"))
+    cache.entries.move_to_end("a")
+    cache.put("d", response("public.d"))
+    assert list(cache.entries) == ["c", "a", "d"]
+
+
+@pytest.mark.asyncio
+async def test_shared_backend():
+    """Responses of the shared tier are read back with their validators."""
+    backend = MemoryCacheBackend()
+    first = ResponseCache(backend=backend)
+    await first.set(
+        "key",
+        CachedResponse(
+            status=200,
+            headers=[(b"content-type", b"application/json")],
+            body=b"{}",
+            etag='"e"',
+            expires=time.monotonic() + 60,
+            tag="public.fires",
+        ),
+    )
+
+    cached = await ResponseCache(backend=backend).get("key")
+    assert cached.body == b"{}"
+    assert cached.etag == '"e"'
+    assert cached.headers == [(b"content-type", b"application/json")]
+    assert cached.tag == "public.fires"
@@ -0,0 +1,293 @@
+"""Test the catalog refresh, extents and snapshots, and the lazy catalog."""
+import asyncio
+import contextlib
+import datetime
+
+import pytest
+from asyncpg.exceptions import UndefinedTableError
+from tipg.collections import Catalog, Column, PgCollection
+from tipg.settings import DatabaseSettings
+
+from fastapi import FastAPI
+
+from src import catalog as catalog_module
+from src.catalog import (
+    CatalogFingerprint,
+    describe_collections,
+    diff_fingerprints,
+    dump_catalog_snapshot,
+    get_extents,
+    load_collection_catalog,
+    read_catalog_snapshot,
+    refresh_collection_catalog,
+    register_collection_catalog,
+)
+
+DB_SETTINGS = DatabaseSettings(spatial_extent=False, datetime_extent=False)
+
+
+def fingerprint(**tables) -> CatalogFingerprint:
+    """Fingerprint of tables given as id=(signature, version)."""
+    return CatalogFingerprint(
+        tables={id: signature for id, (signature, _) in tables.items()},
+        versions={id: version for id, (_, version) in tables.items()},
+        spatial=list(tables),
+        sort_keys={},
+        functions="f1",
+    )
+
+
+def collection(id: str) -> PgCollection:
+    """Collection of a table."""
+    schema, table = id.split(".")
+    return PgCollection(type="Table", id=id, table=table, schema=schema)
+
+
+def test_diff_fingerprints():
+    """Changed definitions, and rows with `data`, and removed tables."""
+    previous = fingerprint(**{"public.a": ("s1", "v1"), "public.b": ("s1", "v1")})
+    current = fingerprint(**{"public.a": ("s1", "v2"), "public.c": ("s1", "v1")})
+
+    assert diff_fingerprints(previous, current) == ({"public.c"}, {"public.b"})
+    assert diff_fingerprints(previous, current, data=True) == (
+        {"public.a", "public.c"},
+        {"public.b"},
+    )
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """Application with a catalog of two tables and a fake database."""
+    app = FastAPI()
+    app.state.pool = None
+    app.state.collection_catalog = Catalog(
+        collections={id: collection(id) for id in ("public.a", "public.b")},
+        last_updated=datetime.datetime(2020, 1, 1),
+    )
+    app.state.catalog_fingerprint = fingerprint(
+        **{"public.a": ("s1", "v1"), "public.b": ("s1", "v1")}
+    )
+    app.state.notified = []
+    app.state.catalog_listeners = [app.state.notified.append]
+    app.state.described = []
+
+    async def get_collection_index(pool, db_settings, tables=None, functions=True):
+        app.state.described.append((tables, functions))
+        return [collection(id) for id in tables or []]
+
+    monkeypatch.setattr(catalog_module, "get_collection_index", get_collection_index)
+    return app
+
+
+def database_fingerprint(monkeypatch, current: CatalogFingerprint):
+    """Make the database return a fingerprint."""
+
+    async def get_catalog_fingerprint(pool, db_settings):
+        return current
+
+    monkeypatch.setattr(catalog_module, "get_catalog_fingerprint", get_catalog_fingerprint)
+
+
+@pytest.mark.asyncio
+async def test_refresh_unchanged(app, monkeypatch):
+    """An unchanged fingerprint describes nothing and notifies no listener."""
+    database_fingerprint(
+        monkeypatch, fingerprint(**{"public.a": ("s1", "v1"), "public.b": ("s1", "v1")})
+    )
+    collections = app.state.collection_catalog["collections"]
+
+    assert await refresh_collection_catalog(app, DB_SETTINGS) == set()
+    assert app.state.described == []
+    assert app.state.notified == []
+    assert app.state.collection_catalog["collections"] == collections
+    assert app.state.collection_catalog["last_updated"] > datetime.datetime(2020, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_refresh_changed(app, monkeypatch):
+    """Only the changed tables are described; row changes only notify the listeners."""
+    database_fingerprint(
+        monkeypatch, fingerprint(**{"public.a": ("s2", "v1"), "public.b": ("s1", "v2")})
+    )
+    unchanged = app.state.collection_catalog["collections"]["public.b"]
+
+    assert await refresh_collection_catalog(app, DB_SETTINGS) == {"public.a"}
+    assert app.state.described == [(["public.a"], False)]
+    assert app.state.notified == [{"public.a", "public.b"}]
+    assert app.state.collection_catalog["collections"]["public.b"] is unchanged
+
+
+@pytest.mark.asyncio
+async def test_refresh_removed(app, monkeypatch):
+    """Dropped tables leave the catalog."""
+    database_fingerprint(monkeypatch, fingerprint(**{"public.a": ("s1", "v1")}))
+
+    assert await refresh_collection_catalog(app, DB_SETTINGS) == {"public.b"}
+    assert app.state.described == []
+    assert list(app.state.collection_catalog["collections"]) == ["public.a"]
+    assert app.state.notified == [{"public.b"}]
+
+
+def test_snapshot_round_trip(tmp_path):
+    """A snapshot gives back the catalog and fingerprint it was written from."""
+    geom = Column(
+        name="geom",
+        type="geometry",
+        geometry_type="point",
+        srid=4326,
+        bounds=[-180, -90, 180, 90],
+    )
+    id = Column(name="id", type="int8")
+    fires = PgCollection(
+        type="Table",
+        id="public.fires",
+        table="fires",
+        schema="public",
+        table_columns=[id, geom],
+        properties=[id, geom],
+        id_column=id,
+        geometry_column=geom,
+    )
+    catalog = Catalog(collections={fires.id: fires}, last_updated=datetime.datetime.now())
+    current = fingerprint(**{"public.fires": ("s1", "v1")})
+
+    path = tmp_path / "catalog.json"
+    path.write_bytes(dump_catalog_snapshot(catalog, current, DB_SETTINGS))
+
+    loaded, loaded_fingerprint = read_catalog_snapshot(str(path), DB_SETTINGS)
+    assert loaded_fingerprint == current
+    assert loaded["collections"] == catalog["collections"]
+    assert loaded["collections"]["public.fires"].geometry_column == geom
+
+    # Described with other settings
+    assert read_catalog_snapshot(str(path), DatabaseSettings()) is None
+    # Other format
+    path.write_bytes(path.read_bytes().replace(b'"version":', b'"version":1'))
+    assert read_catalog_snapshot(str(path), DB_SETTINGS) is None
+    assert read_catalog_snapshot(str(tmp_path / "missing.json"), DB_SETTINGS) is None
+
+
+@pytest.mark.asyncio
+async def test_load_snapshot(app, monkeypatch):
+    """Starting from a snapshot only describes the tables changed since it was built."""
+    snapshot = (app.state.collection_catalog, app.state.catalog_fingerprint)
+    app.state.collection_catalog = None
+    app.state.catalog_fingerprint = None
+    database_fingerprint(
+        monkeypatch, fingerprint(**{"public.a": ("s1", "v1"), "public.b": ("s2", "v1")})
+    )
+
+    assert await load_collection_catalog(app, DB_SETTINGS, snapshot=snapshot) == {
+        "public.b"
+    }
+    assert app.state.described == [(["public.b"], False)]
+    assert set(app.state.collection_catalog["collections"]) == {"public.a", "public.b"}
+
+
+@pytest.mark.asyncio
+async def test_lazy_catalog(app, monkeypatch):
+    """A lazy catalog lists the tables and describes them once, when first requested."""
+    app.state.collection_catalog = None
+    app.state.catalog_fingerprint = None
+    database_fingerprint(
+        monkeypatch, fingerprint(**{"public.a": ("s1", "v1"), "public.b": ("s1", "v1")})
+    )
+
+    assert await register_collection_catalog(app, DB_SETTINGS, lazy=True) == {
+        "public.a",
+        "public.b",
+    }
+    # Only the functions are described
+    assert app.state.described == [([], True)]
+    placeholder = app.state.collection_catalog["collections"]["public.a"]
+    assert placeholder.table_columns == []
+
+    await asyncio.gather(
+        *[describe_collections(app, ["public.a"], DB_SETTINGS) for _ in range(3)]
+    )
+    await describe_collections(app, ["public.a", "public.b"], DB_SETTINGS)
+    assert app.state.described[1:] == [(["public.a"], False), (["public.b"], False)]
+    assert app.state.collection_catalog["collections"]["public.a"] is not placeholder
+
+    # Expired
+    await describe_collections(app, ["public.a"], DB_SETTINGS, ttl=0)
+    assert app.state.described[-1] == (["public.a"], False)
+
+    # A changed table is listed again, to be described on its next request
+    database_fingerprint(
+        monkeypatch, fingerprint(**{"public.a": ("s1", "v1"), "public.b": ("s2", "v1")})
+    )
+    assert await refresh_collection_catalog(app, DB_SETTINGS, lazy=True) == {"public.b"}
+    assert "public.b" not in app.state.catalog_described
+    assert "public.a" in app.state.catalog_described
+
+
+class ExtentsPool:
+    """asyncpg pool of a database with an extents store, or without one."""
+
+    def __init__(self, rows=None):
+        """Init pool."""
+        self.rows = rows
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Connection."""
+        yield self
+
+    async def fetch(self, query):
+        """Rows of the extents store."""
+        if self.rows is None:
+            raise UndefinedTableError('relation "features_api.extents" does not exist')
+        return self.rows
+
+
+@pytest.mark.asyncio
+async def test_extents(app, monkeypatch):
+    """Stored extents are set on the columns of the tables, at each refresh."""
+    columns = [
+        Column(name="id", type="int4"),
+        Column(name="geom", type="geometry", geometry_type="point", srid=4326),
+        Column(name="datetime", type="timestamptz"),
+    ]
+    app.state.collection_catalog["collections"]["public.a"] = PgCollection(
+        type="Table",
+        id="public.a",
+        table="a",
+        schema="public",
+        properties=columns,
+        table_columns=columns,
+        id_column=columns[0],
+        geometry_column=columns[1],
+        datetime_column=columns[2],
+    )
+    database_fingerprint(monkeypatch, app.state.catalog_fingerprint)
+    app.state.pool = ExtentsPool(
+        [
+            {
+                "id": "public.a",
+                "column_name": "geom",
+                "bounds": [0.0, 1.0, 2.0, 3.0],
+                "mindt": None,
+                "maxdt": None,
+            },
+            {
+                "id": "public.a",
+                "column_name": "datetime",
+                "bounds": None,
+                "mindt": "2020-01-01T00:00:00+00:00",
+                "maxdt": "2021-01-01T00:00:00+00:00",
+            },
+        ]
+    )
+
+    assert await refresh_collection_catalog(app, DB_SETTINGS, extents=True) == set()
+    described = app.state.collection_catalog["collections"]["public.a"]
+    assert described.bounds == [0.0, 1.0, 2.0, 3.0]
+    assert described.dt_bounds == [
+        "2020-01-01T00:00:00+00:00",
+        "2021-01-01T00:00:00+00:00",
+    ]
+    assert app.state.described == []
+
+    # Databases without the extents store
+    assert await get_extents(ExtentsPool()) == {}
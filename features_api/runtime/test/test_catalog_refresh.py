@@ -0,0 +1,57 @@
+"""Test the background catalog refresh."""
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from fastapi import FastAPI
+
+from src.middleware import BackgroundCatalogUpdateMiddleware
+
+
+@pytest.mark.asyncio
+async def test_background_refresh():
+    """An expired catalog is refreshed once, without blocking the requests."""
+    app = FastAPI()
+    app.state.collection_catalog = {
+        "collections": {},
+        "last_updated": datetime.now() - timedelta(seconds=600),
+    }
+
+    @app.get("/collections")
+    async def collections():
+        return {}
+
+    refreshed = asyncio.Event()
+    calls = []
+
+    async def refresh(app, **kwargs):
+        calls.append(kwargs)
+        await refreshed.wait()
+        app.state.collection_catalog = {"collections": {}, "last_updated": datetime.now()}
+
+    app.add_middleware(BackgroundCatalogUpdateMiddleware, func=refresh, ttl=300, lazy=True)
+    app.middleware_stack = app.build_middleware_stack()
+    middleware = app.middleware_stack
+    while not isinstance(middleware, BackgroundCatalogUpdateMiddleware):
+        middleware = middleware.app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        # Served with the expired catalog while the refresh is running
+        for _ in range(3):
+            response = await asyncio.wait_for(client.get("/collections"), timeout=1)
+            assert response.status_code == 200
+
+        assert calls == [{"lazy": True}]
+        assert not middleware.task.done()
+
+        refreshed.set()
+        await middleware.task
+
+        response = await client.get("/collections")
+        assert response.status_code == 200
+
+    assert len(calls) == 1
+    assert middleware.failed_at is None
@@ -0,0 +1,59 @@
+"""Test the cold start benchmark checks."""
+import os
+import subprocess
+import sys
+
+from benchmarks.cold_start import package_times, regressions, summarize
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _io
+import time:      2000 |       2000 |     tipg.collections
+import time:      1000 |       3000 |   tipg
+import time:       500 |        500 | src.app
+"""
+
+
+def test_package_times():
+    """Self import times are summed by top-level package."""
+    assert package_times(IMPORTTIME) == {"_io": 0.12, "tipg": 3.0, "src": 0.5}
+
+
+def test_regressions():
+    """Durations above the limits or the baseline fail the benchmark."""
+    samples = [
+        {
+            "collections": 2,
+            "import": i,
+            "lifespan": 10 * i,
+            "phases": {"Pool": i},
+            "packages": {"tipg": i, "src": 1},
+        }
+        for i in (100, 300, 200)
+    ]
+    results = summarize(samples)
+    assert (results["import"], results["lifespan"]) == (200, 2000)
+    assert results["phases"] == {"Pool": 200}
+    assert list(results["packages"]) == ["tipg", "src"]
+
+    assert regressions(results) == []
+    assert regressions(results, max_import=150, max_init=2500) == ["import above 150 ms"]
+    baseline = {"import": 190, "lifespan": 1000}
+    assert regressions(results, baseline, max_regression=500) == [
+        "lifespan 2000 ms, 1000 ms in the baseline"
+    ]
+
+
+def test_lazy_imports():
+    """boto3 and pyarrow are not imported with the application."""
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; import src.app; print(sorted({'boto3', 'pyarrow'} & set(sys.modules)))",
+        ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert process.stdout.strip() == "[]"
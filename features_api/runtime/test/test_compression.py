@@ -0,0 +1,98 @@
+"""Test the response compression."""
+import httpx
+import pytest
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from src.cache import ResponseCache, ResponseCacheMiddleware
+from src.compression import CompressionMiddleware
+
+BODY = b'{"features": [' + b",".join([b'{"id": 1}'] * 500) + b"]}"
+
+
+def create_app() -> Starlette:
+    """Cached collection and items routes behind the compression middleware."""
+
+    async def collection(request: Request):
+        return Response(BODY, media_type="application/json")
+
+    async def items(request: Request):
+        if request.query_params.get("f") == "parquet":
+            return Response(BODY, media_type="application/vnd.apache.parquet")
+        return Response(b'{"features": []}', media_type="application/geo+json")
+
+    return Starlette(
+        routes=[
+            Route("/collections/{collectionId}", collection),
+            Route("/collections/{collectionId}/items", items),
+        ],
+        middleware=[
+            Middleware(CompressionMiddleware, encodings=["gzip"]),
+            Middleware(ResponseCacheMiddleware, cache=ResponseCache()),
+        ],
+    )
+
+
+@pytest.mark.asyncio
+async def test_not_modified_validators():
+    """A 304 repeats the validators of the compressed 200."""
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        headers = {"Accept-Encoding": "gzip"}
+        response = await client.get("/collections/public.fires", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"].startswith('W/"')
+        assert response.content == BODY
+
+        not_modified = await client.get(
+            "/collections/public.fires",
+            headers={**headers, "If-None-Match": response.headers["etag"]},
+        )
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == response.headers["etag"]
+        assert not_modified.headers["vary"] == response.headers["vary"]
+
+        # Without a negotiated encoding, the strong ETag
+        response = await client.get(
+            "/collections/public.fires", headers={"Accept-Encoding": "identity"}
+        )
+        assert "content-encoding" not in response.headers
+        assert not response.headers["etag"].startswith("W/")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", ["", "f=parquet"], ids=["small body", "parquet body"])
+async def test_not_modified_uncompressed(query):
+    """A 304 keeps the strong ETag of a response sent uncompressed."""
+    headers = {"Accept-Encoding": "gzip"}
+    url = f"/collections/public.fires/items?{query}"
+
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert "content-encoding" not in response.headers
+        assert not response.headers["etag"].startswith("W/")
+
+        # Revalidated from the cache
+        not_modified = await client.get(
+            url, headers={**headers, "If-None-Match": response.headers["etag"]}
+        )
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == response.headers["etag"]
+        assert "vary" not in not_modified.headers
+
+    # Revalidated by another instance, storing the response
+    transport = httpx.ASGITransport(app=create_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        not_modified = await client.get(
+            url, headers={**headers, "If-None-Match": response.headers["etag"]}
+        )
+        assert not_modified.status_code == 304
+        assert not_modified.headers["etag"] == response.headers["etag"]
+        assert "vary" not in not_modified.headers
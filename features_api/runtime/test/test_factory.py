@@ -0,0 +1,26 @@
+"""Test the endpoints factory."""
+from tipg.factory import Endpoints
+
+from fastapi import FastAPI
+
+from src.factory import FeaturesEndpoints
+
+
+def openapi(endpoints) -> dict:
+    """OpenAPI document of an application with the endpoints."""
+    app = FastAPI()
+    app.include_router(endpoints.router)
+    return app.openapi()
+
+
+def test_wrapped_routes_openapi():
+    """Wrapped routes keep the path, operation id and description of the tipg routes."""
+    tipg = openapi(Endpoints())["paths"]
+    ours = openapi(FeaturesEndpoints())["paths"]
+
+    assert list(ours) == list(tipg)
+    for path, operations in tipg.items():
+        for method, operation in operations.items():
+            for key in ("operationId", "summary", "description", "tags"):
+                assert ours[path][method].get(key) == operation.get(key), (path, key)
+            assert set(ours[path][method]["responses"]) == set(operation["responses"])
@@ -0,0 +1,351 @@
+"""Test the features queries."""
+import contextlib
+
+import orjson
+import pytest
+from buildpg import render
+from tipg.collections import Column, PgCollection
+from tipg.resources.enums import MediaType
+
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from src.dependencies import geometry_options_query
+from src.factory import FeaturesFactory, check_geometry_options
+from src.features import (
+    GeometryOptions,
+    InvalidPageToken,
+    Keyset,
+    Page,
+    UnsupportedParameter,
+    columnar_query,
+    decode_page_token,
+    encode_page_token,
+    features_query,
+    get_keyset,
+    record_batches,
+    seek_predicate,
+    zoom_precision,
+    zoom_tolerance,
+)
+
+COLUMNS = [
+    Column(name="id", type="int4"),
+    Column(name="name", type="text"),
+    Column(name="value", type="float8"),
+]
+
+COLLECTION = PgCollection(
+    type="Table",
+    id="public.t",
+    table="t",
+    schema="public",
+    properties=COLUMNS,
+    table_columns=COLUMNS,
+    id_column=COLUMNS[0],
+)
+
+
+class Connection:
+    """asyncpg connection returning the same rows to every query."""
+
+    def __init__(self, rows):
+        """Init connection."""
+        self.rows = rows
+        self.queries = []
+
+    async def fetchval(self, query, *args):
+        """Number of matched features."""
+        return len(self.rows)
+
+    async def fetch(self, query, *args):
+        """All the rows."""
+        self.queries.append((query, list(args)))
+        return self.rows
+
+    async def cursor(self, query, *args, prefetch):
+        """Rows of a server-side cursor."""
+        self.queries.append((query, list(args)))
+        for row in self.rows:
+            yield row
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, readonly=False):
+        """Transaction."""
+        yield
+
+
+class Pool:
+    """asyncpg pool of a single connection."""
+
+    def __init__(self, rows):
+        """Init pool."""
+        self.connection = Connection(rows)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Connection."""
+        yield self.connection
+
+
+def rows(count: int):
+    """Rows of a `features_query`, sorted by name."""
+    return [
+        {"id": i, "name": f"n{i}", "tipg_id": i, "tipg_geom": None, "tipg_sort": f"n{i}"}
+        for i in range(count)
+    ]
+
+
+def request(factory: FeaturesFactory, pool: Pool, query: str = "", fingerprint=None):
+    """Items request of the public.t collection."""
+    app = FastAPI()
+    app.include_router(factory.router)
+    app.state.pool = pool
+    app.state.catalog_fingerprint = fingerprint
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "app": app,
+            "scheme": "http",
+            "server": ("test", 80),
+            "root_path": "",
+            "path": "/collections/public.t/items",
+            "query_string": query.encode(),
+            "headers": [],
+        }
+    )
+
+
+async def body(response) -> bytes:
+    """Content of a (streaming) response."""
+    if isinstance(response, StreamingResponse):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return response.body
+
+
+def test_keyset_indexed_sort_keys():
+    """Keyset pagination is only used for sort columns leading a btree index."""
+    keyset = get_keyset(COLLECTION, None, ["id", "name"])
+    assert keyset.column.name == "id" and keyset.by_id
+
+    keyset = get_keyset(COLLECTION, "-name", ["id", "name"])
+    assert keyset.column.name == "name" and keyset.descending
+
+    # Unindexed sort column, multiple sort columns or unindexed primary key
+    assert get_keyset(COLLECTION, "value", ["id", "name"]) is None
+    assert get_keyset(COLLECTION, "name,value", ["id", "name"]) is None
+    assert get_keyset(COLLECTION, None, []) is None
+
+
+def test_page_token():
+    """Page tokens hold the sort key, for the `sortby` they were made with."""
+    token = encode_page_token("-name", ["n1", "1"])
+    assert decode_page_token(token, "-name") == ["n1", "1"]
+
+    with pytest.raises(InvalidPageToken):
+        decode_page_token(token, "name")
+    with pytest.raises(InvalidPageToken):
+        decode_page_token("not a token", "-name")
+
+
+def test_seek_predicate():
+    """Features after a sort key, NULLs last when ascending and first when descending."""
+    id, name = COLUMNS[0], COLUMNS[1]
+
+    def predicate(keyset, key):
+        return render(":p", p=seek_predicate(keyset, key))
+
+    assert predicate(Keyset(id, id, False), ["3"]) == ("id > $1::text::int4", ["3"])
+    assert predicate(Keyset(id, id, True), ["3"]) == ("id < $1::text::int4", ["3"])
+    assert predicate(Keyset(name, id, False), ["a", "3"]) == (
+        "ROW(name, id) > ROW($1::text::text, $2::text::int4) OR name is NULL",
+        ["a", "3"],
+    )
+    assert predicate(Keyset(name, id, True), ["a", "3"]) == (
+        "ROW(name, id) < ROW($1::text::text, $2::text::int4)",
+        ["a", "3"],
+    )
+    assert predicate(Keyset(name, id, False), [None, "3"]) == (
+        "name is NULL AND id > $1::text::int4",
+        ["3"],
+    )
+    assert predicate(Keyset(name, id, True), [None, "3"]) == (
+        "name is not NULL OR id < $1::text::int4",
+        ["3"],
+    )
+
+    query, args = features_query(
+        COLLECTION,
+        sortby="name",
+        keyset=Keyset(name, id, False),
+        after=["a", "3"],
+        limit=5,
+        offset=10,
+    )
+    assert "ORDER BY name, id" in query
+    # the page starts after the sort key, not at the offset
+    assert args[-4:] == ["a", "3", 5, 0]
+
+
+@pytest.mark.asyncio
+async def test_record_batches():
+    """Rows are read by batches from a cursor, or at once.
+
+    Rows over the limit are not returned, they mark a next page.
+    """
+    pool = Pool(rows(5))
+    batches = [b async for b in record_batches(pool, "q", [], batch_size=2)]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+    page = Page()
+    batches = [
+        b async for b in record_batches(pool, "q", [], batch_size=2, limit=4, page=page)
+    ]
+    assert [len(batch) for batch in batches] == [2, 2]
+    assert page.returned == 4 and page.more
+
+    page = Page()
+    batches = [
+        b async for b in record_batches(pool, "q", [], batch_size=0, limit=4, page=page)
+    ]
+    assert [len(batch) for batch in batches] == [4]
+    assert page.returned == 4 and page.more
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "output_type", [MediaType.geojson, MediaType.geojsonseq, MediaType.ndjson]
+)
+async def test_streamed_items(output_type):
+    """Streamed items are the same as the items read at once."""
+    contents = []
+    for stream_batch_size in (0, 2):
+        factory = FeaturesFactory(
+            collections_dependency=lambda: None,
+            collection_dependency=lambda: None,
+            with_common=False,
+            stream_batch_size=stream_batch_size,
+        )
+        response = await factory.items_response(
+            request(factory, Pool(rows(5)), "limit=10"),
+            COLLECTION,
+            limit=10,
+            output_type=output_type,
+        )
+        assert isinstance(response, StreamingResponse) == bool(stream_batch_size)
+        contents.append(await body(response))
+
+    assert contents[0] == contents[1]
+    if output_type == MediaType.geojson:
+        collection = orjson.loads(contents[0])
+        assert collection["numberMatched"] == collection["numberReturned"] == 5
+        assert [f["id"] for f in collection["features"]] == [0, 1, 2, 3, 4]
+    else:
+        assert len(contents[0].splitlines()) == 5
+
+
+@pytest.mark.asyncio
+async def test_keyset_next_link():
+    """Keyset paginated pages link to the next one with a token, the last one does not."""
+    factory = FeaturesFactory(
+        collections_dependency=lambda: None,
+        collection_dependency=lambda: None,
+        with_common=False,
+        keyset_pagination=True,
+    )
+    fingerprint = {"sort_keys": {"public.t": ["id", "name"]}}
+
+    pool = Pool(rows(3))
+    response = await factory.items_response(
+        request(factory, pool, "sortby=name&limit=2&offset=4", fingerprint),
+        COLLECTION,
+        sortby="name",
+        limit=2,
+        offset=4,
+    )
+    collection = orjson.loads(await body(response))
+    assert collection["numberReturned"] == 2
+    (link,) = [link for link in collection["links"] if link["rel"] == "next"]
+    token = encode_page_token("name", ["n1", "1"])
+    assert link["href"] == (
+        f"http://test/collections/public.t/items?sortby=name&limit=2&token={token}"
+    )
+    # One more feature than the limit is read, to tell if there is a next page
+    query, args = pool.connection.queries[-1]
+    assert "ORDER BY name, id" in query
+    assert args[-2:] == [3, 4]
+
+    pool = Pool(rows(2))
+    response = await factory.items_response(
+        request(factory, pool, f"sortby=name&limit=2&token={token}", fingerprint),
+        COLLECTION,
+        sortby="name",
+        limit=2,
+        token=token,
+    )
+    collection = orjson.loads(await body(response))
+    assert collection["numberReturned"] == 2
+    assert [link["rel"] for link in collection["links"]] == ["collection", "self"]
+    query, args = pool.connection.queries[-1]
+    assert "ROW(name, id) > ROW(" in query
+    assert args[-4:] == ["n1", "1", 3, 0]
+
+    with pytest.raises(InvalidPageToken):
+        await factory.items_response(
+            request(factory, pool, f"sortby=id&token={token}", fingerprint),
+            COLLECTION,
+            sortby="id",
+            token=token,
+        )
+
+
+def test_zoom_geometry_options():
+    """A zoom level gives a pixel tolerance and the digits resolving a tenth of a pixel."""
+    assert zoom_tolerance(0) == 360 / 256
+    assert zoom_tolerance(1) == zoom_tolerance(0) / 2
+    assert [zoom_precision(zoom) for zoom in (0, 10, 20)] == [1, 4, 7]
+
+    assert geometry_options_query() == GeometryOptions()
+    assert geometry_options_query(zoom=10) == GeometryOptions(zoom_tolerance(10), 4)
+    # Explicit options win over the zoom
+    assert geometry_options_query(0.5, 10, 2) == GeometryOptions(0.5, 2)
+
+    with pytest.raises(UnsupportedParameter):
+        check_geometry_options(GeometryOptions(precision=2), MediaType.csv)
+    check_geometry_options(GeometryOptions(), MediaType.csv)
+
+
+def test_geometry_options_queries():
+    """Geometries are simplified and their coordinates rounded, or quantized."""
+    geom = Column(name="geom", type="geometry", geometry_type="polygon", srid=4326)
+    collection = PgCollection(
+        type="Table",
+        id="public.t",
+        table="t",
+        schema="public",
+        properties=[*COLUMNS, geom],
+        table_columns=[*COLUMNS, geom],
+        id_column=COLUMNS[0],
+        geometry_column=geom,
+    )
+    options = GeometryOptions(tolerance=0.01, precision=3)
+
+    query, args = features_query(collection, geometry_options=options)
+    assert "ST_AsGeoJSON(ST_SimplifyPreserveTopology(" in query
+    assert 0.01 in args and 3 in args
+
+    query, args = features_query(collection, geom_as_wkt=True, geometry_options=options)
+    assert "ST_AsEWKT(ST_SimplifyPreserveTopology(" in query
+
+    query, args = columnar_query(collection, geometry_options=options)
+    assert "ST_AsBinary(ST_QuantizeCoordinates(ST_SimplifyPreserveTopology(" in query
+
+    # Bounding boxes are not simplified
+    query, args = features_query(collection, bbox_only=True, geometry_options=options)
+    assert "ST_SimplifyPreserveTopology" not in query
+
+    query, args = features_query(collection)
+    assert "ST_SimplifyPreserveTopology" not in query
+    assert "ST_AsGeoJSON(" in query
@@ -0,0 +1,139 @@
+"""Test the binary items outputs."""
+import contextlib
+import io
+
+import pytest
+from tipg.collections import Column, PgCollection
+
+from fastapi import FastAPI
+from starlette.requests import Request
+
+from src.factory import FeaturesFactory
+from src.formats import BinaryMediaType
+
+COLUMNS = [
+    Column(name="id", type="int4"),
+    Column(name="name", type="text"),
+    Column(name="value", type="numeric"),
+    Column(name="geom", type="geometry", geometry_type="point", srid=4326),
+]
+
+COLLECTION = PgCollection(
+    type="Table",
+    id="public.t",
+    table="t",
+    schema="public",
+    properties=COLUMNS,
+    table_columns=COLUMNS,
+    id_column=COLUMNS[0],
+    geometry_column=COLUMNS[3],
+)
+
+# POINT(1 2)
+POINT = bytes.fromhex("0101000000000000000000f03f0000000000000040")
+
+ROWS = [
+    {"id": 1, "name": "a", "value": 1.5, "tipg_geom": POINT},
+    {"id": 2, "name": None, "value": None, "tipg_geom": None},
+]
+
+
+class Connection:
+    """asyncpg connection returning the same rows, or value, to every query."""
+
+    def __init__(self, rows, value=None):
+        """Init connection."""
+        self.rows = rows
+        self.value = value
+
+    async def fetchval(self, query, *args):
+        """The value."""
+        return self.value
+
+    async def cursor(self, query, *args, prefetch):
+        """Rows of a server-side cursor."""
+        for row in self.rows:
+            yield row
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, readonly=False):
+        """Transaction."""
+        yield
+
+
+class Pool:
+    """asyncpg pool of a single connection."""
+
+    def __init__(self, rows, value=None):
+        """Init pool."""
+        self.connection = Connection(rows, value)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Connection."""
+        yield self.connection
+
+
+async def items(output_type: BinaryMediaType, pool: Pool):
+    """Binary items response of the public.t collection."""
+    factory = FeaturesFactory(
+        collections_dependency=lambda: None,
+        collection_dependency=lambda: None,
+        with_common=False,
+    )
+    app = FastAPI()
+    app.state.pool = pool
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "app": app,
+            "path": "/collections/public.t/items",
+            "query_string": b"",
+            "headers": [],
+        }
+    )
+    return await factory.binary_items_response(
+        request, COLLECTION, output_type=output_type
+    )
+
+
+@pytest.mark.asyncio
+async def test_arrow():
+    """Arrow IPC stream of typed columns and a WKB geometry."""
+    pyarrow = pytest.importorskip("pyarrow")
+    response = await items(BinaryMediaType.arrow, Pool(ROWS))
+    assert response.media_type == BinaryMediaType.arrow
+    assert response.headers["content-disposition"] == "attachment;filename=items.arrow"
+
+    table = pyarrow.ipc.open_stream(response.body).read_all()
+    assert table.schema.names == ["id", "name", "value", "geometry"]
+    assert str(table.schema.field("id").type) == "int32"
+    assert str(table.schema.field("value").type) == "double"
+    assert table.to_pylist() == [
+        {"id": 1, "name": "a", "value": 1.5, "geometry": POINT},
+        {"id": 2, "name": None, "value": None, "geometry": None},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_parquet():
+    """GeoParquet with its `geo` metadata."""
+    pyarrow = pytest.importorskip("pyarrow")
+    response = await items(BinaryMediaType.parquet, Pool(ROWS))
+    assert response.media_type == BinaryMediaType.parquet
+
+    table = pyarrow.parquet.read_table(io.BytesIO(response.body))
+    assert table.column("geometry").to_pylist() == [POINT, None]
+    assert b'"primary_column":"geometry"' in table.schema.metadata[b"geo"]
+
+
+@pytest.mark.asyncio
+async def test_flatgeobuf():
+    """FlatGeobuf built by PostGIS, no content when no feature matched."""
+    response = await items(BinaryMediaType.fgb, Pool([], value=b"fgb"))
+    assert response.media_type == BinaryMediaType.fgb
+    assert response.body == b"fgb"
+
+    response = await items(BinaryMediaType.fgb, Pool([]))
+    assert response.status_code == 204
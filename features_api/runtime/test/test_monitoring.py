@@ -0,0 +1,91 @@
+"""Test the latency histograms."""
+import httpx
+import pytest
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from src.cache import ResponseCache, ResponseCacheMiddleware
+from src.middleware import LatencyMiddleware
+from src.monitoring import LatencyRecorder, logger
+
+
+def test_latency_recorder(monkeypatch):
+    """Histograms are logged as EMF, with a collection dimension for allowed collections."""
+    logged = []
+    monkeypatch.setattr(logger, "info", lambda msg, extra=None: logged.append(extra))
+
+    recorder = LatencyRecorder(
+        namespace="test",
+        dimensions={"service": "features-api"},
+        flush_interval=0,
+        collections=["public.fires"],
+    )
+    route = "/collections/{collectionId}/items"
+    recorder.record(route, 200, "public.fires", 0.01)
+    recorder.record(route, 200, "public.roads", 0.02)
+    recorder.record(route, 200, "public.lakes", 0.2)
+    recorder.record(route, 404, "public.lakes", 0.001)
+    recorder.flush()
+
+    documents = {(doc["status"], doc.get("collection")): doc for doc in logged}
+    assert set(documents) == {("2xx", "public.fires"), ("2xx", None), ("4xx", None)}
+
+    fires = documents[("2xx", "public.fires")]
+    assert fires["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["service", "route", "status", "collection"]
+    ]
+    assert sum(fires["Latency"]["Counts"]) == 1
+
+    others = documents[("2xx", None)]
+    assert others["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["service", "route", "status"]
+    ]
+    assert others["route"] == route
+    assert sum(others["Latency"]["Counts"]) == 2
+
+    logged.clear()
+    recorder.flush()
+    assert logged == []
+
+
+@pytest.mark.asyncio
+async def test_latency_of_cached_responses():
+    """Responses of the cache are recorded with the template of their route."""
+    calls = []
+
+    async def collection(request: Request):
+        calls.append(request.path_params["collectionId"])
+        return Response(b'{"id": "public.fires"}', media_type="application/json")
+
+    recorder = LatencyRecorder(namespace="test", dimensions={}, flush_interval=0)
+    app = Starlette(
+        routes=[Route("/collections/{collectionId}", collection)],
+        middleware=[
+            Middleware(LatencyMiddleware, recorder=recorder),
+            Middleware(ResponseCacheMiddleware, cache=ResponseCache()),
+        ],
+    )
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/collections/public.fires")
+        cached = await client.get("/collections/public.fires")
+        assert cached.status_code == 200
+        not_modified = await client.get(
+            "/collections/public.fires",
+            headers={"If-None-Match": response.headers["etag"]},
+        )
+        assert not_modified.status_code == 304
+        # No route: not recorded
+        assert (await client.get("/tiles")).status_code == 404
+
+    assert calls == ["public.fires"]
+    histograms = {key: h.total for key, h in recorder.histograms.items()}
+    assert histograms == {
+        ("/collections/{collectionId}", "2xx", ""): 2,
+        ("/collections/{collectionId}", "3xx", ""): 1,
+    }
@@ -0,0 +1,67 @@
+"""Test the tile seeder."""
+import httpx
+import orjson
+import pytest
+from morecantile import tms as default_tms
+
+from fastapi import FastAPI, Request, Response
+
+from src.seed import Seeder
+
+
+def create_client(requested) -> httpx.AsyncClient:
+    """Client of an API answering every tile request with an empty tile."""
+    app = FastAPI()
+
+    @app.get("/collections/{collectionId}/tiles/{tileMatrixSetId}/{z}/{x}/{y}")
+    async def tile(request: Request, collectionId: str, z: int, x: int, y: int):
+        requested.append((collectionId, f"{z}/{x}/{y}", str(request.query_params)))
+        return Response(status_code=204)
+
+    transport = httpx.ASGITransport(app=app)
+    return httpx.AsyncClient(transport=transport, base_url="https://features.test")
+
+
+@pytest.mark.asyncio
+async def test_seed_resume(tmp_path):
+    """Tiles are requested once, a resumed job skips the tiles of the manifest."""
+    manifest = str(tmp_path / "seed.json")
+    requested = []
+    async with create_client(requested) as client:
+        seeder = Seeder(
+            client,
+            "public.fires",
+            default_tms.get("WebMercatorQuad"),
+            bbox=[-180, -85, 180, 85],
+            minzoom=0,
+            maxzoom=2,
+            query="limit=100",
+            concurrency=3,
+            manifest=manifest,
+        )
+        await seeder.run()
+
+        assert seeder.total == 21
+        assert sorted(name for _, name, _ in requested) == sorted(seeder.done)
+        assert {(id, query) for id, _, query in requested} == {
+            ("public.fires", "limit=100")
+        }
+        with open(manifest, "rb") as f:
+            assert orjson.loads(f.read())["url"] == "https://features.test"
+
+        requested.clear()
+        resumed = Seeder(
+            client,
+            "public.fires",
+            default_tms.get("WebMercatorQuad"),
+            bbox=[-180, -85, 180, 85],
+            minzoom=0,
+            maxzoom=2,
+            query="limit=100",
+            manifest=manifest,
+        )
+        resumed.resume()
+        await resumed.run()
+
+        assert requested == []
+        assert len(resumed.done) == 21
@@ -0,0 +1,132 @@
+"""Test the capture of slow queries."""
+import asyncio
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+
+from fastapi import FastAPI, Request
+
+from src.factory import FeaturesEndpoints
+from src.middleware import SlowQueryMiddleware
+from src.monitoring import InstrumentedPool, logger
+
+PLAN = [{"Plan": {"Node Type": "Seq Scan"}}]
+
+
+class Connection:
+    """Connection running every query in 50ms."""
+
+    def __init__(self, executed):
+        self.executed = executed
+
+    async def fetch(self, sql, *args):
+        await asyncio.sleep(0.05)
+        self.executed.append(sql)
+        return []
+
+    async def fetchval(self, sql, *args):
+        self.executed.append(sql)
+        return PLAN
+
+    async def execute(self, sql, *args):
+        self.executed.append(sql)
+
+    @asynccontextmanager
+    async def transaction(self, readonly=False):
+        assert readonly
+        yield
+
+
+class Pool:
+    """Pool of Connection."""
+
+    def __init__(self):
+        self.executed = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield Connection(self.executed)
+
+
+def create_app(**kwargs) -> SlowQueryMiddleware:
+    """Application with an items and a collection route named as tipg names them."""
+    app = FastAPI()
+    app.state.pool = InstrumentedPool(Pool())
+
+    @app.get("/collections/{collectionId}/items", name="items")
+    async def items(request: Request, collectionId: str):
+        async with request.app.state.pool.acquire() as conn:
+            await conn.fetch("SELECT * FROM public.fires WHERE id = $1", 3)
+        return {}
+
+    @app.get("/collections/{collectionId}", name="collection")
+    async def collection(request: Request, collectionId: str):
+        async with request.app.state.pool.acquire() as conn:
+            await conn.fetch("SELECT 1")
+        return {}
+
+    return SlowQueryMiddleware(app, budget=0.01, sample_rate=1.0, **kwargs)
+
+
+@pytest.fixture
+def warnings(monkeypatch):
+    """Slow query warnings."""
+    logged = []
+    monkeypatch.setattr(
+        logger, "warning", lambda msg, extra=None: logged.append(extra["slow_query"])
+    )
+    return logged
+
+
+def test_default_routes():
+    """The default routes are the items and tile routes of the endpoints."""
+    endpoints = FeaturesEndpoints()
+    names = {
+        route.name
+        for router in (endpoints.ogc_features.router, endpoints.ogc_tiles.router)
+        for route in router.routes
+    }
+    assert set(SlowQueryMiddleware.__init__.__kwdefaults__["routes"]) <= names
+
+
+@pytest.mark.asyncio
+async def test_slow_items_request(warnings):
+    """The plan of the slowest query of a slow items request is logged."""
+    middleware = create_app()
+    transport = httpx.ASGITransport(app=middleware)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/collections/public.fires/items")
+        assert response.status_code == 200
+        await middleware.task
+
+        # Not an items or tile route
+        response = await client.get("/collections/public.fires")
+        assert response.status_code == 200
+
+    assert len(warnings) == 1
+    slow_query = warnings[0]
+    assert slow_query["route"] == "/collections/{collectionId}/items"
+    assert slow_query["collection"] == "public.fires"
+    assert slow_query["sql"] == "SELECT * FROM public.fires WHERE id = $1"
+    assert slow_query["args"] == [3]
+    assert slow_query["plan"] == PLAN
+
+
+@pytest.mark.asyncio
+async def test_slow_request_explained_inline(warnings):
+    """Without background task, the plan is logged before the request returns."""
+    middleware = create_app(background=False)
+    transport = httpx.ASGITransport(app=middleware)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/collections/public.fires/items")
+        assert response.status_code == 200
+
+    assert middleware.task is None
+    assert len(warnings) == 1
+    assert warnings[0]["plan"] == PLAN
+    executed = middleware.app.state.pool.executed
+    assert executed.index("SELECT * FROM public.fires WHERE id = $1") < executed.index(
+        "SET LOCAL statement_timeout = 10000"
+    )
+    assert executed[-1].startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT")
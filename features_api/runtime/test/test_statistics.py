@@ -0,0 +1,84 @@
+"""Test the query statistics."""
+import re
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import morecantile
+import pytest
+from tipg.collections import Column, PgCollection
+
+from src.features import columnar_query, features_query
+from src.statistics import collection_pattern
+
+COLUMNS = [
+    Column(name="id", type="int4"),
+    Column(name="name", type="text"),
+    Column(name="geom", type="geometry", geometry_type="point", srid=4326),
+]
+
+COLLECTION = PgCollection(
+    type="Table",
+    id="public.fires",
+    table="fires",
+    schema="public",
+    properties=COLUMNS,
+    table_columns=COLUMNS,
+    id_column=COLUMNS[0],
+    geometry_column=COLUMNS[2],
+)
+
+
+class Connection:
+    """Connection keeping the queries it runs."""
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    async def fetchval(self, sql, *args):
+        self.queries.append(sql)
+        return b""
+
+
+class Pool:
+    """Pool of Connection."""
+
+    def __init__(self):
+        self.queries = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield Connection(self.queries)
+
+
+def matches(collection_id: str, query: str) -> bool:
+    """Whether PostgreSQL would match the pattern of a collection (`\\m` is `\\b`)."""
+    return re.search(collection_pattern(collection_id).replace(r"\m", r"\b"), query) is not None
+
+
+@pytest.mark.asyncio
+async def test_collection_pattern():
+    """Statements are attributed to the collections they read, as tipg renders them."""
+    pool = Pool()
+    async with pool.acquire() as conn:
+        await COLLECTION._features_count_query(conn, function_parameters=None)
+
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(pool=pool)))
+    await COLLECTION.get_tile(
+        request,
+        tms=morecantile.tms.get("WebMercatorQuad"),
+        tile=morecantile.Tile(0, 0, 0),
+    )
+    count, tile = pool.queries
+
+    items, _ = features_query(COLLECTION, limit=10)
+    flatgeobuf, _ = columnar_query(COLLECTION, flatgeobuf=True)
+
+    for query in (count, tile, items, flatgeobuf):
+        assert matches("public.fires", query), query
+        assert not matches("public.fire", query)
+        assert not matches("public.fires_2", query)
+
+    assert re.search(r"^\s*WITH", tile) and matches("public.fires", tile)
+    assert matches("public.Fires", 'SELECT * FROM "public"."Fires" WHERE id = $1')
+    assert matches("public.fires_2", "SELECT * FROM public.fires_2()")
+    assert not matches("public.fires", "SELECT * FROM public.fires_2")
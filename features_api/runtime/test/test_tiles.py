@@ -0,0 +1,116 @@
+"""Test the vector tile cache."""
+import os
+
+import httpx
+import pytest
+
+from fastapi import FastAPI, Response
+
+from src.tiles import TileCache, TileCacheMiddleware, TileKey, tile_key
+
+
+def key(y: int, collection: str = "public.fires") -> TileKey:
+    """Key of a tile at zoom 1."""
+    return TileKey(collection, "WebMercatorQuad", 1, 0, y, "filters")
+
+
+def test_memory_tier():
+    """Tiles are missed, hit, then evicted least recently used first."""
+    cache = TileCache(max_bytes=10)
+    assert cache.get(key(0)) is None
+
+    cache.set(key(0), b"aaaa")
+    cache.set(key(1), b"bbbb")
+    assert cache.get(key(0)) == b"aaaa"
+
+    cache.set(key(2), b"cccc")
+    assert list(cache.memory) == [key(0), key(2)]
+    assert cache.size == 8
+
+    # Compressed tiles count in the memory limit
+    cache.add_variant(key(2), "gzip", b"cc")
+    cache.add_variant(key(2), "br", b"c")
+    assert list(cache.memory) == [key(2)]
+    assert cache.size == 7
+
+    # Larger than the whole tier
+    cache.set(key(3), b"d" * 11)
+    assert cache.get(key(3)) is None
+
+
+def test_disk_tier(tmp_path):
+    """Tiles are read back from disk, by a new cache too, and invalidated."""
+    directory = str(tmp_path / "tiles")
+    cache = TileCache(max_bytes=4, directory=directory, max_disk_bytes=8)
+    cache.set(key(0), b"aaaa")
+    cache.set(key(1), b"bbbb")
+    cache.set(key(0, collection="public.roads"), b"cccc")
+
+    # Evicted from memory and from disk, oldest first
+    assert cache.get(key(0)) is None
+    assert cache.get(key(1)) == b"bbbb"
+    assert cache.disk_size == 8
+
+    restarted = TileCache(directory=directory)
+    assert restarted.get(key(1)) == b"bbbb"
+    assert restarted.disk_size == 8
+
+    restarted.invalidate({"public.fires"})
+    assert restarted.get(key(1)) is None
+    assert restarted.disk_size == 4
+    assert not os.path.exists(os.path.join(directory, "public.fires"))
+    assert restarted.get(key(0, collection="public.roads")) == b"cccc"
+
+
+def test_tile_key():
+    """Only the tile requests below the root path are cached, by query and version."""
+    app = FastAPI()
+    app.state.catalog_fingerprint = {
+        "tables": {"public.fires": "s1"},
+        "versions": {"public.fires": "v1"},
+        "functions": "",
+    }
+
+    def scope(path: str, query: bytes = b"", root_path: str = ""):
+        return {"app": app, "path": path, "root_path": root_path, "query_string": query}
+
+    tile = "/collections/public.fires/tiles/WebMercatorQuad/1/0/1"
+    assert tile_key(scope(tile)) == tile_key(scope("/api" + tile, root_path="/api"))
+    assert tile_key(scope(tile))[:5] == ("public.fires", "WebMercatorQuad", 1, 0, 1)
+    assert tile_key(scope("/other" + tile)) is None
+    assert tile_key(scope(tile + "/extra")) is None
+
+    assert tile_key(scope(tile, b"a=1&b=2")) == tile_key(scope(tile, b"b=2&a=1"))
+    assert tile_key(scope(tile, b"a=1")) != tile_key(scope(tile, b"a=2"))
+
+    before = tile_key(scope(tile))
+    app.state.catalog_fingerprint["versions"]["public.fires"] = "v2"
+    assert tile_key(scope(tile)) != before
+
+
+@pytest.mark.asyncio
+async def test_middleware():
+    """Tiles are rendered once, then answered from the cache."""
+    rendered = []
+    app = FastAPI()
+
+    @app.get("/collections/{collectionId}/tiles/{tileMatrixSetId}/{z}/{x}/{y}")
+    async def tile(collectionId: str, z: int, x: int, y: int):
+        rendered.append((z, x, y))
+        return Response(b"tile", media_type="application/vnd.mapbox-vector-tile")
+
+    app.add_middleware(TileCacheMiddleware, cache=TileCache())
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for _ in range(2):
+            response = await client.get(
+                "/collections/public.fires/tiles/WebMercatorQuad/1/0/1"
+            )
+            assert response.status_code == 200
+            assert response.content == b"tile"
+            assert response.headers["content-type"] == (
+                "application/vnd.mapbox-vector-tile"
+            )
+
+    assert rendered == [(1, 0, 1)]
@@ -58,6 +58,20 @@ class FeaturesDBSettings(BaseSettings):
         description="maximum number of temporary buffers used by each session",
         pattern=r"^[1-9]\d*$",
     )
+    shared_preload_libraries: Optional[str] = Field(
+        "pg_stat_statements",
+        description=(
+            "Libraries loaded at server start, pg_stat_statements backs the query "
+            "statistics of the features API (changing it needs a reboot)"
+        ),
+    )
+    index_dry_run: Optional[bool] = Field(
+        False,
+        description=(
+            "Boolean if the bootstrap should only report the missing indexes of the "
+            "geometry and datetime columns instead of creating them"
+        ),
+    )
     use_rds_proxy: Optional[bool] = Field(
         False,
         description="Boolean if the RDS should be accessed through a proxy",
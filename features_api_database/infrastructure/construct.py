@@ -51,7 +51,8 @@ class BootstrapTIPG(Construct):
                 path=os.path.abspath("./"),
                 file="features_api_database/runtime/Dockerfile",
             ),
-            timeout=Duration.minutes(2),
+            # concurrent index builds of the index stage can take a while
+            timeout=Duration.minutes(15),
             vpc=database.vpc,
             log_retention=aws_logs.RetentionDays.ONE_WEEK,
         )
@@ -76,6 +77,9 @@ class BootstrapTIPG(Construct):
             description=f"TIPG database bootsrapped by {Stack.of(self).stack_name} stack",
         )
 
+        # The index stage can also be invoked on demand: {"action": "index", "dry_run": true}
+        handler.add_environment("NEW_USER_SECRET_ARN", self.secret.secret_arn)
+
         # Allow lambda to...
         # read new user secret
         self.secret.grant_read(handler)
@@ -96,6 +100,8 @@ class BootstrapTIPG(Construct):
                 # property to update the lambda that triggers bootstrapping
                 # check here: https://stackoverflow.com/a/74727589
                 "database_schema_version": database_schema_version,
+                # only report the missing indexes instead of creating them
+                "index_dry_run": str(features_db_settings.index_dry_run).lower(),
             },
             removal_policy=RemovalPolicy.RETAIN,  # This retains the custom resource (which doesn't really exist), not the database
         )
@@ -149,6 +155,7 @@ class FeaturesRdsConstruct(Construct):
                 "work_mem": features_db_settings.work_mem,
                 "temp_buffers": features_db_settings.temp_buffers,
                 "random_page_cost": features_db_settings.random_page_cost,
+                "shared_preload_libraries": features_db_settings.shared_preload_libraries,
             },
         )
 
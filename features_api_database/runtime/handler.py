@@ -3,6 +3,8 @@ Custom resource lambda handler to bootstrap Postgres db.
 Source: https://github.com/developmentseed/eoAPI/blob/master/deployment/handlers/db_handler.py
 """
 import json
+import os
+from typing import Dict, List, Sequence
 
 import boto3
 import psycopg
@@ -141,10 +143,426 @@ def add_SRID_9311(cursor) -> None:
     )
 
 
+# Extents of the collections, read by the features API catalog in one query instead of
+# scanning every table. `refresh_extents` computes them for a table (e.g. after a load),
+# `refresh_all_extents` for the tables of some schemas, and the triggers installed by
+# `track_extents` extend them as rows are inserted or updated; deleted rows only shrink
+# the extents on the next refresh.
+EXTENTS_STORE_SQL = """
+CREATE SCHEMA IF NOT EXISTS features_api;
+
+CREATE TABLE IF NOT EXISTS features_api.extents (
+    table_schema text NOT NULL,
+    table_name text NOT NULL,
+    column_name text NOT NULL,
+    -- xmin, ymin, xmax, ymax in WGS84, for geometry/geography columns
+    bounds float8[],
+    -- for timestamp/date columns
+    mindt timestamptz,
+    maxdt timestamptz,
+    updated_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_schema, table_name, column_name)
+);
+
+CREATE OR REPLACE FUNCTION features_api.extent_bounds(g geometry, srid int) RETURNS float8[] AS $$
+    SELECT CASE WHEN b IS NOT NULL THEN ARRAY[ST_XMin(b), ST_YMin(b), ST_XMax(b), ST_YMax(b)] END
+    FROM (
+        SELECT CASE WHEN srid != 4326 THEN ST_Transform(ST_SetSRID(g, srid), 4326) ELSE g END AS b
+    ) AS t;
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION features_api.refresh_extents(_table regclass) RETURNS void AS $$
+DECLARE
+    _schema text;
+    _name text;
+    att record;
+    bounds_geom geometry;
+    _mindt timestamptz;
+    _maxdt timestamptz;
+BEGIN
+    SELECT n.nspname, c.relname INTO _schema, _name
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = _table;
+
+    DELETE FROM features_api.extents WHERE table_schema = _schema AND table_name = _name;
+
+    FOR att IN
+        SELECT attname::text AS attname, format_type(atttypid, NULL) AS atttype, atttypmod
+        FROM pg_attribute
+        WHERE attrelid = _table AND attnum > 0 AND NOT attisdropped
+    LOOP
+        IF att.atttype IN ('geometry', 'geography') THEN
+            EXECUTE format('SELECT ST_Extent(%I::geometry)::geometry FROM %s', att.attname, _table)
+            INTO bounds_geom;
+            INSERT INTO features_api.extents (table_schema, table_name, column_name, bounds)
+            VALUES (
+                _schema,
+                _name,
+                att.attname,
+                features_api.extent_bounds(
+                    bounds_geom, coalesce(nullif(postgis_typmod_srid(att.atttypmod), 0), 4326)
+                )
+            );
+        ELSIF att.atttype IN ('timestamp without time zone', 'timestamp with time zone', 'date') THEN
+            EXECUTE format('SELECT min(%I::timestamptz), max(%I::timestamptz) FROM %s', att.attname, att.attname, _table)
+            INTO _mindt, _maxdt;
+            INSERT INTO features_api.extents (table_schema, table_name, column_name, mindt, maxdt)
+            VALUES (_schema, _name, att.attname, _mindt, _maxdt);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE PLPGSQL;
+
+-- Formerly an overload of refresh_extents, which made `refresh_extents('schema.table')`
+-- ambiguous
+DROP FUNCTION IF EXISTS features_api.refresh_extents(text[]);
+
+CREATE OR REPLACE FUNCTION features_api.refresh_all_extents(_schemas text[] DEFAULT ARRAY['public']) RETURNS void AS $$
+    SELECT features_api.refresh_extents(c.oid::regclass)
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = ANY(_schemas) AND c.relkind IN ('r', 'm', 'p');
+$$ LANGUAGE SQL;
+
+-- Statement trigger extending the extents with the inserted or updated rows
+CREATE OR REPLACE FUNCTION features_api.extend_extents() RETURNS trigger AS $$
+DECLARE
+    ext record;
+    _bounds float8[];
+    bounds_geom geometry;
+    _mindt timestamptz;
+    _maxdt timestamptz;
+BEGIN
+    FOR ext IN
+        SELECT e.column_name, format_type(a.atttypid, NULL) AS atttype, a.atttypmod
+        FROM features_api.extents e
+        JOIN pg_attribute a ON a.attrelid = TG_RELID AND a.attname = e.column_name
+        WHERE e.table_schema = TG_TABLE_SCHEMA AND e.table_name = TG_TABLE_NAME
+    LOOP
+        IF ext.atttype IN ('geometry', 'geography') THEN
+            EXECUTE format('SELECT ST_Extent(%I::geometry)::geometry FROM new_rows', ext.column_name)
+            INTO bounds_geom;
+            _bounds := features_api.extent_bounds(
+                bounds_geom, coalesce(nullif(postgis_typmod_srid(ext.atttypmod), 0), 4326)
+            );
+            CONTINUE WHEN _bounds IS NULL;
+
+            UPDATE features_api.extents e
+            SET
+                bounds = CASE WHEN e.bounds IS NULL THEN _bounds ELSE ARRAY[
+                    least(e.bounds[1], _bounds[1]),
+                    least(e.bounds[2], _bounds[2]),
+                    greatest(e.bounds[3], _bounds[3]),
+                    greatest(e.bounds[4], _bounds[4])
+                ] END,
+                updated_at = now()
+            WHERE e.table_schema = TG_TABLE_SCHEMA AND e.table_name = TG_TABLE_NAME AND e.column_name = ext.column_name;
+        ELSE
+            EXECUTE format('SELECT min(%I::timestamptz), max(%I::timestamptz) FROM new_rows', ext.column_name, ext.column_name)
+            INTO _mindt, _maxdt;
+            CONTINUE WHEN _mindt IS NULL;
+
+            UPDATE features_api.extents e
+            SET mindt = least(e.mindt, _mindt), maxdt = greatest(e.maxdt, _maxdt), updated_at = now()
+            WHERE e.table_schema = TG_TABLE_SCHEMA AND e.table_name = TG_TABLE_NAME AND e.column_name = ext.column_name;
+        END IF;
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE PLPGSQL;
+
+-- Compute the extents of a table and keep them up to date (run by the table owner)
+CREATE OR REPLACE FUNCTION features_api.track_extents(_table regclass) RETURNS void AS $$
+BEGIN
+    PERFORM features_api.refresh_extents(_table);
+
+    EXECUTE format('DROP TRIGGER IF EXISTS features_api_extents_insert ON %s', _table);
+    EXECUTE format('DROP TRIGGER IF EXISTS features_api_extents_update ON %s', _table);
+    EXECUTE format(
+        'CREATE TRIGGER features_api_extents_insert AFTER INSERT ON %s '
+        'REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION features_api.extend_extents()',
+        _table
+    );
+    EXECUTE format(
+        'CREATE TRIGGER features_api_extents_update AFTER UPDATE ON %s '
+        'REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION features_api.extend_extents()',
+        _table
+    );
+END;
+$$ LANGUAGE PLPGSQL;
+
+GRANT USAGE ON SCHEMA features_api TO {username};
+GRANT SELECT, INSERT, UPDATE, DELETE ON features_api.extents TO {username};
+GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA features_api TO {username};
+"""
+
+
+def create_extents_store(cursor, username: str) -> None:
+    """Create the collection extents table and the functions maintaining it."""
+    cursor.execute(
+        sql.SQL(EXTENTS_STORE_SQL).format(username=sql.Identifier(username))
+    )
+
+
+PROJECTED_GEOMETRY_SQL = """
+-- Geometry projected to a CRS, clipped to the WebMercator latitudes for EPSG:3857
+CREATE OR REPLACE FUNCTION features_api.project_geometry(g geometry, srid int) RETURNS geometry AS $$
+DECLARE
+    wgs84 geometry;
+    mercator_bounds geometry := ST_MakeEnvelope(-180, -85.0511287798066, 180, 85.0511287798066, 4326);
+BEGIN
+    IF srid != 3857 THEN
+        RETURN ST_Transform(g, srid);
+    END IF;
+
+    wgs84 := ST_Transform(g, 4326);
+    IF NOT ST_CoveredBy(wgs84, mercator_bounds) THEN
+        wgs84 := ST_Intersection(wgs84, mercator_bounds);
+    END IF;
+    RETURN ST_Transform(wgs84, 3857);
+END;
+$$ LANGUAGE PLPGSQL IMMUTABLE STRICT PARALLEL SAFE;
+
+-- Add a generated copy of a geometry column projected to `srid`, named `<column>_<srid>`,
+-- with its GIST index, for the tiles of TileMatrixSets in that CRS (run by the table owner)
+CREATE OR REPLACE FUNCTION features_api.add_projected_geometry(
+    _table regclass, _column name DEFAULT 'geom', _srid int DEFAULT 3857
+) RETURNS text AS $$
+DECLARE
+    _projected text := _column || '_' || _srid;
+    _schema text;
+    _name text;
+BEGIN
+    SELECT n.nspname, c.relname INTO _schema, _name
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = _table;
+
+    EXECUTE format(
+        'ALTER TABLE %s ADD COLUMN IF NOT EXISTS %I geometry(Geometry, %s) '
+        'GENERATED ALWAYS AS (features_api.project_geometry(%I::geometry, %s)) STORED',
+        _table, _projected, _srid, _column, _srid
+    );
+    EXECUTE format(
+        'CREATE INDEX IF NOT EXISTS %I ON %s USING gist (%I)',
+        left(_name || '_' || _projected || '_idx', 63), _table, _projected
+    );
+    EXECUTE format('ANALYZE %s', _table);
+
+    -- extents of the new column, for tables in the extents store
+    IF EXISTS (SELECT 1 FROM features_api.extents WHERE table_schema = _schema AND table_name = _name) THEN
+        PERFORM features_api.refresh_extents(_table);
+    END IF;
+
+    RETURN _projected;
+END;
+$$ LANGUAGE PLPGSQL;
+
+GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA features_api TO {username};
+"""
+
+
+def create_projected_geometry_functions(cursor, username: str) -> None:
+    """Create the functions maintaining geometry columns projected for the tiles."""
+    cursor.execute(
+        sql.SQL(PROJECTED_GEOMETRY_SQL).format(username=sql.Identifier(username))
+    )
+
+
+# Execution statistics of the statements, grouped by collection by the `/statistics`
+# endpoint of the features API. The library is preloaded by the parameter group of the
+# database; the extension lives in the features_api schema so that its views are not
+# listed as collections of the public schema.
+QUERY_STATISTICS_SQL = """
+CREATE SCHEMA IF NOT EXISTS features_api;
+CREATE EXTENSION IF NOT EXISTS pg_stat_statements SCHEMA features_api;
+GRANT USAGE ON SCHEMA features_api TO {username};
+"""
+
+
+def enable_query_statistics(cursor, username: str) -> None:
+    """Create the pg_stat_statements extension."""
+    cursor.execute(
+        sql.SQL(QUERY_STATISTICS_SQL).format(username=sql.Identifier(username))
+    )
+
+
+# Geometry and datetime columns of the tables, the access methods of the indexes leading
+# with them and how well their values follow the physical order of the rows
+INDEXABLE_COLUMNS_SQL = """
+SELECT
+    n.nspname AS table_schema,
+    c.relname AS table_name,
+    a.attname AS column_name,
+    format_type(a.atttypid, NULL) AS column_type,
+    c.reltuples::bigint AS row_estimate,
+    s.correlation,
+    coalesce(t.n_tup_ins, 0) AS inserts,
+    coalesce(t.n_tup_upd + t.n_tup_del, 0) AS changes,
+    array_remove(array_agg(DISTINCT am.amname::text), NULL) AS methods
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indkey[0] = a.attnum AND i.indisvalid
+LEFT JOIN pg_class ic ON ic.oid = i.indexrelid
+LEFT JOIN pg_am am ON am.oid = ic.relam
+LEFT JOIN pg_stats s
+    ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = a.attname
+LEFT JOIN pg_stat_user_tables t ON t.relid = c.oid
+WHERE
+    n.nspname = ANY(%s)
+    AND c.relkind IN ('r', 'm')
+    AND format_type(a.atttypid, NULL) IN (
+        'geometry', 'geography', 'timestamp without time zone', 'timestamp with time zone', 'date'
+    )
+GROUP BY n.nspname, c.relname, a.attname, a.atttypid, c.reltuples, s.correlation, t.n_tup_ins, t.n_tup_upd, t.n_tup_del
+ORDER BY n.nspname, c.relname, a.attname;
+"""
+
+# BRIN indexes only prune block ranges when the column follows the row order, as the
+# time column of an append-only table does
+BRIN_MIN_CORRELATION = 0.9
+# share of the inserted rows that were later updated or deleted
+BRIN_MAX_CHANGES = 0.01
+
+
+def advise_indexes(cursor, schemas: Sequence[str] = ("public",)) -> List[Dict]:
+    """List the missing GIST, BRIN and btree indexes of geometry and datetime columns."""
+    cursor.execute(INDEXABLE_COLUMNS_SQL, [list(schemas)])
+
+    advice = []
+    for (
+        table_schema,
+        table_name,
+        column_name,
+        column_type,
+        row_estimate,
+        correlation,
+        inserts,
+        changes,
+        methods,
+    ) in cursor.fetchall():
+        if column_type in ("geometry", "geography"):
+            if "gist" in methods or "spgist" in methods:
+                continue
+            method = "gist"
+
+        else:
+            if methods:
+                continue
+            append_only = (
+                correlation is not None
+                and abs(correlation) >= BRIN_MIN_CORRELATION
+                and changes <= inserts * BRIN_MAX_CHANGES
+            )
+            method = "brin" if append_only else "btree"
+
+        index_name = f"{table_name}_{column_name}_{method}_idx"[:63]
+        statement = sql.SQL(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} USING {method} ({column})"
+        ).format(
+            index=sql.Identifier(index_name),
+            table=sql.Identifier(table_schema, table_name),
+            method=sql.SQL(method),
+            column=sql.Identifier(column_name),
+        )
+        advice.append(
+            {
+                "table": f"{table_schema}.{table_name}",
+                "column": column_name,
+                "type": column_type,
+                "rows": row_estimate,
+                "method": method,
+                "index": index_name,
+                "statement": statement.as_string(cursor),
+            }
+        )
+
+    return advice
+
+
+# Invalid index left by an interrupted concurrent build
+INVALID_INDEX_SQL = """
+SELECT 1
+FROM pg_index i
+JOIN pg_class ic ON ic.oid = i.indexrelid
+JOIN pg_namespace n ON n.oid = ic.relnamespace
+WHERE n.nspname = %s AND ic.relname = %s AND NOT i.indisvalid;
+"""
+
+
+def drop_index(cursor, table_schema: str, index_name: str) -> None:
+    """Drop an index without blocking writes to its table."""
+    cursor.execute(
+        sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {index}").format(
+            index=sql.Identifier(table_schema, index_name)
+        )
+    )
+
+
+def create_indexes(cursor, advice: List[Dict], dry_run: bool = False) -> List[Dict]:
+    """Create the advised indexes (needs an autocommit connection), return the failed ones."""
+    failed = []
+    for index in advice:
+        print(("Would run: " if dry_run else "Running: ") + index["statement"])
+        if dry_run:
+            continue
+
+        table_schema = index["table"].split(".", 1)[0]
+        # `IF NOT EXISTS` would keep the invalid index of a build interrupted by the
+        # lambda timeout
+        cursor.execute(INVALID_INDEX_SQL, [table_schema, index["index"]])
+        if cursor.fetchone():
+            drop_index(cursor, table_schema, index["index"])
+
+        try:
+            cursor.execute(index["statement"])
+        except psycopg.Error as e:
+            print(f"Could not create {index['index']}: {e}")
+            failed.append({**index, "error": str(e)})
+            # A failed concurrent build leaves an invalid index behind
+            drop_index(cursor, table_schema, index["index"])
+
+    return failed
+
+
+def index_stage(conninfo: str, dry_run: bool = False) -> Dict:
+    """Report or create the missing indexes of the `public` tables."""
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        with conn.cursor() as cur:
+            advice = advise_indexes(cursor=cur)
+            failed = create_indexes(cursor=cur, advice=advice, dry_run=dry_run)
+
+    return {"dry_run": dry_run, "indexes": advice, "failed": failed}
+
+
+def user_conninfo(user_params: Dict) -> str:
+    """Connection to the features database as its user, which owns the tables."""
+    return make_conninfo(
+        dbname=user_params["dbname"],
+        user=user_params["username"],
+        password=user_params["password"],
+        host=user_params["host"],
+        port=user_params["port"],
+    )
+
+
+def index_handler(event: Dict) -> Dict:
+    """On demand index stage: `{"action": "index", "dry_run": true}`."""
+    user_params = get_secret(
+        event.get("new_user_secret_arn") or os.environ["NEW_USER_SECRET_ARN"]
+    )
+    report = index_stage(user_conninfo(user_params), dry_run=event.get("dry_run", True))
+    print(json.dumps(report))
+    return report
+
+
 def handler(event, context):
     """Lambda Handler."""
     print(f"Handling {event}")
 
+    if event.get("action") == "index":
+        return index_handler(event)
+
     if event["RequestType"] not in ["Create", "Update"]:
         return send(event, context, "SUCCESS", {"msg": "No action to be taken"})
 
@@ -200,9 +618,35 @@ def handler(event, context):
                 print("Adding SRID 9311 ...")
                 add_SRID_9311(cursor=cur)
 
+                print("Creating extents store ...")
+                create_extents_store(cursor=cur, username=user_params["username"])
+
+                print("Creating projected geometry functions ...")
+                create_projected_geometry_functions(
+                    cursor=cur, username=user_params["username"]
+                )
+
+                print("Enabling query statistics ...")
+                enable_query_statistics(cursor=cur, username=user_params["username"])
+
     except Exception as e:
         print(f"Unable to bootstrap database with exception={e}")
         return send(event, context, "FAILED", {"message": str(e)})
 
+    # Respond before the index stage: concurrent index builds on large tables can take
+    # longer than the stack is willing to wait for the custom resource
+    send(event, context, "SUCCESS", {"msg": "Database bootstrapped"})
+
+    print("Indexing geometry and datetime columns ...")
+    try:
+        index_report = index_stage(
+            user_conninfo(user_params),
+            dry_run=str(params.get("index_dry_run", "false")).lower() == "true",
+        )
+    except Exception as e:
+        # The on demand index stage ({"action": "index"}) resumes the remaining builds
+        print(f"Unable to index the tables with exception={e}")
+        return
+
+    print(json.dumps(index_report))
     print("Complete.")
-    return send(event, context, "SUCCESS", {})
@@ -0,0 +1,26 @@
+"""Test the database bootstrap handler."""
+import pytest
+from psycopg import sql
+
+import handler
+
+SQL_BLOCKS = [
+    name
+    for name, value in vars(handler).items()
+    if name.endswith("_SQL") and isinstance(value, str)
+]
+
+
+@pytest.mark.parametrize("name", SQL_BLOCKS)
+def test_sql_blocks_format(name):
+    """Every SQL block of the handler formats with the username placeholder only."""
+    query = sql.SQL(getattr(handler, name)).format(username=sql.Identifier("features"))
+    assert query.as_string(None)
+
+
+def test_projected_geometry_sql():
+    """The projected geometry functions are granted to the user."""
+    query = sql.SQL(handler.PROJECTED_GEOMETRY_SQL).format(
+        username=sql.Identifier("features")
+    )
+    assert 'TO "features";' in query.as_string(None)
@@ -0,0 +1,3 @@
+"""Bulk loader of PostGIS collections for veda.features_api."""
+
+__version__ = "0.1.0"
@@ -0,0 +1,86 @@
+"""Load GeoJSON, NDJSON or GeoParquet into a PostGIS table.
+
+usage: python -m loader data.parquet public.my_table --workers 4 --cluster
+"""
+import argparse
+import os
+import urllib.request
+
+from loader.load import Loader
+from loader.sources import open_source
+
+
+def refresh_catalog(url: str) -> None:
+    """Ask the features API to register the catalog again, e.g. https://.../refresh."""
+    with urllib.request.urlopen(url, timeout=60) as response:
+        print(f"Catalog refresh: {response.status}")
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="GeoJSON, NDJSON or GeoParquet file.")
+    parser.add_argument("table", help="Table to create or replace, e.g. public.fires.")
+    parser.add_argument(
+        "--dsn",
+        default=os.environ.get("DATABASE_URL", ""),
+        help="PostgreSQL connection string, defaults to DATABASE_URL or the PG* variables.",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of COPY connections.")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Rows per COPY.")
+    parser.add_argument(
+        "--id-field",
+        help="Property used as primary key, an identity column is added otherwise.",
+    )
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="Reorder the rows along the spatial index so features close in space share pages.",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Copy into the existing table instead of replacing it.",
+    )
+    parser.add_argument(
+        "--projected-srid",
+        type=int,
+        action="append",
+        default=[],
+        help="Add a `geom_{srid}` copy of the geometries projected to this SRID, e.g. 3857 for the tiles.",
+    )
+    parser.add_argument(
+        "--infer-rows",
+        type=int,
+        default=1000,
+        help="Number of GeoJSON features used to infer the property types.",
+    )
+    parser.add_argument(
+        "--refresh-url",
+        help="Features API catalog refresh URL, called once the table is loaded.",
+    )
+    args = parser.parse_args()
+
+    loader = Loader(
+        args.dsn,
+        args.table,
+        open_source(args.path, infer_rows=args.infer_rows),
+        workers=args.workers,
+        batch_size=args.batch_size,
+        id_field=args.id_field,
+        cluster=args.cluster,
+        append=args.append,
+        projected_srids=args.projected_srid,
+    )
+    report = loader.run()
+    print(
+        f"Loaded {report.rows} rows into {report.table} at {report.rows_per_second:.0f} rows/s "
+        f"({report.copy_seconds:.1f}s copying, {report.seconds:.1f}s in total)"
+    )
+
+    if args.refresh_url:
+        refresh_catalog(args.refresh_url)
+
+
+if __name__ == "__main__":
+    main()
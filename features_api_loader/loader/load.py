@@ -0,0 +1,323 @@
+"""Parallel binary COPY of a source into a PostGIS table"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import orjson
+import psycopg
+from psycopg import sql
+from psycopg.types.json import set_json_dumps
+
+from loader.sources import GEOMETRY_COLUMN, Source
+
+# Primary key added when the features have no identifier property
+ID_COLUMN = "fid"
+
+
+@dataclass
+class LoadReport:
+    """Outcome of a load."""
+
+    table: str
+    rows: int = 0
+    # seconds spent copying the rows, and in total with the indexes and analyze
+    copy_seconds: float = 0.0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        """Copy rate."""
+        return self.rows / self.copy_seconds if self.copy_seconds else 0.0
+
+
+def split_table_name(table: str) -> Tuple[str, str]:
+    """(schema, table) of a `schema.table` or `table` name."""
+    schema, _, name = table.rpartition(".")
+    return schema or "public", name
+
+
+class Loader:
+    """Load a source into a table with binary COPY from parallel workers.
+
+    The rows are copied into a new table without indexes, which is then indexed,
+    optionally clustered, analyzed and swapped with the target table in one
+    transaction. With `append`, rows are copied into the existing table instead.
+    """
+
+    def __init__(
+        self,
+        conninfo: str,
+        table: str,
+        source: Source,
+        workers: int = 4,
+        batch_size: int = 10000,
+        id_field: Optional[str] = None,
+        cluster: bool = False,
+        append: bool = False,
+        projected_srids: Sequence[int] = (),
+        report_interval: float = 5.0,
+    ) -> None:
+        """Init loader."""
+        self.conninfo = conninfo
+        self.schema, self.table = split_table_name(table)
+        self.source = source
+        self.workers = workers
+        self.batch_size = batch_size
+        self.id_field = id_field
+        self.cluster = cluster
+        self.append = append
+        # `geom_{srid}` generated columns, see features_api.add_projected_geometry
+        self.projected_srids = projected_srids
+        self.report_interval = report_interval
+
+        # table receiving the rows
+        self.target = self.table if append else f"{self.table}_loading"[:63]
+        self.report = LoadReport(table=f"{self.schema}.{self.table}")
+        self.lock = threading.Lock()
+        # set when the copy failed, for the workers to stop
+        self.stop = threading.Event()
+
+    def identifier(self, name: str) -> sql.Identifier:
+        """Qualified identifier of a table of the schema."""
+        return sql.Identifier(self.schema, name)
+
+    def create_table(self, cur: psycopg.Cursor) -> None:
+        """Create the loading table, without any index."""
+        columns = [
+            sql.SQL("{} {}").format(sql.Identifier(field.name), sql.SQL(field.type))
+            for field in self.source.fields
+        ]
+        if not self.id_field:
+            columns.insert(
+                0,
+                sql.SQL("{} bigint GENERATED BY DEFAULT AS IDENTITY").format(
+                    sql.Identifier(ID_COLUMN)
+                ),
+            )
+        columns.append(
+            sql.SQL("{} geometry(Geometry, {})").format(
+                sql.Identifier(GEOMETRY_COLUMN), sql.Literal(self.source.srid)
+            )
+        )
+        for srid in self.projected_srids:
+            columns.append(
+                sql.SQL(
+                    "{} geometry(Geometry, {}) GENERATED ALWAYS AS "
+                    "(features_api.project_geometry({}, {})) STORED"
+                ).format(
+                    sql.Identifier(f"{GEOMETRY_COLUMN}_{srid}"),
+                    sql.Literal(srid),
+                    sql.Identifier(GEOMETRY_COLUMN),
+                    sql.Literal(srid),
+                )
+            )
+
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(self.identifier(self.target)))
+        cur.execute(
+            sql.SQL("CREATE TABLE {} ({})").format(
+                self.identifier(self.target), sql.SQL(", ").join(columns)
+            )
+        )
+
+    def copy_statement(self) -> sql.Composed:
+        """Binary COPY of the source columns."""
+        names = [field.name for field in self.source.fields] + [GEOMETRY_COLUMN]
+        return sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            self.identifier(self.target),
+            sql.SQL(", ").join(map(sql.Identifier, names)),
+        )
+
+    def copy_worker(self, batches: "queue.Queue[Optional[List[Tuple]]]") -> None:
+        """Copy the batches of the queue, each in its own transaction, until a None."""
+        statement = self.copy_statement()
+        # The geometry (E)WKB is sent as is, the server reads it with geometry_recv
+        types = [field.type for field in self.source.fields] + ["bytea"]
+
+        with psycopg.connect(self.conninfo, autocommit=True) as conn:
+            set_json_dumps(orjson.dumps, conn)
+            with conn.cursor() as cur:
+                while True:
+                    try:
+                        rows = batches.get(timeout=1)
+                    except queue.Empty:
+                        if self.stop.is_set():
+                            return
+                        continue
+
+                    if rows is None:
+                        return
+
+                    with conn.transaction():
+                        with cur.copy(statement) as copy:
+                            copy.set_types(types)
+                            for row in rows:
+                                copy.write_row(row)
+
+                    with self.lock:
+                        self.report.rows += len(rows)
+
+    def copy(self) -> None:
+        """Read the source and hand the batches to the copy workers."""
+        batches: "queue.Queue[Optional[List[Tuple]]]" = queue.Queue(maxsize=self.workers * 2)
+        started = time.monotonic()
+        last_report = started
+
+        def put(item: Optional[List[Tuple]], futures: List[Future]) -> None:
+            # Never block on a queue whose workers failed
+            while True:
+                for future in futures:
+                    if future.done() and future.exception():
+                        raise future.exception()  # type: ignore
+                try:
+                    batches.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self.copy_worker, batches) for _ in range(self.workers)
+            ]
+            try:
+                for rows in self.source.batches(self.batch_size):
+                    put(rows, futures)
+
+                    if time.monotonic() - last_report > self.report_interval:
+                        last_report = time.monotonic()
+                        rate = self.report.rows / (last_report - started)
+                        print(f"{self.report.rows} rows, {rate:.0f} rows/s")
+
+                for _ in futures:
+                    put(None, futures)
+
+            except BaseException:
+                self.stop.set()
+                raise
+
+            for future in futures:
+                future.result()
+
+        self.report.copy_seconds = time.monotonic() - started
+
+    def finish(self, cur: psycopg.Cursor) -> None:
+        """Index, cluster and analyze the loaded table, then swap it with the target."""
+        target = self.identifier(self.target)
+        key = self.id_field or ID_COLUMN
+        geometry_columns = [GEOMETRY_COLUMN] + [
+            f"{GEOMETRY_COLUMN}_{srid}" for srid in self.projected_srids
+        ]
+
+        if not self.append:
+            print("Creating indexes")
+            cur.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY ({})").format(
+                    target,
+                    sql.Identifier(f"{self.target}_pkey"[:63]),
+                    sql.Identifier(key),
+                )
+            )
+            for column in geometry_columns:
+                cur.execute(
+                    sql.SQL("CREATE INDEX {} ON {} USING gist ({})").format(
+                        sql.Identifier(f"{self.target}_{column}_idx"[:63]),
+                        target,
+                        sql.Identifier(column),
+                    )
+                )
+
+            if self.cluster:
+                # Rows close in space end up in the same pages
+                print("Clustering")
+                cur.execute(
+                    sql.SQL("CLUSTER {} USING {}").format(
+                        target,
+                        sql.Identifier(f"{self.target}_{GEOMETRY_COLUMN}_idx"[:63]),
+                    )
+                )
+
+        print("Analyzing")
+        cur.execute(sql.SQL("ANALYZE {}").format(target))
+
+        if not self.append:
+            table = self.identifier(self.table)
+            with cur.connection.transaction():
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(table))
+                cur.execute(
+                    sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        target, sql.Identifier(self.table)
+                    )
+                )
+                cur.execute(
+                    sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                        table,
+                        sql.Identifier(f"{self.target}_pkey"[:63]),
+                        sql.Identifier(f"{self.table}_pkey"[:63]),
+                    )
+                )
+                for column in geometry_columns:
+                    cur.execute(
+                        sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                            self.identifier(f"{self.target}_{column}_idx"[:63]),
+                            sql.Identifier(f"{self.table}_{column}_idx"[:63]),
+                        )
+                    )
+
+        self.refresh_extents(cur)
+
+    def refresh_extents(self, cur: psycopg.Cursor) -> None:
+        """Update the extents store of the database, when it has one."""
+        cur.execute(
+            "SELECT 1 FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace "
+            "WHERE n.nspname = 'features_api' AND p.proname = 'refresh_extents'"
+        )
+        if cur.fetchone():
+            print("Refreshing extents")
+            cur.execute(
+                sql.SQL("SELECT features_api.refresh_extents({})").format(
+                    sql.Literal(self.identifier(self.table).as_string(cur))
+                )
+            )
+
+    def reserved_columns(self) -> List[str]:
+        """Columns added by the loader, which the properties cannot be loaded into."""
+        columns = [GEOMETRY_COLUMN] + [
+            f"{GEOMETRY_COLUMN}_{srid}" for srid in self.projected_srids
+        ]
+        if not self.id_field:
+            columns.insert(0, ID_COLUMN)
+        return columns
+
+    def run(self) -> LoadReport:
+        """Load the source."""
+        started = time.monotonic()
+        names = [f.name for f in self.source.fields]
+        if self.id_field and self.id_field not in names:
+            raise ValueError(f"{self.id_field} is not a property of the features")
+        for name in self.reserved_columns():
+            if name in names:
+                hint = " (use it as the id field)" if name == ID_COLUMN else ""
+                raise ValueError(f"Property {name!r} is a column of the loader{hint}")
+
+        with psycopg.connect(self.conninfo, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                if not self.append:
+                    self.create_table(cur)
+
+                try:
+                    self.copy()
+                except BaseException:
+                    if not self.append:
+                        cur.execute(
+                            sql.SQL("DROP TABLE IF EXISTS {}").format(
+                                self.identifier(self.target)
+                            )
+                        )
+                    raise
+
+                self.finish(cur)
+
+        self.report.seconds = time.monotonic() - started
+        return self.report
@@ -0,0 +1,281 @@
+"""Feature sources: GeoJSON, NDJSON and GeoParquet files read in batches of rows"""
+import abc
+import decimal
+import itertools
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import orjson
+import shapely
+
+try:
+    import ijson
+except ImportError:  # pragma: nocover
+    ijson = None  # type: ignore
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: nocover
+    pyarrow = None  # type: ignore
+
+# Name of the geometry column of the loaded tables
+GEOMETRY_COLUMN = "geom"
+
+
+class Field(NamedTuple):
+    """Column of a loaded table."""
+
+    name: str
+    # PostgreSQL type name, also used to pick the binary COPY dumper
+    type: str
+
+
+class Source(metaclass=abc.ABCMeta):
+    """Rows of properties followed by the geometry (E)WKB."""
+
+    # properties, the geometry column is added after them
+    fields: List[Field]
+    srid: int = 4326
+
+    @abc.abstractmethod
+    def batches(self, batch_size: int) -> Iterator[List[Tuple]]:
+        """Yield the rows, `batch_size` at a time."""
+        ...
+
+
+def _to_text(value: Any) -> str:
+    return value if isinstance(value, str) else str(value)
+
+
+def _to_int8(value: Any) -> int:
+    if type(value) is int:
+        return value
+    if type(value) is float and value.is_integer():
+        return int(value)
+    raise ValueError("not an integer")
+
+
+def _to_float8(value: Any) -> float:
+    if type(value) in (int, float):
+        return float(value)
+    raise ValueError("not a number")
+
+
+def _to_bool(value: Any) -> bool:
+    if type(value) is bool:
+        return value
+    raise ValueError("not a boolean")
+
+
+def infer_type(values: List[Any]) -> str:
+    """PostgreSQL type of the values of a GeoJSON property."""
+    types = {type(v) for v in values if v is not None}
+    if not types:
+        return "text"
+    if types == {bool}:
+        return "bool"
+    if types <= {int}:
+        return "int8"
+    if types <= {int, float}:
+        return "float8"
+    if types <= {dict, list}:
+        return "jsonb"
+    return "text"
+
+
+# Conversion of the values to their inferred column type, raising ValueError for the
+# values of another type (which the binary COPY dumpers would fail on)
+CONVERTERS: Dict[str, Callable[[Any], Any]] = {
+    "bool": _to_bool,
+    "int8": _to_int8,
+    "float8": _to_float8,
+    "text": _to_text,
+}
+
+
+class FeatureSource(Source):
+    """GeoJSON features, with the property types inferred from the first ones."""
+
+    def __init__(self, features: Iterator[Dict], infer_rows: int = 1000) -> None:
+        """Peek the first features to build the fields."""
+        head = list(itertools.islice(features, infer_rows))
+        self.features = itertools.chain(head, features)
+        self.infer_rows = infer_rows
+        # features converted to rows so far
+        self.read = 0
+
+        names: Dict[str, List[Any]] = {}
+        for feature in head:
+            for name, value in (feature.get("properties") or {}).items():
+                names.setdefault(name, []).append(value)
+
+        self.fields = [Field(name, infer_type(values)) for name, values in names.items()]
+        self.converters = [CONVERTERS.get(field.type) for field in self.fields]
+
+    def rows(self, features: List[Dict]) -> List[Tuple]:
+        """Rows of a batch of features, geometries are converted at once by GEOS."""
+        geometries = shapely.from_geojson(
+            [
+                orjson.dumps(f["geometry"]) if f.get("geometry") else None
+                for f in features
+            ]
+        )
+        wkbs = shapely.to_wkb(shapely.set_srid(geometries, self.srid), include_srid=True)
+
+        rows = []
+        for feature, wkb in zip(features, wkbs):
+            properties = feature.get("properties") or {}
+            row = []
+            for field, convert in zip(self.fields, self.converters):
+                value = properties.get(field.name)
+                if convert and value is not None:
+                    try:
+                        value = convert(value)
+                    except ValueError:
+                        raise ValueError(
+                            f"Property {field.name!r} of feature {self.read + len(rows)} "
+                            f"is {value!r}, while its type was inferred as {field.type} "
+                            f"from the first {self.infer_rows} features: raise the "
+                            "number of features used to infer the types"
+                        ) from None
+                row.append(value)
+            row.append(wkb)
+            rows.append(tuple(row))
+
+        self.read += len(rows)
+        return rows
+
+    def batches(self, batch_size: int) -> Iterator[List[Tuple]]:
+        """Yield the rows, `batch_size` at a time."""
+        while features := list(itertools.islice(self.features, batch_size)):
+            yield self.rows(features)
+
+
+def geojson_features(path: str) -> Iterator[Dict]:
+    """Features of a GeoJSON FeatureCollection, streamed with ijson when it is installed."""
+    with open(path, "rb") as f:
+        if ijson is not None:
+            yield from ijson.items(f, "features.item", use_float=True)
+        else:
+            yield from orjson.loads(f.read())["features"]
+
+
+def ndjson_features(path: str) -> Iterator[Dict]:
+    """Features of a newline delimited GeoJSON file."""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+
+def _arrow_type(arrow_type) -> Tuple[str, Optional[Callable[[Any], Any]]]:
+    """PostgreSQL type (and value converter) of an Arrow type."""
+    types = pyarrow.types
+    if types.is_boolean(arrow_type):
+        return "bool", None
+    if types.is_int8(arrow_type) or types.is_int16(arrow_type) or types.is_uint8(arrow_type):
+        return "int2", None
+    if types.is_int32(arrow_type) or types.is_uint16(arrow_type):
+        return "int4", None
+    if types.is_integer(arrow_type):
+        return "int8", None
+    if types.is_float16(arrow_type) or types.is_float32(arrow_type):
+        return "float4", None
+    if types.is_floating(arrow_type):
+        return "float8", None
+    if types.is_decimal(arrow_type):
+        return "numeric", None
+    if types.is_string(arrow_type) or types.is_large_string(arrow_type):
+        return "text", None
+    if types.is_binary(arrow_type) or types.is_large_binary(arrow_type):
+        return "bytea", None
+    if types.is_date(arrow_type):
+        return "date", None
+    if types.is_timestamp(arrow_type):
+        return ("timestamptz" if arrow_type.tz else "timestamp"), None
+    if types.is_nested(arrow_type):
+        return "jsonb", _json_value
+    return "text", _to_text
+
+
+def _json_default(value: Any) -> Any:
+    return float(value) if isinstance(value, decimal.Decimal) else str(value)
+
+
+def _json_value(value: Any) -> Any:
+    """Nested value with only JSON types (dates and decimals are not)."""
+    return orjson.loads(orjson.dumps(value, default=_json_default))
+
+
+def _geoparquet_srid(column: Dict) -> int:
+    """SRID of a GeoParquet geometry column, from the EPSG id of its PROJJSON CRS."""
+    crs = column.get("crs")
+    if not isinstance(crs, dict):
+        # missing: OGC:CRS84
+        return 4326
+
+    id = crs.get("id") or {}
+    if id.get("authority") == "EPSG":
+        return int(id["code"])
+    return 4326
+
+
+class ParquetSource(Source):
+    """GeoParquet file, read one record batch at a time."""
+
+    def __init__(self, path: str) -> None:
+        """Read the schema and the GeoParquet metadata."""
+        if pyarrow is None:
+            raise ValueError("GeoParquet sources need the `parquet` extra (pyarrow)")
+
+        self.file = pyarrow.parquet.ParquetFile(path)
+        schema = self.file.schema_arrow
+
+        geo = orjson.loads((schema.metadata or {}).get(b"geo", b"{}"))
+        self.geometry = geo.get("primary_column")
+        if not self.geometry:
+            raise ValueError(f"{path} has no GeoParquet metadata")
+
+        column = geo["columns"][self.geometry]
+        if column.get("encoding", "WKB").upper() != "WKB":
+            raise ValueError(f"Unsupported GeoParquet encoding {column['encoding']}")
+        self.srid = _geoparquet_srid(column)
+
+        self.columns = [
+            name
+            for name in schema.names
+            if name != self.geometry and name not in geo["columns"]
+        ]
+        self.fields = []
+        self.converters = []
+        for name in self.columns:
+            pg_type, convert = _arrow_type(schema.field(name).type)
+            self.fields.append(Field(name, pg_type))
+            self.converters.append(convert)
+
+    def batches(self, batch_size: int) -> Iterator[List[Tuple]]:
+        """Yield the rows, `batch_size` at a time."""
+        for batch in self.file.iter_batches(
+            batch_size=batch_size, columns=[*self.columns, self.geometry]
+        ):
+            columns = []
+            for name, convert in zip([*self.columns, self.geometry], [*self.converters, None]):
+                values = batch.column(name).to_pylist()
+                if convert:
+                    values = [None if v is None else convert(v) for v in values]
+                columns.append(values)
+
+            yield list(zip(*columns))
+
+
+def open_source(path: str, infer_rows: int = 1000) -> Source:
+    """Source of a file, from its extension."""
+    extension = path.rsplit(".", 1)[-1].lower()
+    if extension in ("geojson", "json"):
+        return FeatureSource(geojson_features(path), infer_rows=infer_rows)
+    if extension in ("ndjson", "geojsonl", "geojsons", "jsonl"):
+        return FeatureSource(ndjson_features(path), infer_rows=infer_rows)
+    if extension in ("parquet", "geoparquet"):
+        return ParquetSource(path)
+
+    raise ValueError(f"Unsupported file extension: {path}")
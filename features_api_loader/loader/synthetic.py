@@ -0,0 +1,387 @@
+"""Generate synthetic PostGIS collections for scale testing.
+
+usage: python -m loader.synthetic --geometry point --geometry multipolygon --size 10k --size 1M
+       python -m loader.synthetic --geometry line --size 10M --srid 9311 --projected-srid 3857
+"""
+import argparse
+import itertools
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Iterator, List, Tuple
+
+import numpy
+import psycopg
+import shapely
+
+from loader.load import Loader
+from loader.sources import Field, Source
+
+try:
+    import pyproj
+except ImportError:  # pragma: nocover
+    pyproj = None  # type: ignore
+
+# Collection sizes used by the scale tests
+SIZES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+
+GEOMETRY_TYPES = ("point", "line", "multipolygon")
+
+# Contiguous United States, in longitude/latitude, which 9311 (US National Atlas) covers
+CONUS = (-125.0, 24.0, -66.0, 50.0)
+
+# Types of the additional properties, in turn
+PROPERTY_TYPES = ("float8", "int8", "text", "bool")
+
+# Centers around which the features of the "clustered" distribution gather
+CLUSTERS = 64
+
+
+def parse_size(value: str) -> int:
+    """Number of rows of a size like 10k, 1M or 2500."""
+    if value in SIZES:
+        return SIZES[value]
+
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    unit = value[-1:].lower()
+    if unit in multipliers:
+        return int(float(value[:-1]) * multipliers[unit])
+    return int(value)
+
+
+class SyntheticSource(Source):
+    """Deterministic random features.
+
+    Rows have an `id`, a `datetime`, a low cardinality `category` and `properties`
+    more columns, followed by a point, a random walk line, or a multipolygon of
+    non-overlapping star-shaped parts, some with a hole. Features are created in
+    longitude/latitude within `bbox` and projected to `srid`.
+    """
+
+    def __init__(
+        self,
+        geometry: str = "point",
+        rows: int = 10_000,
+        properties: int = 4,
+        datetimes: str = "uniform",
+        spatial: str = "clustered",
+        srid: int = 4326,
+        bbox: Tuple[float, float, float, float] = CONUS,
+        vertices: int = 128,
+        feature_size: float = 0.05,
+        start: datetime = datetime(2000, 1, 1, tzinfo=timezone.utc),
+        end: datetime = datetime(2024, 1, 1, tzinfo=timezone.utc),
+        seed: int = 0,
+    ) -> None:
+        """Init source."""
+        if geometry not in GEOMETRY_TYPES:
+            raise ValueError(f"Unsupported geometry type: {geometry}")
+        if datetimes not in ("uniform", "sequential", "recent"):
+            raise ValueError(f"Unsupported datetime distribution: {datetimes}")
+        if spatial not in ("uniform", "clustered"):
+            raise ValueError(f"Unsupported spatial distribution: {spatial}")
+        if srid != 4326 and pyproj is None:
+            raise ValueError("Synthetic features in another SRID than 4326 need pyproj")
+
+        self.geometry = geometry
+        self.rows = rows
+        self.datetimes = datetimes
+        self.spatial = spatial
+        self.srid = srid
+        self.bbox = bbox
+        self.vertices = vertices
+        self.feature_size = feature_size
+        self.start = start.timestamp()
+        self.end = end.timestamp()
+        self.rng = numpy.random.default_rng(seed)
+
+        self.fields = [
+            Field("id", "int8"),
+            Field("datetime", "timestamptz"),
+            Field("category", "text"),
+        ] + [
+            Field(f"property_{i}", PROPERTY_TYPES[i % len(PROPERTY_TYPES)])
+            for i in range(properties)
+        ]
+
+        xmin, ymin, xmax, ymax = bbox
+        self.clusters = numpy.column_stack(
+            [
+                self.rng.uniform(xmin, xmax, CLUSTERS),
+                self.rng.uniform(ymin, ymax, CLUSTERS),
+            ]
+        )
+        self.transformer = (
+            pyproj.Transformer.from_crs(4326, srid, always_xy=True)
+            if srid != 4326
+            else None
+        )
+
+    def centers(self, count: int) -> numpy.ndarray:
+        """Locations of the features."""
+        xmin, ymin, xmax, ymax = self.bbox
+        if self.spatial == "uniform":
+            x = self.rng.uniform(xmin, xmax, count)
+            y = self.rng.uniform(ymin, ymax, count)
+        else:
+            clusters = self.clusters[self.rng.integers(0, CLUSTERS, count)]
+            spread = self.rng.normal(0, 0.03, (count, 2)) * (xmax - xmin, ymax - ymin)
+            x, y = (clusters + spread).T
+
+        return numpy.column_stack(
+            [numpy.clip(x, xmin, xmax), numpy.clip(y, ymin, ymax)]
+        )
+
+    def lines(self, centers: numpy.ndarray) -> numpy.ndarray:
+        """Random walks of 2 to `vertices` vertices from the centers."""
+        count = len(centers)
+        sizes = self.rng.integers(2, max(self.vertices, 2) + 1, count)
+        starts = numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+
+        steps = self.rng.normal(0, self.feature_size / 10, (sizes.sum(), 2))
+        steps[numpy.cumsum(sizes) - sizes] = 0
+        walks = numpy.cumsum(steps, axis=0)
+        coords = walks - walks[starts] + numpy.repeat(centers, sizes, axis=0)
+
+        return shapely.linestrings(coords, indices=numpy.repeat(numpy.arange(count), sizes))
+
+    def multipolygons(self, centers: numpy.ndarray) -> numpy.ndarray:
+        """Multipolygons of 1 to 4 star-shaped parts side by side, a third with a hole."""
+        count = len(centers)
+        radii = self.feature_size * self.rng.lognormal(0, 0.75, count)
+        parts = self.rng.integers(1, 5, count)
+        part_feature = numpy.repeat(numpy.arange(count), parts)
+        part_index = numpy.arange(parts.sum()) - numpy.repeat(numpy.cumsum(parts) - parts, parts)
+        part_radius = radii[part_feature]
+        # Parts are 2.5 radii apart so they never overlap
+        part_centers = centers[part_feature] + numpy.column_stack(
+            [
+                part_index * 2.5 * part_radius,
+                self.rng.uniform(-0.5, 0.5, len(part_feature)) * part_radius,
+            ]
+        )
+
+        # Each part has a shell, then maybe a hole
+        holes = self.rng.random(len(part_feature)) < 1 / 3
+        ring_part = numpy.repeat(numpy.arange(len(part_feature)), 1 + holes)
+        is_hole = numpy.zeros(len(ring_part), dtype=bool)
+        is_hole[1:] = ring_part[1:] == ring_part[:-1]
+
+        sizes = numpy.where(
+            is_hole, 8, self.rng.integers(8, max(self.vertices, 8) + 1, len(ring_part))
+        )
+        ring_vertex = numpy.repeat(ring_part, sizes)
+        position = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        # One vertex per angular sector: shells stay beyond half the radius, around holes
+        # within 0.4 of it
+        angles = (
+            2 * numpy.pi * (position + self.rng.random(len(position)) * 0.5)
+            / numpy.repeat(sizes, sizes)
+        )
+        hole_vertex = numpy.repeat(is_hole, sizes)
+        distances = part_radius[ring_vertex] * numpy.where(
+            hole_vertex,
+            self.rng.uniform(0.2, 0.4, len(position)),
+            self.rng.uniform(0.6, 1.0, len(position)),
+        )
+        coords = part_centers[ring_vertex] + numpy.column_stack(
+            [distances * numpy.cos(angles), distances * numpy.sin(angles)]
+        )
+
+        rings = shapely.linearrings(coords, indices=numpy.repeat(numpy.arange(len(sizes)), sizes))
+        polygons = shapely.polygons(rings, indices=ring_part)
+        return shapely.multipolygons(polygons, indices=part_feature)
+
+    def geometries(self, count: int) -> List[bytes]:
+        """EWKB of `count` features."""
+        centers = self.centers(count)
+        if self.geometry == "point":
+            geometries = shapely.points(centers)
+        elif self.geometry == "line":
+            geometries = self.lines(centers)
+        else:
+            geometries = self.multipolygons(centers)
+
+        if self.transformer is not None:
+            transform = self.transformer.transform
+            geometries = shapely.transform(
+                geometries, lambda xy: numpy.column_stack(transform(xy[:, 0], xy[:, 1]))
+            )
+
+        return shapely.to_wkb(shapely.set_srid(geometries, self.srid), include_srid=True)
+
+    def timestamps(self, ids: numpy.ndarray) -> numpy.ndarray:
+        """POSIX timestamps of the features."""
+        span = self.end - self.start
+        if self.datetimes == "sequential":
+            # Increasing with the ids, like rows appended as they are observed
+            return self.start + (ids - 1) * span / max(self.rows - 1, 1)
+        if self.datetimes == "recent":
+            # Most features in the last years
+            ages = self.rng.exponential(span / 10, len(ids))
+            return numpy.maximum(self.end - ages, self.start)
+        return self.rng.uniform(self.start, self.end, len(ids))
+
+    def values(self, type: str, count: int) -> List:
+        """Values of an additional property."""
+        if type == "float8":
+            return self.rng.normal(100, 25, count).tolist()
+        if type == "int8":
+            return self.rng.integers(0, 1_000_000, count).tolist()
+        if type == "bool":
+            return (self.rng.random(count) < 0.5).tolist()
+        return [f"value {i}" for i in self.rng.zipf(1.5, count).tolist()]
+
+    def batches(self, batch_size: int) -> Iterator[List[Tuple]]:
+        """Yield the rows, `batch_size` at a time."""
+        for offset in range(0, self.rows, batch_size):
+            count = min(batch_size, self.rows - offset)
+            ids = numpy.arange(offset + 1, offset + count + 1)
+            datetimes = [
+                datetime.fromtimestamp(ts, timezone.utc)
+                for ts in self.timestamps(ids).tolist()
+            ]
+            categories = [
+                f"category {i}" for i in self.rng.integers(0, 20, count).tolist()
+            ]
+            properties = [self.values(field.type, count) for field in self.fields[3:]]
+
+            yield list(
+                zip(
+                    ids.tolist(),
+                    datetimes,
+                    categories,
+                    *properties,
+                    self.geometries(count),
+                )
+            )
+
+
+def table_name(prefix: str, geometry: str, size: str, srid: int) -> str:
+    """Table of a synthetic collection, e.g. synthetic_point_1m or synthetic_line_10k_9311."""
+    name = f"{prefix}{geometry}_{size.lower()}"
+    return name if srid == 4326 else f"{name}_{srid}"
+
+
+def check_srid(conninfo: str, srid: int) -> None:
+    """Exit when the database does not know the SRID."""
+    with psycopg.connect(conninfo) as conn:
+        if not conn.execute(
+            "SELECT 1 FROM spatial_ref_sys WHERE srid = %s", (srid,)
+        ).fetchone():
+            sys.exit(
+                f"SRID {srid} is not in spatial_ref_sys, 9311 is added by the database "
+                "bootstrap (add_SRID_9311 in features_api_database/runtime/handler.py)"
+            )
+
+
+def main():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dsn",
+        default=os.environ.get("DATABASE_URL", ""),
+        help="PostgreSQL connection string, defaults to DATABASE_URL or the PG* variables.",
+    )
+    parser.add_argument(
+        "--geometry",
+        choices=GEOMETRY_TYPES,
+        action="append",
+        help="Geometry type of a collection (repeat for several, all by default).",
+    )
+    parser.add_argument(
+        "--size",
+        action="append",
+        help="Rows of a collection: 10k, 1M, 10M or a number (repeat for several, 10k by default).",
+    )
+    parser.add_argument("--srid", type=int, default=4326, help="SRID of the geometries.")
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        default=CONUS,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        help="Longitude/latitude area of the features, the contiguous US by default.",
+    )
+    parser.add_argument(
+        "--properties", type=int, default=4, help="Properties besides id, datetime and category."
+    )
+    parser.add_argument(
+        "--datetime",
+        choices=["uniform", "sequential", "recent"],
+        default="uniform",
+        help="Datetimes spread over 2000-2024, increasing with the id, or mostly recent.",
+    )
+    parser.add_argument(
+        "--spatial",
+        choices=["uniform", "clustered"],
+        default="clustered",
+        help="Features spread over the area, or gathered around a few places.",
+    )
+    parser.add_argument(
+        "--vertices", type=int, default=128, help="Maximum vertices of a line or polygon ring."
+    )
+    parser.add_argument(
+        "--feature-size",
+        type=float,
+        default=0.05,
+        help="Typical size of the lines and polygon parts, in degrees.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random features.")
+    parser.add_argument(
+        "--table-prefix",
+        default="public.synthetic_",
+        help="Prefix of the tables, named {prefix}{geometry}_{size}[_{srid}].",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Number of COPY connections.")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Rows per COPY.")
+    parser.add_argument(
+        "--cluster",
+        action="store_true",
+        help="Reorder the rows along the spatial index so features close in space share pages.",
+    )
+    parser.add_argument(
+        "--projected-srid",
+        type=int,
+        action="append",
+        default=[],
+        help="Add a `geom_{srid}` copy of the geometries projected to this SRID, e.g. 3857 for the tiles.",
+    )
+    args = parser.parse_args()
+
+    check_srid(args.dsn, args.srid)
+
+    for geometry, size in itertools.product(
+        args.geometry or GEOMETRY_TYPES, args.size or ["10k"]
+    ):
+        table = table_name(args.table_prefix, geometry, size, args.srid)
+        source = SyntheticSource(
+            geometry=geometry,
+            rows=parse_size(size),
+            properties=args.properties,
+            datetimes=args.datetime,
+            spatial=args.spatial,
+            srid=args.srid,
+            bbox=tuple(args.bbox),
+            vertices=args.vertices,
+            feature_size=args.feature_size,
+            seed=args.seed,
+        )
+        report = Loader(
+            args.dsn,
+            table,
+            source,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            id_field="id",
+            cluster=args.cluster,
+            projected_srids=args.projected_srid,
+        ).run()
+        print(
+            f"Loaded {report.rows} rows into {report.table} at "
+            f"{report.rows_per_second:.0f} rows/s ({report.seconds:.1f}s in total)"
+        )
+
+
+if __name__ == "__main__":
+    main()
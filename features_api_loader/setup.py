@@ -0,0 +1,38 @@
+"""Setup veda.features_loader."""
+
+from setuptools import find_packages, setup
+
+with open("README.md") as f:
+    long_description = f.read()
+
+inst_reqs = [
+    "psycopg[binary]>=3.1",
+    "orjson",
+    "shapely>=2.0",
+    "ijson>=3.1",
+    "numpy",  # loader/synthetic.py
+]
+
+extra_reqs = {
+    "parquet": ["pyarrow"],  # GeoParquet sources
+    "synthetic": ["pyproj"],  # synthetic collections in another SRID than 4326
+    "test": ["pytest"],
+}
+
+
+setup(
+    name="veda.features_loader",
+    description="Bulk loader of PostGIS collections for veda.features_api",
+    long_description=long_description,
+    python_requires=">=3.9",
+    packages=find_packages(exclude=["tests*"]),
+    zip_safe=False,
+    install_requires=inst_reqs,
+    extras_require=extra_reqs,
+    entry_points={
+        "console_scripts": [
+            "veda-features-load=loader.__main__:main",
+            "veda-features-synthetic=loader.synthetic:main",
+        ]
+    },
+)
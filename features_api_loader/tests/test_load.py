@@ -0,0 +1,129 @@
+"""Test the COPY loader, without a database."""
+import contextlib
+import threading
+
+import pytest
+
+from loader.load import Loader
+from loader.sources import Field
+
+
+class Source:
+    """Source of `count` rows with two properties."""
+
+    fields = [Field("name", "text"), Field("value", "float8")]
+    srid = 4326
+
+    def __init__(self, count: int = 0):
+        """Init source."""
+        self.count = count
+
+    def batches(self, size):
+        """Rows, `size` at a time."""
+        rows = [(f"n{i}", float(i), b"wkb") for i in range(self.count)]
+        for start in range(0, len(rows), size):
+            yield rows[start : start + size]
+
+
+class Cursor:
+    """psycopg cursor recording the statements."""
+
+    def __init__(self):
+        """Init cursor."""
+        self.statements = []
+        self.connection = self
+
+    def execute(self, statement):
+        """Record a statement."""
+        if not isinstance(statement, str):
+            statement = statement.as_string(None)
+        self.statements.append(statement)
+
+    def fetchone(self):
+        """No extents store."""
+        return None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Transaction."""
+        self.statements.append("BEGIN")
+        yield
+        self.statements.append("COMMIT")
+
+
+def test_create_table():
+    """The loading table has the source columns, a key and the geometries, no index."""
+    loader = Loader("", "data.places", Source(), projected_srids=[3857])
+    cur = Cursor()
+    loader.create_table(cur)
+
+    assert cur.statements == [
+        'DROP TABLE IF EXISTS "data"."places_loading"',
+        'CREATE TABLE "data"."places_loading" ('
+        '"fid" bigint GENERATED BY DEFAULT AS IDENTITY, "name" text, "value" float8, '
+        '"geom" geometry(Geometry, 4326), '
+        '"geom_3857" geometry(Geometry, 3857) GENERATED ALWAYS AS '
+        '(features_api.project_geometry("geom", 3857)) STORED)',
+    ]
+    assert loader.copy_statement().as_string(None) == (
+        'COPY "data"."places_loading" ("name", "value", "geom") FROM STDIN (FORMAT BINARY)'
+    )
+
+    # Appended rows go to the table itself, which keeps its key
+    loader = Loader("", "places", Source(), id_field="name", append=True)
+    assert loader.copy_statement().as_string(None).startswith('COPY "public"."places" (')
+
+
+def test_finish():
+    """The loaded table is indexed, analyzed, then swapped with the target at once."""
+    loader = Loader("", "places", Source(), cluster=True)
+    cur = Cursor()
+    loader.finish(cur)
+
+    assert cur.statements[:4] == [
+        'ALTER TABLE "public"."places_loading" ADD CONSTRAINT "places_loading_pkey" '
+        'PRIMARY KEY ("fid")',
+        'CREATE INDEX "places_loading_geom_idx" ON "public"."places_loading" '
+        'USING gist ("geom")',
+        'CLUSTER "public"."places_loading" USING "places_loading_geom_idx"',
+        'ANALYZE "public"."places_loading"',
+    ]
+    swap = cur.statements[cur.statements.index("BEGIN") : cur.statements.index("COMMIT")]
+    assert swap[1:3] == [
+        'DROP TABLE IF EXISTS "public"."places"',
+        'ALTER TABLE "public"."places_loading" RENAME TO "places"',
+    ]
+
+    # Appended rows are only analyzed
+    loader = Loader("", "places", Source(), append=True)
+    cur = Cursor()
+    loader.finish(cur)
+    assert cur.statements[0] == 'ANALYZE "public"."places"'
+    assert "BEGIN" not in cur.statements
+
+
+def test_copy(monkeypatch):
+    """Batches are copied by the workers; a failing worker stops the load."""
+    copied = []
+    lock = threading.Lock()
+
+    def copy_worker(self, batches):
+        while (rows := batches.get()) is not None:
+            with lock:
+                copied.extend(rows)
+                self.report.rows += len(rows)
+
+    monkeypatch.setattr(Loader, "copy_worker", copy_worker)
+    loader = Loader("", "places", Source(25), workers=3, batch_size=4)
+    loader.copy()
+    assert sorted(row[1] for row in copied) == [float(i) for i in range(25)]
+    assert loader.report.rows == 25
+
+    def failing_worker(self, batches):
+        raise RuntimeError("copy failed")
+
+    monkeypatch.setattr(Loader, "copy_worker", failing_worker)
+    loader = Loader("", "places", Source(1000), workers=2, batch_size=1)
+    with pytest.raises(RuntimeError, match="copy failed"):
+        loader.copy()
+    assert loader.stop.is_set()
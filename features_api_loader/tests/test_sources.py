@@ -0,0 +1,72 @@
+"""Test the feature sources."""
+import pytest
+
+from loader.load import Loader
+from loader.sources import FeatureSource, Field
+
+
+def feature(**properties):
+    """Point feature with properties."""
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [0.0, 0.0]},
+        "properties": properties,
+    }
+
+
+def test_inferred_types():
+    """Types are inferred from the first features, values converted to them."""
+    source = FeatureSource(
+        iter(
+            [
+                feature(count=1, value=1, flag=True, name="a", tags=["x"]),
+                feature(count=2.0, value=1.5, flag=None, name=3, tags={"y": 1}),
+            ]
+        )
+    )
+    assert source.fields == [
+        Field("count", "float8"),
+        Field("value", "float8"),
+        Field("flag", "bool"),
+        Field("name", "text"),
+        Field("tags", "jsonb"),
+    ]
+
+    source = FeatureSource(iter([feature(count=1), feature(count=2.0)]), infer_rows=1)
+    assert source.fields == [Field("count", "int8")]
+    rows = [row[:-1] for batch in source.batches(10) for row in batch]
+    assert rows == [(1,), (2,)]
+
+
+@pytest.mark.parametrize("value", [1.5, "n/a", True])
+def test_value_of_another_type(value):
+    """A value of another type than inferred names its property."""
+    features = [feature(count=1), feature(count=2), feature(count=value)]
+    source = FeatureSource(iter(features), infer_rows=2)
+    assert source.fields == [Field("count", "int8")]
+
+    with pytest.raises(ValueError, match="Property 'count' of feature 2"):
+        list(source.batches(1))
+
+
+@pytest.mark.parametrize(
+    "name,kwargs",
+    [
+        ("fid", {}),
+        ("geom", {"id_field": "id"}),
+        ("geom_3857", {"id_field": "id", "projected_srids": [3857]}),
+    ],
+)
+def test_reserved_columns(name, kwargs):
+    """Properties named as the columns added by the loader are rejected."""
+    source = FeatureSource(iter([feature(id=1, **{name: 1})]))
+    loader = Loader("postgresql://localhost/test", "public.test", source, **kwargs)
+    with pytest.raises(ValueError, match=f"Property '{name}'"):
+        loader.run()
+
+
+def test_fid_id_field():
+    """A `fid` property can be the id field."""
+    source = FeatureSource(iter([feature(fid=1)]))
+    loader = Loader("postgresql://localhost/test", "public.test", source, id_field="fid")
+    assert loader.reserved_columns() == ["geom"]